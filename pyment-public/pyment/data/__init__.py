@@ -1,3 +1,4 @@
+from .augmenters import BatchAugmenter
 from .datasets import NiftiDataset
 from .io import NiftiLoader
 from .generators import AsyncNiftiGenerator, NiftiGenerator
\ No newline at end of file
@@ -0,0 +1 @@
+from .batch_augmenter import BatchAugmenter
\ No newline at end of file
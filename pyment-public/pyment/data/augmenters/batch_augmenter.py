@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import numpy as np
+
+from typing import List, Tuple
+
+
+class BatchAugmenter(object):
+    """Expands a batch of decoded images into one enlarged batch holding
+    every configured augmentation of every image, and reduces the
+    predictions for the enlarged batch back to one prediction per image.
+
+    Augmentations are given as strings:
+        'identity': The image itself
+        'flip' or 'flip:<axis>': The image mirrored along the given axis
+            (default 0, which is left-right for images in MNI152 space)
+        'shift:<dy>,<dx>,<dz>': The image translated by the given number
+            of voxels. Voxels moved in from outside the volume are zero
+
+    Args:
+        augmentations (List[str]): The augmentations to apply. Defaults to
+            ['identity', 'flip']
+        reduction (str): How the predictions for the augmented copies of
+            an image are combined. Either 'mean' or 'median'
+    """
+
+    def __init__(self, augmentations: List[str] = None, *,
+                 reduction: str = 'mean') -> BatchAugmenter:
+        if augmentations is None:
+            augmentations = ['identity', 'flip']
+
+        if len(augmentations) == 0:
+            raise ValueError('BatchAugmenter needs at least one augmentation')
+
+        if reduction not in ['mean', 'median']:
+            raise ValueError(f'Unknown reduction {reduction}')
+
+        self.augmentations = [self._parse(a) for a in augmentations]
+        self.reduction = reduction
+
+    @staticmethod
+    def _parse(augmentation: str) -> Tuple[str, Tuple[int]]:
+        name, _, params = augmentation.partition(':')
+
+        if name == 'identity' and params == '':
+            return name, ()
+        elif name == 'flip':
+            return name, (int(params) if params != '' else 0,)
+        elif name == 'shift' and params != '':
+            return name, tuple(int(p) for p in params.split(','))
+
+        raise ValueError(f'Unknown augmentation {augmentation}')
+
+    @staticmethod
+    def _shift(X: np.ndarray, offsets: Tuple[int], out: np.ndarray) -> None:
+        if len(offsets) != len(X.shape) - 1:
+            raise ValueError((f'Shift {offsets} does not match images of '
+                              f'shape {X.shape[1:]}'))
+
+        src = [slice(None)]
+        dest = [slice(None)]
+
+        for offset in offsets:
+            src.append(slice(max(0, -offset), -offset if offset > 0 else None))
+            dest.append(slice(max(0, offset), offset if offset < 0 else None))
+
+        out[...] = 0
+        out[tuple(dest)] = X[tuple(src)]
+
+    def augment(self, X: np.ndarray) -> np.ndarray:
+        """Returns a batch of len(X) * len(self) images where the
+        augmented copies of each image are stored consecutively"""
+        augmented = np.empty((len(X), len(self)) + X.shape[1:],
+                             dtype=X.dtype)
+
+        for i, (name, params) in enumerate(self.augmentations):
+            out = augmented[:, i]
+
+            if name == 'identity':
+                out[...] = X
+            elif name == 'flip':
+                out[...] = np.flip(X, axis=params[0] + 1)
+            elif name == 'shift':
+                self._shift(X, params, out)
+
+        return augmented.reshape((-1,) + X.shape[1:])
+
+    def reduce(self, predictions: np.ndarray) -> np.ndarray:
+        """Combines predictions for a batch produced by augment into one
+        prediction per original image"""
+        if len(predictions) % len(self) != 0:
+            raise ValueError((f'Number of predictions {len(predictions)} is '
+                              f'not a multiple of {len(self)} augmentations'))
+
+        predictions = predictions.reshape((-1, len(self)) +
+                                          predictions.shape[1:])
+
+        if self.reduction == 'median':
+            return np.median(predictions, axis=1)
+
+        return np.mean(predictions, axis=1)
+
+    def __len__(self) -> int:
+        return len(self.augmentations)
@@ -32,7 +32,7 @@ class NiftiDataset(Dataset):
     @classmethod
     def from_folder(cls, root: str, *, show_missing_warnings: bool = True, 
                     images: str = 'images', labels: str = 'labels.csv', 
-                    suffix: str = 'nii.gz', **kwargs) -> NiftiDataset:
+                    suffix: str = None, **kwargs) -> NiftiDataset:
         images = os.path.join(root, images)
         labels = os.path.join(root, labels)
 
@@ -41,8 +41,13 @@ class NiftiDataset(Dataset):
         assert 'id' in df.columns, 'labels is missing id column'
 
         label_ids = set(df['id'])
-        image_ids = set([filename.split('.')[0] \
-                         for filename in os.listdir(images)])
+        # Without a suffix, images are used with whichever suffix they were
+        # written with, e.g. uncompressed intermediates. If both exist,
+        # .nii.gz is sorted last and used
+        filenames = {filename.split('.')[0]: filename \
+                     for filename in sorted(os.listdir(images)) \
+                     if not filename.startswith('.')}
+        image_ids = set(filenames.keys())
 
         missing_images = label_ids - image_ids
         missing_labels = image_ids - label_ids
@@ -62,7 +67,9 @@ class NiftiDataset(Dataset):
                             '\'path\' as this is used internally. This column '
                             'will be dropped'))
 
-        create_path = lambda x: os.path.join(images, f'{x}.{suffix}')
+        create_path = lambda x: os.path.join(images, f'{x}.{suffix}' \
+                                             if suffix is not None \
+                                             else filenames[str(x)])
 
         df['path'] = df['id'].apply(create_path)
 
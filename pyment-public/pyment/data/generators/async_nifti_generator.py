@@ -3,9 +3,10 @@ import numpy as np
 
 from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, List, Tuple
 
 from .nifti_generator import NiftiGenerator
+from ...utils.cpu import pin_current_thread
 
 
 format = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
@@ -14,7 +15,8 @@ logger = logging.getLogger(__name__)
 
 class AsyncNiftiGenerator(NiftiGenerator):
     def __init__(self, *args, threads: int, 
-                 avoid_singular_batches: bool = False, **kwargs):
+                 avoid_singular_batches: bool = False, cpus: List[int] = None,
+                 **kwargs):
         super().__init__(*args, **kwargs)
 
         if threads < 2:
@@ -23,6 +25,7 @@ class AsyncNiftiGenerator(NiftiGenerator):
 
         self.threads = threads
         self.avoid_singular_batches = avoid_singular_batches
+        self.cpus = cpus
 
         self._exception = None
         self._next_batch = None
@@ -37,7 +40,9 @@ class AsyncNiftiGenerator(NiftiGenerator):
         if hasattr(self, 'threadpool'):
             self.threadpool.shutdown(wait=True)
 
-        self.threadpool = ThreadPoolExecutor(max_workers=self.threads)
+        self.threadpool = ThreadPoolExecutor(max_workers=self.threads,
+                                             initializer=pin_current_thread,
+                                             initargs=(self.cpus,))
         self._next_batch = None
 
         super()._initialize()
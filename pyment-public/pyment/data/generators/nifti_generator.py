@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import math
+import os
 import numpy as np
 
 from collections.abc import Iterator
@@ -8,6 +9,7 @@ from typing import Any, Callable, Dict, List, Tuple
 
 from ..io import NiftiLoader
 from ...callbacks import Resettable
+from ...utils.telemetry import track
 
 
 class NiftiGenerator(Iterator, Resettable):
@@ -43,8 +45,11 @@ class NiftiGenerator(Iterator, Resettable):
                              f'{len(self.dataset)} data points'))
 
         path = self.dataset.paths[idx]
-        image = self.loader.load(path)
-        image = self.preprocessor(image)
+
+        with track('load', subject=os.path.basename(path).split('.')[0],
+                   generator=self.name):
+            image = self.loader.load(path)
+            image = self.preprocessor(image)
 
         return image
 
@@ -1,13 +1,32 @@
+import os
 import nibabel as nib
 import numpy as np
 
 
 class NiftiLoader(object):
+    # Images may be stored compressed or not, e.g. when intermediates are
+    # written uncompressed to save time
+    suffixes = ['.nii.gz', '.nii']
+
     def __init__(self):
         self._cache = {}
 
+    def _resolve(self, path: str) -> str:
+        if os.path.isfile(path):
+            return path
+
+        for suffix in self.suffixes:
+            if path.endswith(suffix):
+                stem = path[:-len(suffix)]
+
+                for other in self.suffixes:
+                    if os.path.isfile(stem + other):
+                        return stem + other
+
+        return path
+
     def _load(self, path: str) -> nib.Nifti1Image:
-        return nib.load(path)
+        return nib.load(self._resolve(path))
 
     def load(self, path: str) -> np.ndarray:
         return self._load(path).get_fdata()
@@ -8,7 +8,9 @@ from typing import Any
 from tqdm import tqdm
 
 from .model_type import ModelType
-from .utils import WeightRepository
+from .utils import TiledExecutor, WeightRepository
+from ..data.augmenters import BatchAugmenter
+from ..utils.telemetry import track
 
 
 class Model(KerasModel):
@@ -32,7 +34,44 @@ class Model(KerasModel):
         
             self.load_weights(weights)
 
-    def predict(self, data: Any, *, return_labels: bool = False, **kwargs):
+    def _predict_array(self, X: np.ndarray, *, augmenter: BatchAugmenter,
+                       executor: TiledExecutor, **kwargs) -> np.ndarray:
+        if augmenter is not None:
+            # All augmented copies of the batch go through the model in a
+            # single forward pass
+            batch_size = kwargs.get('batch_size', len(X))
+            X = augmenter.augment(X)
+            kwargs = {**kwargs, 'batch_size': batch_size * len(augmenter)}
+
+        # The work is done by TensorFlow threads, so the whole process is
+        # measured
+        with track('predict', images=len(X), model=self.__class__.__name__,
+                   process=True):
+            if executor is not None:
+                predictions = executor.predict(X)
+            else:
+                predictions = super().predict(X, **kwargs)
+
+        if augmenter is not None:
+            predictions = augmenter.reduce(predictions)
+
+        return predictions
+
+    def predict(self, data: Any, *, return_labels: bool = False,
+                augmenter: BatchAugmenter = None, memory_limit: int = None,
+                **kwargs):
+        """Predicts for a numpy array or a generator of batches.
+
+        Args:
+            augmenter (BatchAugmenter): If given, predictions are reduced
+                over the augmented copies of each image
+            memory_limit (int): If given, the first blocks of the model are
+                run in spatial tiles with activations bounded by the given
+                number of bytes (see TiledExecutor)
+        """
+        executor = TiledExecutor(self, memory_limit=memory_limit) \
+                   if memory_limit is not None else None
+
         if isinstance(data, Iterator):
             predictions = None
             labels = None
@@ -44,7 +83,9 @@ class Model(KerasModel):
                     X = batch
                     y = np.asarray([None] * len(batch))
 
-                batch_predictions = self.predict(X, **kwargs)
+                batch_predictions = self._predict_array(X, augmenter=augmenter,
+                                                        executor=executor,
+                                                        **kwargs)
                 predictions = np.concatenate([predictions, batch_predictions]) \
                               if predictions is not None else batch_predictions
                 labels = np.concatenate([labels, y]) if labels is not None else y
@@ -54,4 +95,5 @@ class Model(KerasModel):
 
             return predictions
         elif isinstance(data, np.ndarray):
-            return super().predict(data, **kwargs)
\ No newline at end of file
+            return self._predict_array(data, augmenter=augmenter,
+                                       executor=executor, **kwargs)
\ No newline at end of file
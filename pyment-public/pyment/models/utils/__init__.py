@@ -1,2 +1,3 @@
 from .restrict_range import restrict_range
+from .tiled_executor import TiledExecutor
 from .weight_repository import WeightRepository
\ No newline at end of file
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import logging
+import numpy as np
+import tensorflow as tf
+
+from itertools import product
+from tensorflow.keras import Model as KerasModel
+from typing import List, Tuple
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class TiledExecutor(object):
+    """Runs an SFCN with bounded memory by executing the first
+    high-resolution blocks on spatial tiles of the input. Each tile is
+    extended by the halo needed by the 3x3x3 convolutions and the
+    pooling of the tiled blocks, and the tiles are stitched together
+    after the last tiled block before the rest of the model is run as
+    usual. Zero padding is only applied where a tile touches the border
+    of the volume, so the output matches the untiled model.
+
+    Args:
+        model (Model): An SFCN (as defined in pyment.models)
+        blocks (int): Number of initial blocks to run in tiles
+        memory_limit (int): Upper bound in bytes for the activations of
+            a single tile. The number of tiles is chosen accordingly
+        tiles (Tuple[int, int, int]): Number of tiles along each axis.
+            Overrides memory_limit if given
+    """
+
+    def __init__(self, model: KerasModel, *, blocks: int = 2,
+                 memory_limit: int = None,
+                 tiles: Tuple[int, int, int] = None) -> TiledExecutor:
+        if memory_limit is None and tiles is None:
+            raise ValueError(('TiledExecutor needs either a memory_limit or '
+                              'an explicit number of tiles'))
+
+        self.model = model
+        self.blocks = [self._get_block(i + 1) for i in range(blocks)]
+
+        pool = model.get_layer(f'{model.name}/block{blocks}/pool')
+        self.tail = KerasModel(pool.output, model.output)
+
+        self.input_shape = tuple(model.input_shape[1:])
+        self.sizes = [self.input_shape]
+
+        for _ in range(blocks):
+            self.sizes.append(tuple(n // 2 for n in self.sizes[-1]))
+
+        self.memory_limit = memory_limit
+        self.tiles = tiles
+
+        # Tiles of any shape share a single graph, as the extent and the
+        # padding of a tile are passed as tensors
+        self._blocks = tf.function(self._run_blocks, input_signature=[
+            tf.TensorSpec((None, None, None, None, 1), tf.float32),
+            tf.TensorSpec((blocks, 3, 2), tf.int32)
+        ])
+
+    def _get_block(self, i: int) -> Tuple[tf.keras.layers.Layer]:
+        prefix = f'{self.model.name}/block{i}'
+        layers = [layer for layer in self.model.layers \
+                  if layer.name.startswith(f'{prefix}/')]
+
+        if len(layers) != 4:
+            raise ValueError((f'Unable to find conv, norm, activation and '
+                              f'pool layers for {prefix}'))
+
+        return tuple(layers)
+
+    def _channels(self) -> List[int]:
+        return [1] + [block[0].filters for block in self.blocks]
+
+    def _ranges(self, start: int, stop: int,
+                axis: int) -> List[Tuple[Tuple[int, int], Tuple[int, int]]]:
+        """Returns, for each tiled block, the range along the given axis
+        of its input that is needed to compute [start, stop) after the
+        last tiled block, and the zero padding added at the volume
+        border"""
+        ranges = []
+
+        for level in reversed(range(len(self.blocks))):
+            lower, upper = 2 * start - 1, 2 * stop + 1
+            start = max(0, lower)
+            stop = min(self.sizes[level][axis], upper)
+            ranges.insert(0, ((start, stop), (start - lower, upper - stop)))
+
+        return ranges
+
+    def estimate_memory(self, shape: Tuple[int, int, int],
+                        batch_size: int = 1) -> int:
+        """Estimates the peak activation memory, in bytes, for running the
+        tiled blocks on a tile of the given shape (measured after the last
+        tiled block)"""
+        channels = self._channels()
+        extents = [np.asarray(shape)]
+
+        for _ in self.blocks:
+            extents.insert(0, 2 * extents[0] + 2)
+
+        peak = 0
+
+        for i in range(len(self.blocks)):
+            inputs = np.prod(extents[i]) * channels[i]
+            outputs = np.prod(extents[i] - 2) * channels[i + 1]
+            # The convolution output is alive together with its normalized
+            # counterpart while the activation is applied
+            peak = max(peak, inputs + 2 * outputs)
+
+        return int(peak * batch_size * 4)
+
+    def _plan(self, batch_size: int) -> Tuple[int, int, int]:
+        if self.tiles is not None:
+            return tuple(self.tiles)
+
+        tiles = [1, 1, 1]
+        sizes = self.sizes[-1]
+
+        while True:
+            shape = [int(np.ceil(n / t)) for n, t in zip(sizes, tiles)]
+
+            if self.estimate_memory(shape, batch_size) <= self.memory_limit:
+                break
+
+            axis = int(np.argmax(shape))
+
+            if shape[axis] <= 1:
+                logger.warning((f'Unable to fit tiles within memory limit '
+                                f'{self.memory_limit}'))
+                break
+
+            tiles[axis] += 1
+
+        return tuple(tiles)
+
+    def _run_blocks(self, x: tf.Tensor, padding: tf.Tensor) -> tf.Tensor:
+        for i, (conv, norm, activation, pool) in enumerate(self.blocks):
+            x = tf.pad(x, tf.concat([[[0, 0]], padding[i], [[0, 0]]],
+                                    axis=0))
+            x = tf.nn.conv3d(x, conv.kernel, strides=[1, 1, 1, 1, 1],
+                             padding='VALID')
+
+            if conv.use_bias:
+                x = tf.nn.bias_add(x, conv.bias)
+
+            x = norm(x, training=False)
+            x = activation(x)
+            x = pool(x)
+
+        return x
+
+    def _run_tile(self, X: tf.Tensor,
+                  ranges: List[List[Tuple[Tuple[int, int]]]]) -> tf.Tensor:
+        x = X[(slice(None),) + tuple(slice(*r[0][0]) for r in ranges)]
+        padding = [[r[i][1] for r in ranges] for i in range(len(self.blocks))]
+
+        return self._blocks(x, tf.constant(padding, dtype=tf.int32))
+
+    def _validate(self, X: np.ndarray) -> tf.Tensor:
+        if tuple(X.shape[1:]) != self.input_shape:
+            raise ValueError((f'Expected images of shape {self.input_shape}, '
+                              f'got {X.shape[1:]}'))
+
+        return tf.convert_to_tensor(X[..., np.newaxis], dtype=tf.float32)
+
+    def region(self, mask: np.ndarray) -> List[Tuple[int, int]]:
+        """Returns the region of the output of the last tiled block that a
+        change of the input within the given mask can reach, as (start,
+        stop) along each axis"""
+        region = []
+
+        for axis, coords in enumerate(np.nonzero(mask)):
+            start, stop = int(np.min(coords)), int(np.max(coords)) + 1
+
+            for level in range(len(self.blocks)):
+                # The 3x3x3 convolution spreads a change by one voxel, and
+                # the pooling halves the extent
+                start = max(0, (start - 1) // 2)
+                stop = min(self.sizes[level + 1][axis], (stop + 2) // 2)
+
+            region.append((start, stop))
+
+        return region
+
+    def features_in(self, X: np.ndarray,
+                    region: List[Tuple[int, int]]) -> np.ndarray:
+        """Returns the output of the last tiled block within a region of it,
+        given as (start, stop) along each axis, for a batch. Only the part
+        of the input that the region depends on is run"""
+        X = self._validate(X)
+        ranges = [self._ranges(start, stop, axis) \
+                  for axis, (start, stop) in enumerate(region)]
+
+        return self._run_tile(X, ranges).numpy()
+
+    def features(self, X: np.ndarray) -> np.ndarray:
+        """Returns the output of the last tiled block for a batch"""
+        X = self._validate(X)
+        sizes = self.sizes[-1]
+        tiles = [min(t, n) for t, n in zip(self._plan(len(X)), sizes)]
+        bounds = [np.linspace(0, n, t + 1).astype(int) \
+                  for n, t in zip(sizes, tiles)]
+
+        logger.debug(f'Running {np.prod(tiles)} tiles {tiles}')
+
+        features = np.zeros((len(X),) + sizes + (self._channels()[-1],),
+                            dtype=np.float32)
+
+        for index in product(*[range(t) for t in tiles]):
+            tile = [(b[i], b[i + 1]) for b, i in zip(bounds, index)]
+            ranges = [self._ranges(start, stop, axis) \
+                      for axis, (start, stop) in enumerate(tile)]
+            output = self._run_tile(X, ranges)
+
+            (y0, y1), (x0, x1), (z0, z1) = tile
+            features[:, y0:y1, x0:x1, z0:z1] = output.numpy()
+
+        return features
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        features = self.features(X)
+
+        return self.tail.predict(features, batch_size=len(features),
+                                 verbose=0)
@@ -1 +1,8 @@
-from .download import download
\ No newline at end of file
+from .cpu import configure_tensorflow_threads, numa_nodes, parse_cpulist, \
+                  pin_current_thread, resolve_cpus
+from .download import download
+from .memory import auto_batch_size, available_memory, \
+                     estimate_sample_memory, find_batch_size, \
+                     parse_batch_size, peak_memory
+from .telemetry import configure_telemetry, emit, load_telemetry, measure, \
+                       Measurement, summarize_telemetry, Telemetry, track
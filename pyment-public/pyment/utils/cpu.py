@@ -0,0 +1,92 @@
+import glob
+import logging
+import os
+
+from typing import Dict, List
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    """Parses a list of CPUs in the format used by the kernel and taskset,
+    e.g. '0-3,8,10-11'"""
+    cpus = []
+
+    for part in cpulist.strip().split(','):
+        if part == '':
+            continue
+
+        start, _, end = part.partition('-')
+        end = end if end != '' else start
+        cpus += list(range(int(start), int(end) + 1))
+
+    return cpus
+
+
+def numa_nodes() -> Dict[int, List[int]]:
+    """Returns the CPUs of each NUMA node of the host. Hosts without NUMA
+    information are reported as a single node containing all CPUs"""
+    nodes = {}
+
+    for folder in glob.glob('/sys/devices/system/node/node[0-9]*'):
+        node = int(os.path.basename(folder)[len('node'):])
+
+        with open(os.path.join(folder, 'cpulist'), 'r') as f:
+            nodes[node] = parse_cpulist(f.read())
+
+    if len(nodes) == 0:
+        nodes[0] = list(range(os.cpu_count()))
+
+    return dict(sorted(nodes.items()))
+
+
+def resolve_cpus(spec: str) -> List[int]:
+    """Resolves a CPU specification into a list of CPUs. The specification
+    is either a cpulist (e.g. '0-7') or a NUMA node (e.g. 'numa:1')"""
+    if spec is None:
+        return None
+
+    if spec.startswith('numa:'):
+        nodes = numa_nodes()
+        node = int(spec[len('numa:'):])
+
+        if node not in nodes:
+            raise ValueError((f'NUMA node {node} does not exist. Available '
+                              f'nodes are {list(nodes.keys())}'))
+
+        return nodes[node]
+
+    return parse_cpulist(spec)
+
+
+def pin_current_thread(cpus: List[int]) -> None:
+    """Restricts the calling thread to the given CPUs. Threads started by
+    the calling thread afterwards inherit the restriction"""
+    if cpus is None:
+        return
+
+    if not hasattr(os, 'sched_setaffinity'):
+        logger.warning('CPU affinity is not supported on this platform')
+        return
+
+    # On Linux, pid 0 refers to the calling thread
+    os.sched_setaffinity(0, cpus)
+
+
+def configure_tensorflow_threads(*, intra_op: int = None,
+                                 inter_op: int = None) -> None:
+    """Sets the number of threads used within (intra_op) and across
+    (inter_op) TensorFlow operations. Must be called before TensorFlow
+    executes its first operation"""
+    import tensorflow as tf
+
+    if intra_op is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+
+    if inter_op is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+    logger.debug((f'Configured TensorFlow with {intra_op} intra-op and '
+                  f'{inter_op} inter-op threads'))
@@ -0,0 +1,150 @@
+import logging
+import os
+import resource
+import numpy as np
+
+from typing import Any, Callable, Tuple, Union
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _read_cgroup_limit() -> int:
+    """Returns the memory left within the cgroup of the process (e.g. a
+    Slurm or container allocation), or None if it is unlimited"""
+    candidates = [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+         '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    ]
+
+    for limitfile, usagefile in candidates:
+        try:
+            with open(limitfile, 'r') as f:
+                limit = f.read().strip()
+            with open(usagefile, 'r') as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+
+        if limit == 'max' or int(limit) >= 2**60:
+            return None
+
+        return max(0, int(limit) - usage)
+
+    return None
+
+
+def available_memory() -> int:
+    """Returns the number of bytes of RAM currently available to the
+    process"""
+    available = None
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+
+    if available is None:
+        available = os.sysconf('SC_AVPHYS_PAGES') * \
+                    os.sysconf('SC_PAGE_SIZE')
+
+    limit = _read_cgroup_limit()
+
+    return min(available, limit) if limit is not None else available
+
+
+def peak_memory() -> int:
+    """Returns the peak resident memory of the process in bytes"""
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def estimate_sample_memory(model: Any, *, dtype: str = 'float32',
+                           training: bool = False) -> int:
+    """Estimates the activation memory needed per sample by a Keras model.
+
+    Args:
+        model (Model): The model. Only the output shapes of its layers
+            are used
+        dtype (str): Data type of the images fed to the model
+        training (bool): If true, all activations are kept alive for the
+            backward pass. Otherwise only the input and output of the
+            largest layer are alive at the same time
+
+    Returns:
+        int: Estimated number of bytes per sample
+    """
+    sizes = []
+
+    for layer in model.layers:
+        outputs = layer.output
+
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+
+        sizes.append(sum([int(np.prod(tuple(o.shape)[1:])) for o in outputs]))
+
+    inputs = int(np.prod(model.input_shape[1:])) * np.dtype(dtype).itemsize
+
+    # Activations are computed in float32
+    if training:
+        # Gradients of the activations are as large as the activations
+        activations = 2 * sum(sizes) * 4
+    else:
+        activations = max([a + b for a, b in zip(sizes[:-1], sizes[1:])]) * 4
+
+    return inputs + activations
+
+
+def parse_batch_size(value: str) -> Union[int, str]:
+    """Parses a batch size argument, which is either an integer or 'auto'"""
+    return value if value == 'auto' else int(value)
+
+
+def auto_batch_size(sample_memory: int, *, available: int = None,
+                    fraction: float = .8, maximum: int = None) -> int:
+    """Returns the largest batch size whose estimated memory fits within
+    the given fraction of the available memory"""
+    if available is None:
+        available = available_memory()
+
+    batch_size = max(1, int((available * fraction) // sample_memory))
+
+    if maximum is not None:
+        batch_size = min(batch_size, maximum)
+
+    logger.info((f'Estimated {sample_memory / 2**20:.1f}MB per sample with '
+                 f'{available / 2**20:.1f}MB available. Using batch size '
+                 f'{batch_size}'))
+
+    return batch_size
+
+
+def find_batch_size(trial: Callable[[int], Any], batch_size: int, *,
+                    exceptions: Tuple[type] = (MemoryError,)) -> int:
+    """Runs the trial function with the given batch size, halving the batch
+    size until the trial no longer fails with one of the given exceptions.
+    Returns the first batch size that succeeded"""
+    while True:
+        try:
+            trial(batch_size)
+            break
+        except exceptions as e:
+            if batch_size == 1:
+                raise e
+
+            logger.warning((f'Batch size {batch_size} failed with '
+                            f'{e.__class__.__name__}. Retrying with '
+                            f'{batch_size // 2}'))
+            batch_size = batch_size // 2
+
+    logger.info((f'Using batch size {batch_size}. Peak memory after trial: '
+                 f'{peak_memory() / 2**20:.1f}MB'))
+
+    return batch_size
@@ -1,6 +1,16 @@
 from .crop import crop_folder, crop_mri
 from .freesurfer import autorecon1, autorecon1_folder, convert_mgz_to_nii_gz, \
-                        convert_mgz_to_nii_gz_folder
+                        convert_mgz_to_nii_gz_folder, mgz_to_nifti
 
-from .fsl import flirt, flirt_folder, reorient2std, reorient2std_folder
-from .utils import extract_brainmasks_from_recon
\ No newline at end of file
+from .formats import ImageFormat, output_filename, save_image
+from .fsl import flirt, flirt_folder, reorient2std, reorient2std_folder, \
+                 reorient_to_standard
+from .manifest import atomic_output, hash_file, list_images, Manifest
+from .pipeline import Pipeline, Stage
+from .planner import FolderIndex, load_records, Plan, plan_pipeline
+from .registration import apply_rigid, estimate_rigid, register_rigid, \
+                          register_rigid_folder, rigid_matrix
+from .scheduler import Job, JobRecord, ResourceBudget, ResourceUsage, \
+                       Scheduler
+from .utils import extract_brainmask, extract_brainmasks_from_recon
+from .workqueue import FileWorkQueue, LeaseLost
\ No newline at end of file
@@ -2,25 +2,34 @@ import logging
 import os
 import nibabel as nib
 
-from typing import Tuple
+from typing import List, Tuple, Union
+
+from .formats import ImageFormat, output_filename, save_image
+from .manifest import list_images, Manifest
+from .scheduler import JobRecord, Scheduler
 
 
 logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
 logging.basicConfig(format=logformat, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def crop_mri(src: str, dest: str, bounds: Tuple[Tuple[int]]) -> None:
+def crop_mri(src: Union[str, nib.Nifti1Image], dest: str,
+             bounds: Tuple[Tuple[int]], *,
+             image_format: Union[str, ImageFormat] = None) -> None:
     """Crops an MRI by the given bounds and stores the result 
 
     Args:
-        src (str): Path to original MRI
+        src (Union[str, nib.Nifti1Image]): Path to original MRI, or the MRI
+            itself
         dest (str): Where to store the result
         bounds (Tuple[Tuple[int]]): Bounds to crop by. Contains three 
             pairs, where the first refers to the y-axis, the second x,
             and the third z. Start is inclusive, end is exclusive
+        image_format (Union[str, ImageFormat]): Optional format used to
+            write the result
 
     """
-    img = nib.load(src)
+    img = nib.load(src) if isinstance(src, str) else src
     data = img.get_fdata()
 
     if bounds[0][0] < 0:
@@ -44,20 +53,31 @@ def crop_mri(src: str, dest: str, bounds: Tuple[Tuple[int]]) -> None:
     ]
 
     img = nib.Nifti1Image(data, affine=img.affine, header=img.header)
-    nib.save(img, dest)
+    save_image(img, dest, image_format)
 
 
-def crop_folder(src: str, dest: str, bounds: Tuple[Tuple[int]]) -> None:
-    """Crops all MRIs in a folder by the given bounds"""
+def crop_folder(src: str, dest: str, bounds: Tuple[Tuple[int]], *,
+                workers: int = 1, image_format: str = None,
+                scheduler: Scheduler = None) -> List[JobRecord]:
+    """Crops all MRIs in a folder by the given bounds. MRIs that were
+    already cropped from the same input with the same bounds are skipped.
+    With more than one worker, MRIs are cropped in separate processes. If
+    an image format is given, outputs are written in it"""
     if not os.path.isdir(dest):
         os.makedirs(dest)
 
-    for filename in os.listdir(src):
-        path = os.path.join(dest, filename)
+    files = {filename.split('.')[0]: (
+                 os.path.join(src, filename),
+                 os.path.join(dest, output_filename(filename, image_format))
+             ) for filename in list_images(src)}
+
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=workers, processes=workers > 1)
+
+    params = {'bounds': bounds}
+
+    if image_format is not None:
+        params['image_format'] = str(ImageFormat.parse(image_format))
 
-        if os.path.isfile(path):
-            logger.info(f'Skipping {filename}: Already exists')
-            continue
-    
-        crop_mri(os.path.join(src, filename), os.path.join(dest, filename),
-                 bounds)
\ No newline at end of file
+    return Manifest(dest).run(crop_mri, files, scheduler=scheduler,
+                              params=params)
\ No newline at end of file
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import gzip
+import logging
+import nibabel as nib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ImageFormat(object):
+    """How a preprocessing stage writes its images. Intermediates that are
+    read back immediately by the next stage are cheaper to write
+    uncompressed or with a low compression level, while final outputs can
+    be compressed harder. Compressed images can be written by several
+    threads, in which case the file consists of several gzip members,
+    which is still a valid gzip file.
+
+    Formats are described by strings of the form suffix[:level[:threads]],
+    e.g. 'nii', 'nii.gz' or 'nii.gz:1:4'.
+
+    Args:
+        compressed (bool): Whether images are gzip compressed
+        level (int): The gzip compression level, from 1 to 9
+        threads (int): Number of threads compressing each image
+        chunk_size (int): Number of bytes compressed by each thread at a
+            time
+    """
+
+    def __init__(self, *, compressed: bool = True, level: int = 6,
+                 threads: int = 1, chunk_size: int = 2**22) -> ImageFormat:
+        if not 1 <= level <= 9:
+            raise ValueError(f'Invalid compression level {level}')
+
+        if threads < 1:
+            raise ValueError(f'Invalid number of threads {threads}')
+
+        self.compressed = compressed
+        self.level = level
+        self.threads = threads
+        self.chunk_size = chunk_size
+
+    @property
+    def suffix(self) -> str:
+        return '.nii.gz' if self.compressed else '.nii'
+
+    @classmethod
+    def parse(cls, image_format: Union[str, ImageFormat, None]
+              ) -> ImageFormat:
+        """Returns the format described by the given string. Formats are
+        returned as they are, and None gives the default format"""
+        if isinstance(image_format, ImageFormat):
+            return image_format
+        elif image_format is None:
+            return cls()
+
+        tokens = image_format.split(':')
+
+        if tokens[0] not in ['nii', 'nii.gz'] or len(tokens) > 3:
+            raise ValueError(f'Invalid image format {image_format}')
+
+        compressed = tokens[0] == 'nii.gz'
+
+        if not compressed and len(tokens) > 1:
+            raise ValueError(('Compression level and threads require a '
+                              f'compressed format, got {image_format}'))
+
+        return cls(compressed=compressed,
+                   level=int(tokens[1]) if len(tokens) > 1 else 6,
+                   threads=int(tokens[2]) if len(tokens) > 2 else 1)
+
+    def filename(self, name: str) -> str:
+        """Returns the filename of the image of the given subject"""
+        return f'{name}{self.suffix}'
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.threads == 1 or len(data) <= self.chunk_size:
+            return gzip.compress(data, compresslevel=self.level)
+
+        chunks = [data[i:i+self.chunk_size] \
+                  for i in range(0, len(data), self.chunk_size)]
+
+        # zlib releases the GIL while compressing
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            members = executor.map(
+                lambda chunk: gzip.compress(chunk, compresslevel=self.level),
+                chunks
+            )
+
+            return b''.join(members)
+
+    def save(self, img: nib.Nifti1Image, path: str) -> None:
+        """Stores the image at the given path. Whether it is compressed
+        follows from the suffix of the path, so that outputs named by other
+        tools are written as expected"""
+        if not path.endswith('.gz'):
+            nib.save(img, path)
+            return
+
+        with open(path, 'wb') as f:
+            f.write(self._compress(img.to_bytes()))
+
+    def __str__(self) -> str:
+        if not self.compressed:
+            return 'nii'
+
+        return f'nii.gz:{self.level}:{self.threads}'
+
+    def __repr__(self) -> str:
+        return f'ImageFormat({str(self)})'
+
+
+def save_image(img: nib.Nifti1Image, path: str,
+               image_format: Union[str, ImageFormat] = None) -> None:
+    """Stores an image in the given format, or with nibabel defaults if no
+    format is given"""
+    if image_format is None:
+        nib.save(img, path)
+    else:
+        ImageFormat.parse(image_format).save(img, path)
+
+
+def output_filename(filename: str,
+                    image_format: Union[str, ImageFormat] = None) -> str:
+    """Returns the filename of the output for the given input. Without a
+    format the filename of the input is kept"""
+    if image_format is None:
+        return filename
+
+    return ImageFormat.parse(image_format).filename(filename.split('.')[0])
@@ -1,10 +1,14 @@
 import logging
 import os
+import nibabel as nib
 import numpy as np
 
-from threading import Thread
-from typing import Any, Dict, List
+from typing import List, Union
 
+from .formats import ImageFormat, save_image
+from .manifest import list_images, Manifest
+from .planner import FolderIndex
+from .scheduler import Job, JobRecord, ResourceUsage, Scheduler
 from .utils import run
 
 
@@ -13,7 +17,10 @@ logging.basicConfig(format=logformat, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def autorecon1(path: str, *, subject: str, subjects_dir: str, 
-               noisrunning: bool = True, silence: bool = True) -> None:
+               noisrunning: bool = True, silence: bool = True,
+               threads: int = 1) -> ResourceUsage:
+    """Runs autorecon1 for a single subject, with OpenMP restricted to the
+    given number of threads. Returns the resources used by recon-all"""
     logger.debug(f'Running autorecon1 on {path}')
 
     if not os.path.isdir(subjects_dir):
@@ -24,20 +31,37 @@ def autorecon1(path: str, *, subject: str, subjects_dir: str,
     if noisrunning:
         cmd += ' -no-isrunning'
 
-    run(cmd, silence=silence)
+    if threads > 1:
+        cmd += f' -parallel -openmp {threads}'
 
+    # Without a limit, OpenMP starts a thread per core in every job
+    env = {**os.environ, 'OMP_NUM_THREADS': str(threads)}
 
-def _brainmask_exists(subjects_dir: str, filename: str) -> bool:
+    return run(cmd, silence=silence, env=env)
+
+
+def _brainmask_exists(subjects_dir: str, filename: str,
+                      index: FolderIndex = None) -> bool:
     subject = filename.split('.')[0]
-    return os.path.isfile(os.path.join(subjects_dir, subject, 'mri', 
-                                       'brainmask.mgz'))
+    path = os.path.join(subjects_dir, subject, 'mri', 'brainmask.mgz')
+
+    return index.exists(path) if index is not None else os.path.isfile(path)
 
 
 def autorecon1_folder(src: str, dest: str, *, threads: int = 1, 
-                      noisrunning: bool = True, 
-                      silence: bool = True) -> None:
-    filenames = os.listdir(src)
-    remaining = [f for f in filenames if not _brainmask_exists(dest, f)]
+                      noisrunning: bool = True, silence: bool = True,
+                      retries: int = 0, job_threads: int = 1,
+                      job_memory: int = 0,
+                      scheduler: Scheduler = None) -> List[JobRecord]:
+    """Runs autorecon1 for all images in a folder. At most threads jobs
+    run at once, each using job_threads OpenMP threads, and a job is only
+    started when its threads and job_memory bytes fit in what the host
+    has left"""
+    filenames = list_images(src)
+    # The subjects folder is listed once, instead of once per image
+    index = FolderIndex()
+    remaining = [f for f in filenames \
+                 if not _brainmask_exists(dest, f, index=index)]
 
     if not os.path.isdir(dest):
         os.mkdir(dest)
@@ -45,37 +69,23 @@ def autorecon1_folder(src: str, dest: str, *, threads: int = 1,
     logger.info((f'Skipping {len(filenames) - len(remaining)} ' 
                  'existing subjects'))
 
-    filenames = remaining
-
-    params = [{
-        'path': os.path.join(src, filename),
-        'subject': filename.split('.')[0],
-        'subjects_dir': dest,
-        'noisrunning': noisrunning,
-        'silence': silence
-    } for filename in filenames]
+    jobs = [Job(filename.split('.')[0], autorecon1,
+                path=os.path.join(src, filename),
+                subject=filename.split('.')[0],
+                subjects_dir=dest,
+                noisrunning=noisrunning,
+                silence=silence,
+                threads=job_threads) for filename in remaining]
 
-    class Worker(Thread):
-        def __init__(self, params: List[Dict[str, Any]]):
-            super().__init__()
-            self.params = params
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=threads, retries=retries,
+                              job_cpus=job_threads, job_memory=job_memory)
 
-        def run(self):
-            for params in self.params:
-                autorecon1(**params)
-
-    params = np.array_split(params, threads)
-    workers = [Worker(p) for p in params]
-
-    for w in workers:
-        w.start()
-
-    for w in workers:
-        w.join()
+    return scheduler.run(jobs, stage='autorecon1')
 
 
 def convert_mgz_to_nii_gz(src: str, dest: str, *, 
-                          silence: bool = True) -> None:
+                          silence: bool = True) -> ResourceUsage:
     assert src.endswith('mgz'), ('First argument to convert_mgz_to_nii_gz '
                                  'be an mgz-file')
 
@@ -83,21 +93,77 @@ def convert_mgz_to_nii_gz(src: str, dest: str, *,
 
     cmd = f'mri_convert {src} {dest} -ot nii'
 
-    run(cmd, silence=silence)
+    return run(cmd, silence=silence)
+
+
+def mgz_to_nifti(src: Union[str, nib.MGHImage], dest: str = None, *,
+                 image_format: Union[str, ImageFormat] = None
+                 ) -> nib.Nifti1Image:
+    """Converts an MGZ image to NIfTI in-process, equivalent to
+    mri_convert -ot nii. The voxels and affine are kept as they are.
+
+    Args:
+        src (Union[str, nib.MGHImage]): Path to the MGZ image, or the
+            image itself
+        dest (str): Optional path where the result is stored
+        image_format (Union[str, ImageFormat]): Optional format used to
+            write the result
+
+    Returns:
+        nib.Nifti1Image: The converted image, which can be passed on to
+            the next step without being written to disk
+    """
+    img = nib.load(src) if isinstance(src, str) else src
+    data = np.asanyarray(img.dataobj)
+
+    nifti = nib.Nifti1Image(data, affine=img.affine)
+    nifti.header.set_data_dtype(data.dtype)
+    nifti.header.set_zooms(img.header.get_zooms()[:3])
+    nifti.header.set_xyzt_units('mm', 'sec')
+    # mri_convert labels the transforms as scanner coordinates
+    nifti.set_qform(img.affine, code=1)
+    nifti.set_sform(img.affine, code=1)
+
+    if dest is not None:
+        save_image(nifti, dest, image_format)
+
+    return nifti
 
 
 def convert_mgz_to_nii_gz_folder(src: str, dest: str, *, 
-                                 silence: bool = True) -> None:
+                                 silence: bool = True,
+                                 backend: str = 'freesurfer',
+                                 workers: int = 1,
+                                 image_format: str = None,
+                                 scheduler: Scheduler = None
+                                 ) -> List[JobRecord]:
+    """Converts all MGZ images in a folder to NIfTI, either with
+    mri_convert (backend='freesurfer') or in-process (backend='nibabel').
+    With more than one worker, images are converted in separate
+    processes. If an image format is given, outputs are written in it.
+    mri_convert only follows the suffix of the format"""
+    if backend not in ['freesurfer', 'nibabel']:
+        raise ValueError(f'Invalid backend {backend}')
+
+    func, kwargs = (convert_mgz_to_nii_gz, {'silence': silence}) \
+                   if backend == 'freesurfer' else (mgz_to_nifti, {})
+    params = {}
+
+    if backend == 'nibabel' and image_format is not None:
+        params['image_format'] = str(ImageFormat.parse(image_format))
+
+    suffix = ImageFormat.parse(image_format).suffix
+
     if not os.path.isdir(dest):
         os.makedirs(dest)
-    
-    for filename in os.listdir(src):
-        target = filename.split('.')[0] + '.nii.gz'
-        path = os.path.join(dest, target)
 
-        if os.path.isfile(path):
-            logger.info(f'Skipping {filename}: Already exists')
-            continue
+    files = {filename.split('.')[0]: (
+                 os.path.join(src, filename),
+                 os.path.join(dest, f'{filename.split(".")[0]}{suffix}')
+             ) for filename in list_images(src)}
+
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=workers, processes=workers > 1)
 
-        convert_mgz_to_nii_gz(os.path.join(src, filename), path,
-                              silence=silence)
\ No newline at end of file
+    return Manifest(dest).run(func, files, scheduler=scheduler,
+                              params=params, **kwargs)
\ No newline at end of file
@@ -1,6 +1,14 @@
 import logging
 import os
+import nibabel as nib
 
+from nibabel.orientations import axcodes2ornt, io_orientation, \
+                                 ornt_transform
+from typing import Dict, List, Tuple, Union
+
+from .formats import ImageFormat, output_filename, save_image
+from .manifest import list_images, Manifest
+from .scheduler import JobRecord, Scheduler
 from .utils import run
 
 
@@ -9,27 +17,84 @@ logging.basicConfig(format=logformat, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def _fsl_env(dest: str) -> Dict[str, str]:
+    # FSL picks the output format from FSLOUTPUTTYPE rather than from the
+    # suffix of the output
+    return {**os.environ,
+            'FSLOUTPUTTYPE': 'NIFTI_GZ' if dest.endswith('.gz') else 'NIFTI'}
+
+
 def reorient2std(src: str, dest: str, *, silence: bool = True):
     logger.debug(f'Running reorient on {src}')
 
     cmd = f'fslreorient2std {src} {dest}'
 
-    run(cmd, silence=silence)
+    return run(cmd, silence=silence, env=_fsl_env(dest))
+
+
+def reorient_to_standard(src: Union[str, nib.Nifti1Image], dest: str = None,
+                         *, orientation: Tuple[str] = ('L', 'A', 'S'),
+                         image_format: Union[str, ImageFormat] = None
+                         ) -> nib.Nifti1Image:
+    """Reorients an image in-process, equivalent to fslreorient2std. Only
+    axis permutations and flips are applied, so voxels are not resampled.
+
+    Args:
+        src (Union[str, nib.Nifti1Image]): Path to the image, or the image
+            itself
+        dest (str): Optional path where the result is stored
+        orientation (Tuple[str]): Target axis codes. Defaults to the
+            orientation of the MNI152 templates
+        image_format (Union[str, ImageFormat]): Optional format used to
+            write the result
+
+    Returns:
+        nib.Nifti1Image: The reoriented image
+    """
+    img = nib.load(src) if isinstance(src, str) else src
+
+    transform = ornt_transform(io_orientation(img.affine),
+                               axcodes2ornt(orientation))
+    img = img.as_reoriented(transform)
 
+    if dest is not None:
+        save_image(img, dest, image_format)
+
+    return img
+
+
+def reorient2std_folder(src: str, dest: str, *, silence: bool = True,
+                        backend: str = 'fsl', workers: int = 1,
+                        image_format: str = None,
+                        scheduler: Scheduler = None) -> List[JobRecord]:
+    """Reorients all images in a folder, either with fslreorient2std
+    (backend='fsl') or in-process (backend='nibabel'). With more than one
+    worker, images are reoriented in separate processes. If an image
+    format is given, outputs are written in it. FSL only follows the
+    suffix of the format"""
+    if backend not in ['fsl', 'nibabel']:
+        raise ValueError(f'Invalid backend {backend}')
+
+    func, kwargs = (reorient2std, {'silence': silence}) \
+                   if backend == 'fsl' else (reorient_to_standard, {})
+    params = {}
+
+    if backend == 'nibabel' and image_format is not None:
+        params['image_format'] = str(ImageFormat.parse(image_format))
 
-def reorient2std_folder(src: str, dest: str, *, silence: bool = True):
     if not os.path.isdir(dest):
         os.makedirs(dest)
 
-    for filename in os.listdir(src):
-        path = os.path.join(dest, filename)
+    files = {filename.split('.')[0]: (
+                 os.path.join(src, filename),
+                 os.path.join(dest, output_filename(filename, image_format))
+             ) for filename in list_images(src)}
+
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=workers, processes=workers > 1)
 
-        if os.path.isfile(path):
-            logger.info(f'Skipping {filename}: Already exists')
-            continue
-    
-        reorient2std(os.path.join(src, filename), path,
-                     silence=silence)
+    return Manifest(dest).run(func, files, scheduler=scheduler,
+                              params=params, **kwargs)
 
 
 def flirt(src: str, dest: str, *, template: str, 
@@ -39,20 +104,31 @@ def flirt(src: str, dest: str, *, template: str,
     cmd = (f'flirt -in {src} -out {dest} -ref {template} '
            f'-dof {degrees_of_freedom}')
 
-    run(cmd, silence=silence)
+    return run(cmd, silence=silence, env=_fsl_env(dest))
 
 
 def flirt_folder(src: str, dest: str, *, template: str, 
-                 degrees_of_freedom: int = 6, silence: bool = True):
+                 degrees_of_freedom: int = 6, silence: bool = True,
+                 workers: int = 1, image_format: str = None,
+                 scheduler: Scheduler = None) -> List[JobRecord]:
+    """Registers all images in a folder to the given template. With more
+    than one worker, several registrations run at once. If an image format
+    is given, outputs are written with its suffix"""
     if not os.path.isdir(dest):
         os.makedirs(dest)
-    
-    for filename in os.listdir(src):
-        path = os.path.join(dest, filename)
-
-        if os.path.isfile(path):
-            logger.info(f'Skipping {filename}: Already exists')
-            continue
-    
-        flirt(os.path.join(src, filename), path, template=template, 
-              silence=silence, degrees_of_freedom=degrees_of_freedom)
\ No newline at end of file
+
+    files = {filename.split('.')[0]: (
+                 os.path.join(src, filename),
+                 os.path.join(dest, output_filename(filename, image_format))
+             ) for filename in list_images(src)}
+
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=workers, processes=workers > 1)
+
+    # The contents of the template are recorded along with its path
+    return Manifest(dest).run(flirt, files, scheduler=scheduler,
+                              params={
+                                  'template': template,
+                                  'degrees_of_freedom': degrees_of_freedom
+                              },
+                              dependencies=[template], silence=silence)
\ No newline at end of file
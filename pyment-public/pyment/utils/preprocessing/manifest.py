@@ -0,0 +1,404 @@
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from .scheduler import Job, JobRecord, Scheduler
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def hash_file(path: str, *, chunk_size: int = 2**20) -> str:
+    """Returns the SHA-256 of the contents of a file"""
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def list_images(folder: str) -> List[str]:
+    """Lists the images of a stage folder, leaving out hidden files such as
+    the manifest and partially written outputs"""
+    return sorted([f for f in os.listdir(folder) if not f.startswith('.')])
+
+
+@contextmanager
+def atomic_output(path: str) -> Iterator[str]:
+    """Yields a temporary path next to the given path. The temporary file
+    is moved in place when the block finishes, and removed if the block
+    fails, so that the given path is never left half-written. The
+    temporary path is unique to the host and process, so that processes
+    writing the same path do not write into each other's files"""
+    folder, filename = os.path.split(path)
+    # The extension is kept so that tools infer the same output format
+    partial = os.path.join(folder, (f'.partial-{socket.gethostname()}-'
+                                    f'{os.getpid()}-{filename}'))
+
+    try:
+        yield partial
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def produce(func: Callable, src: str, dest: str, **kwargs) -> Any:
+    """Runs func(src, dest, **kwargs) with the output written atomically"""
+    with atomic_output(dest) as partial:
+        return func(src, partial, **kwargs)
+
+
+def _unchanged(stat: os.stat_result, previous: Dict[str, Any]) -> bool:
+    return stat is not None and previous.get('size') == stat.st_size and \
+           previous.get('mtime_ns') == stat.st_mtime_ns
+
+
+def _fingerprint(path: str, previous: Dict[str, Any] = None
+                 ) -> Dict[str, Any]:
+    # Files that have not been touched since they were last hashed are
+    # not read again
+    stat = os.stat(path)
+
+    if previous is not None and _unchanged(stat, previous):
+        return previous
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha256': hash_file(path)}
+
+
+class Manifest(object):
+    """Keeps track of the outputs of a preprocessing stage. For every
+    subject the hash of the input, the tool and its parameters, and the
+    hash of the output are recorded, so that a re-run only recomputes
+    subjects where any of them changed. The manifest is stored as a hidden
+    JSON lines file in the output folder of the stage, with a line
+    appended for every recorded subject. Lines superseded by later ones
+    are only removed by an explicit call to compact.
+
+    Processes that share the folder, e.g. the workers of a cluster, can
+    each append to their own shard of the manifest. The shards of all
+    processes are read together, with the latest record of a subject
+    taking precedence.
+
+    Args:
+        folder (str): Output folder of the stage
+        filename (str): Name of the manifest file within the folder
+        shard (str): If given, subjects are recorded in a manifest file of
+            their own, named after the shard
+        read_only (bool): If set, the manifest is only read, e.g. for
+            planning, and never written or compacted
+    """
+
+    def __init__(self, folder: str, *, filename: str = '.manifest.jsonl',
+                 shard: str = None, read_only: bool = False) -> Manifest:
+        self.folder = folder
+        self.filename = filename
+        self.read_only = read_only
+
+        if shard is not None:
+            stem, suffix = os.path.splitext(filename)
+            filename = f'{stem}-{shard}{suffix}'
+
+        self.path = os.path.join(folder, filename)
+        self.entries = {}
+        self._offsets = {}
+        self._lock = Lock()
+
+        self.reload()
+
+    def _shards(self) -> List[str]:
+        stem, suffix = os.path.splitext(self.filename)
+
+        try:
+            filenames = os.listdir(self.folder)
+        except FileNotFoundError:
+            return []
+
+        return [os.path.join(self.folder, filename) \
+                for filename in sorted(filenames) \
+                if filename == self.filename or \
+                   (filename.startswith(f'{stem}-') and \
+                    filename.endswith(suffix))]
+
+    def _parse(self, lines: List[bytes]) -> Dict[str, Dict[str, Any]]:
+        entries = {}
+
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a killed process
+                continue
+
+            entries[entry.pop('subject')] = entry
+
+        return entries
+
+    def _merge(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        for subject, entry in entries.items():
+            previous = self.entries.get(subject)
+
+            if previous is None or \
+               entry.get('recorded', 0) >= previous.get('recorded', 0):
+                self.entries[subject] = entry
+
+    def reload(self) -> None:
+        """Reads the lines appended to every shard of the manifest since
+        it was last read. Only the new part of each file is read, unless
+        it was compacted in the meantime"""
+        with self._lock:
+            for path in self._shards():
+                try:
+                    with open(path, 'rb') as f:
+                        stat = os.fstat(f.fileno())
+                        inode, offset = self._offsets.get(path, (None, 0))
+
+                        if inode != stat.st_ino or stat.st_size < offset:
+                            offset = 0
+
+                        f.seek(offset)
+                        data = f.read()
+                except FileNotFoundError:
+                    continue
+
+                # A last line without a newline may still be being written,
+                # and is read again the next time
+                end = data.rfind(b'\n') + 1
+                self._offsets[path] = (stat.st_ino, offset + end)
+                self._merge(self._parse(data[:end].splitlines()))
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False) -> Iterator[None]:
+        # Appending takes a shared lock and compacting an exclusive one,
+        # so that lines appended by other processes are never dropped.
+        # The lock is held on a separate file, as compacting replaces the
+        # manifest itself
+        with self._lock, open(f'{self.path}.lock', 'a+') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def compact(self) -> None:
+        """Rewrites the manifest with only the latest line of every
+        subject. Only the shard of this manifest is rewritten. The file is
+        read again while holding the lock, so that subjects recorded by
+        other processes are kept. A read-only manifest is left as it is"""
+        if self.read_only or not os.path.isfile(self.path):
+            return
+
+        with self._locked(exclusive=True):
+            with open(self.path, 'rb') as f:
+                lines = f.readlines()
+
+            entries = self._parse(lines)
+            self._merge(entries)
+
+            if len(lines) > len(entries):
+                with atomic_output(self.path) as partial:
+                    with open(partial, 'w') as f:
+                        for subject, entry in entries.items():
+                            f.write(json.dumps({'subject': subject,
+                                                **entry}) + '\n')
+
+                logger.info(f'Compacted {self.path} from {len(lines)} to '
+                            f'{len(entries)} lines')
+
+    def _describe(self, func: Callable, *, src: str, dest: str,
+                  params: Dict[str, Any], dependencies: List[str],
+                  previous: Dict[str, Any] = None) -> Dict[str, Any]:
+        previous = previous if previous is not None else {}
+        previous_dependencies = previous.get('dependencies', {})
+
+        return {
+            'tool': func.__name__,
+            # Round-tripping normalizes e.g. tuples to lists
+            'params': json.loads(json.dumps(params)),
+            # An input that is no longer there is taken to be the one
+            # that was recorded
+            'input': _fingerprint(src, previous.get('input')) \
+                     if os.path.isfile(src) or 'input' not in previous \
+                     else previous['input'],
+            'dependencies': {
+                path: _fingerprint(path, previous_dependencies.get(path)) \
+                for path in dependencies
+            },
+            'output': os.path.basename(dest)
+        }
+
+    def is_current(self, subject: str, func: Callable, *, src: str,
+                   dest: str, params: Dict[str, Any] = None,
+                   dependencies: List[str] = None,
+                   stat: Callable[[str], os.stat_result] = None) -> bool:
+        """Returns whether the recorded output of the subject was produced
+        from the current input, tool and parameters, and is still intact.
+        An input that was removed after the output was produced, e.g. a
+        freed intermediate, does not make the output stale.
+
+        If a stat function is given, e.g. FolderIndex.stat, which returns
+        None for missing files, no file is read. Files then only count as
+        unchanged if their size and modification time are the recorded
+        ones, also when their contents are the same"""
+        entry = self.entries.get(subject)
+
+        if entry is None:
+            return False
+
+        if stat is not None:
+            return self._listed_current(entry, func, src=src, dest=dest,
+                                        params=params or {},
+                                        dependencies=dependencies or [],
+                                        stat=stat)
+
+        if not os.path.isfile(dest):
+            return False
+
+        current = self._describe(func, src=src, dest=dest,
+                                 params=params or {},
+                                 dependencies=dependencies or [],
+                                 previous=entry)
+
+        for key in ['tool', 'params', 'output']:
+            if current[key] != entry[key]:
+                return False
+
+        # Files that were touched but not changed still count as current
+        hashes = lambda files: {path: f['sha256'] \
+                                for path, f in files.items()}
+
+        if current['input']['sha256'] != entry['input']['sha256'] or \
+           hashes(current['dependencies']) != hashes(entry['dependencies']):
+            return False
+
+        return _fingerprint(dest, entry['result'])['sha256'] == \
+               entry['result']['sha256']
+
+    def _listed_current(self, entry: Dict[str, Any], func: Callable, *,
+                        src: str, dest: str, params: Dict[str, Any],
+                        dependencies: List[str],
+                        stat: Callable[[str], os.stat_result]) -> bool:
+        if func.__name__ != entry['tool'] or \
+           json.loads(json.dumps(params)) != entry['params'] or \
+           os.path.basename(dest) != entry['output'] or \
+           sorted(dependencies) != sorted(entry['dependencies']):
+            return False
+
+        if not all([_unchanged(stat(path), entry['dependencies'][path]) \
+                    for path in dependencies]):
+            return False
+
+        # As when hashing, a removed input does not make the output stale
+        source = stat(src)
+
+        return (source is None or _unchanged(source, entry['input'])) and \
+               _unchanged(stat(dest), entry['result'])
+
+    def record(self, subject: str, func: Callable, *, src: str, dest: str,
+               params: Dict[str, Any] = None,
+               dependencies: List[str] = None) -> None:
+        """Records that dest was produced from src by func with the given
+        params and dependencies"""
+        if self.read_only:
+            raise RuntimeError(f'Unable to record {subject} in read-only '
+                               f'manifest {self.path}')
+
+        entry = self._describe(func, src=src, dest=dest,
+                               params=params or {},
+                               dependencies=dependencies or [])
+        entry['result'] = _fingerprint(dest)
+        entry['recorded'] = time()
+
+        line = (json.dumps({'subject': subject, **entry}) + '\n').encode()
+
+        with self._locked():
+            self.entries[subject] = entry
+
+            with open(self.path, 'ab+') as f:
+                # A line cut short by a killed process is ended first, so
+                # that it does not swallow the new one
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+
+                    if f.read(1) != b'\n':
+                        line = b'\n' + line
+
+                f.write(line)
+
+    def apply(self, subject: str, func: Callable, *, src: str, dest: str,
+              params: Dict[str, Any] = None, dependencies: List[str] = None,
+              **kwargs) -> Any:
+        """Runs func(src, dest, **params, **kwargs) with the output written
+        atomically, and records the result in the manifest. Only params
+        and the contents of the dependencies are part of the record.
+        Returns what func returned"""
+        result = produce(func, src, dest, **(params or {}), **kwargs)
+        self.record(subject, func, src=src, dest=dest, params=params,
+                    dependencies=dependencies)
+
+        return result
+
+    def run(self, func: Callable, files: Dict[str, Tuple[str, str]], *,
+            scheduler: Scheduler, params: Dict[str, Any] = None,
+            dependencies: List[str] = None, **kwargs) -> List[JobRecord]:
+        """Runs func for every subject whose output is not current, and
+        records each output as soon as it is produced. The manifest is
+        compacted once all subjects have run.
+
+        Args:
+            func (Callable): Function called as
+                func(src, dest, **params, **kwargs)
+            files (Dict[str, Tuple[str, str]]): The input and output path
+                of each subject
+            scheduler (Scheduler): Scheduler used to run the jobs
+            params (Dict[str, Any]): Parameters of func that are part of
+                the record
+            dependencies (List[str]): Files whose contents are part of the
+                record, e.g. a template
+
+        Returns:
+            List[JobRecord]: The records of the subjects that were run
+        """
+        params = params or {}
+        jobs = []
+
+        for subject, (src, dest) in files.items():
+            if self.is_current(subject, func, src=src, dest=dest,
+                               params=params, dependencies=dependencies):
+                logger.info(f'Skipping {subject}: Already exists')
+                continue
+
+            jobs.append(Job(subject, produce, func=func, src=src, dest=dest,
+                            **params, **kwargs))
+
+        # Outputs are recorded by this process, so that jobs can run in
+        # other processes
+        def callback(record: JobRecord) -> None:
+            if record.succeeded:
+                src, dest = files[record.name]
+                self.record(record.name, func, src=src, dest=dest,
+                            params=params, dependencies=dependencies)
+
+        records = scheduler.run(jobs, callback=callback,
+                                stage=getattr(func, '__name__', None))
+        self.compact()
+
+        return records
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,632 @@
+from __future__ import annotations
+
+import logging
+import os
+import pandas as pd
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from threading import Condition, Lock, Thread
+from time import time
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+from .manifest import Manifest
+from .planner import Plan, plan_pipeline
+from .scheduler import _attempt, _write_record, Job, JobRecord, \
+                       ResourceBudget
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _disk_usage(path: str) -> int:
+    if os.path.isfile(path):
+        return os.lstat(path).st_size
+
+    usage = 0
+
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                usage += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                # Removed while walking
+                pass
+
+    return usage
+
+
+class Stage(object):
+    """A preprocessing step applied to one subject at a time.
+
+    Args:
+        name (str): Name of the stage
+        func (Callable): Function processing a single subject, given its
+            id. If the stage has an input, func is instead called as
+            func(src, dest, **params, **options)
+        output (Callable[[str], str]): Optional function returning the
+            path of the output of a subject. Subjects whose output exists
+            are skipped
+        input (Callable[[str], str]): Optional function returning the path
+            of the input of a subject. Requires an output and a manifest.
+            The output is then written atomically and recorded in the
+            manifest, and a subject is only skipped if its output was
+            produced from the current input and parameters
+        params (Dict[str, Any]): Parameters of func that are part of the
+            record
+        options (Dict[str, Any]): Arguments of func that are not part of
+            the record, e.g. verbosity
+        tracked (List[str]): Files whose contents are part of the record,
+            e.g. a template
+        manifest (Manifest): Manifest recording the outputs of the stage
+        dependencies (List[str]): Stages that must be finished for a
+            subject before this stage can start. If not given, the stage
+            depends on the preceding stage in the pipeline
+        concurrency (int): Maximum number of subjects processed by the
+            stage at once
+        cpus (int): CPUs reserved from the budget of the pipeline while
+            the stage processes a subject
+        memory (int): Bytes of memory reserved from the budget of the
+            pipeline while the stage processes a subject
+        cleanup (Callable[[str], None]): Optional function removing the
+            intermediates of a subject. Defaults to removing the output
+        workspace (Callable[[str], str]): Optional function returning the
+            file or folder holding the intermediates of a subject, which is
+            measured against the scratch limit of the pipeline. Defaults to
+            the output
+    """
+
+    def __init__(self, name: str, func: Callable[[str], None], *,
+                 output: Callable[[str], str] = None,
+                 input: Callable[[str], str] = None,
+                 params: Dict[str, Any] = None,
+                 options: Dict[str, Any] = None,
+                 tracked: List[str] = None, manifest: Manifest = None,
+                 dependencies: List[str] = None,
+                 concurrency: int = 1, cpus: int = 0,
+                 memory: int = 0,
+                 cleanup: Callable[[str], None] = None,
+                 workspace: Callable[[str], str] = None) -> Stage:
+        if concurrency < 1:
+            raise ValueError('Stage concurrency must be at least 1')
+
+        if input is not None and (output is None or manifest is None):
+            raise ValueError('A stage with an input requires an output and '
+                             'a manifest')
+
+        self.name = name
+        self.func = func
+        self.output = output
+        self.input = input
+        self.params = params or {}
+        self.options = options or {}
+        self.tracked = tracked
+        self.manifest = manifest
+        self.dependencies = dependencies
+        self.concurrency = concurrency
+        self.cpus = cpus
+        self.memory = memory
+        self.cleanup = cleanup
+        self.workspace = workspace or output
+
+    def is_done(self, subject: str, *,
+                exists: Callable[[str], bool] = os.path.exists,
+                stat: Callable[[str], os.stat_result] = None) -> bool:
+        if self.output is None or not exists(self.output(subject)):
+            return False
+
+        if self.input is None:
+            return True
+
+        return self.manifest.is_current(subject, self.func,
+                                        src=self.input(subject),
+                                        dest=self.output(subject),
+                                        params=self.params,
+                                        dependencies=self.tracked,
+                                        stat=stat)
+
+    def run(self, subject: str) -> Any:
+        if self.input is None:
+            return self.func(subject)
+
+        return self.manifest.apply(subject, self.func,
+                                   src=self.input(subject),
+                                   dest=self.output(subject),
+                                   params=self.params,
+                                   dependencies=self.tracked, **self.options)
+
+    def size(self, subject: str) -> int:
+        """Returns the bytes held by the intermediates of a subject"""
+        if self.workspace is None or \
+           not os.path.exists(self.workspace(subject)):
+            return 0
+
+        return _disk_usage(self.workspace(subject))
+
+    def clean(self, subject: str) -> None:
+        if self.cleanup is not None:
+            self.cleanup(subject)
+        elif self.output is not None and os.path.exists(self.output(subject)):
+            os.remove(self.output(subject))
+
+    def __repr__(self) -> str:
+        return f'Stage({self.name})'
+
+
+class Pipeline(object):
+    """Moves each subject through a DAG of stages as soon as the inputs of
+    the subject are ready, instead of running every stage over the whole
+    cohort before starting the next. Each stage has its own concurrency
+    limit. Subjects that have passed all stages are handed to a consumer
+    (e.g. a predictor) in batches as they become ready.
+
+    Args:
+        stages (List[Stage]): The stages. Stages without explicit
+            dependencies depend on the stage before them
+        retries (int): Number of times a failed stage is retried for a
+            subject
+        records (str): Optional folder where a CSV with the records of
+            each stage is written
+        budget (ResourceBudget): Budget that the resources reserved by
+            stages are admitted against. If not given, and any stage
+            reserves resources, the resources of the host are used
+        free_intermediates (bool): If true, the output of a stage is
+            removed for a subject as soon as every stage depending on it
+            has finished for the subject. Outputs of the final stages are
+            kept
+        scratch_limit (int): If given, no new subjects are started while
+            the intermediates of the subjects in progress hold more than
+            this many bytes. Intermediates are measured once, when their
+            stage finishes, and stop counting when they are freed or their
+            subject leaves the pipeline. Outputs of the final stages are
+            not counted, and subjects that are already started are not
+            held back
+    """
+
+    def __init__(self, stages: List[Stage], *, retries: int = 0,
+                 records: str = None, budget: ResourceBudget = None,
+                 free_intermediates: bool = False,
+                 scratch_limit: int = None) -> Pipeline:
+        names = [stage.name for stage in stages]
+
+        if len(set(names)) != len(names):
+            raise ValueError('Pipeline requires stages with unique names')
+
+        self.stages = {stage.name: stage for stage in stages}
+        self.dependencies = {}
+
+        for i, stage in enumerate(stages):
+            dependencies = stage.dependencies
+
+            if dependencies is None:
+                dependencies = [names[i - 1]] if i > 0 else []
+
+            for dependency in dependencies:
+                if dependency not in self.stages or \
+                   names.index(dependency) >= i:
+                    raise ValueError((f'Stage {stage.name} depends on '
+                                      f'{dependency}, which is not an earlier '
+                                      'stage'))
+
+            self.dependencies[stage.name] = dependencies
+
+        self.dependents = {
+            name: [other for other, dependencies in self.dependencies.items() \
+                   if name in dependencies] \
+            for name in names
+        }
+
+        self.retries = retries
+        self.free_intermediates = free_intermediates
+        self.scratch_limit = scratch_limit
+        self.records = records
+
+        if budget is None and any([stage.cpus > 0 or stage.memory > 0 \
+                                   for stage in stages]):
+            budget = ResourceBudget()
+
+        self.budget = budget
+
+        if records is not None and not os.path.isdir(records):
+            os.makedirs(records)
+
+        self._lock = Lock()
+        self._records = {}
+
+    def _satisfied(self, subject: str, stage: str, *,
+                   exists: Callable[[str], bool] = os.path.exists,
+                   stat: Callable[[str], os.stat_result] = None) -> bool:
+        # A stage whose intermediates were freed is still done if every
+        # stage depending on it is
+        dependents = self.dependents[stage]
+
+        return self.stages[stage].is_done(subject, exists=exists,
+                                          stat=stat) or \
+               (len(dependents) > 0 and \
+                all([self._satisfied(subject, d, exists=exists, stat=stat) \
+                     for d in dependents]))
+
+    def _execute(self, subject: str, stage: Stage) -> JobRecord:
+        record = self._run_stage(subject, stage)
+        record.emit(stage.name)
+
+        return record
+
+    def _run_stage(self, subject: str, stage: Stage) -> JobRecord:
+        record = JobRecord(subject)
+        job = Job(subject, stage.run, subject=subject)
+
+        try:
+            if self._satisfied(subject, stage.name):
+                record.status = 'skipped'
+                record.exit_status = 0
+
+                return record
+        except Exception as e:
+            record.status = 'failed'
+            record.error = f'{e.__class__.__name__}: {e}'
+
+            return record
+
+        while True:
+            if self.budget is not None:
+                with self.budget.reserve(stage.cpus, stage.memory):
+                    success = _attempt(job, record)
+            else:
+                success = _attempt(job, record)
+
+            if success:
+                record.status = 'success'
+                break
+            elif record.attempts > self.retries:
+                record.status = 'failed'
+                break
+
+            logger.info((f'Retrying {stage.name} for {subject} '
+                         f'({record.attempts}/{self.retries + 1}): '
+                         f'{record.error}'))
+
+        if self.records is not None:
+            with self._lock:
+                _write_record(os.path.join(self.records, f'{stage.name}.csv'),
+                              record)
+
+        return record
+
+    def _submit(self, subject: str, stage: str) -> None:
+        with self._condition:
+            self._records[subject][stage] = JobRecord(subject)
+            self._outstanding += 1
+            self._inflight[subject] += 1
+
+        future = self._executors[stage].submit(self._execute, subject,
+                                               self.stages[stage])
+        future.add_done_callback(lambda f: self._done(subject, stage, f))
+
+    def _done(self, subject: str, stage: str, future: Future) -> None:
+        # Callback of a stage. The outstanding count is always decremented,
+        # as run waits for it to reach zero
+        try:
+            try:
+                record = future.result()
+            except Exception as e:
+                record = JobRecord(subject)
+                record.status = 'failed'
+                record.error = f'{e.__class__.__name__}: {e}'
+
+            size = 0
+
+            if self.scratch_limit is not None and \
+               record.status in ['success', 'skipped'] and \
+               len(self.dependents[stage]) > 0:
+                size = self.stages[stage].size(subject)
+
+            self._completed(subject, stage, record, size)
+        except Exception as e:
+            logger.error(f'Unable to complete {stage} for {subject}: {e}')
+
+            with self._condition:
+                record = self._records[subject][stage]
+                record.status = 'failed'
+                record.error = record.error or f'{e.__class__.__name__}: {e}'
+        finally:
+            with self._condition:
+                self._outstanding -= 1
+                self._condition.notify_all()
+
+    def _finished(self, records: Dict[str, JobRecord], stage: str) -> bool:
+        return stage in records and records[stage].status in \
+               ['success', 'skipped']
+
+    def _clean(self, subject: str, stages: List[str]) -> None:
+        for stage in stages:
+            try:
+                self.stages[stage].clean(subject)
+            except Exception as e:
+                logger.warning((f'Unable to free {stage} for {subject}: '
+                                f'{e}'))
+
+    def _advance(self, subject: str, stage: str,
+                 records: Dict[str, JobRecord], freed: List[str]) -> None:
+        # Submits the stages of a subject whose dependencies have finished.
+        # Called with the condition held
+        record = records[stage]
+
+        if record.status == 'failed':
+            logger.warning((f'Stage {stage} failed for {subject}: '
+                            f'{record.error}. Skipping remaining stages'))
+
+            return
+        elif subject in self._cancelled:
+            logger.warning((f'Finished {stage} for {subject}, which was '
+                            'cancelled. Skipping remaining stages'))
+
+            return
+
+        if self.free_intermediates:
+            freed += [
+                d for d in self.dependencies[stage] \
+                if all([self._finished(records, other) \
+                        for other in self.dependents[d]])
+            ]
+
+        logger.debug(f'Finished {stage} for {subject}')
+
+        for name, dependencies in self.dependencies.items():
+            if name in records or stage not in dependencies:
+                continue
+
+            if all([self._finished(records, d) for d in dependencies]):
+                self._submit(subject, name)
+
+        # A stage submitted above may already have finished and passed the
+        # subject on through a nested call
+        if subject not in self._passed and \
+           all([self._finished(records, name) for name in self.stages]):
+            self._passed.add(subject)
+            self._ready.put(subject)
+
+    def _completed(self, subject: str, stage: str, record: JobRecord,
+                   size: int = 0) -> None:
+        freed = []
+        left = False
+
+        try:
+            with self._condition:
+                records = self._records[subject]
+                records[stage] = record
+
+                if size > 0:
+                    self._usage[subject][stage] = size
+
+                try:
+                    self._advance(subject, stage, records, freed)
+                finally:
+                    self._inflight[subject] -= 1
+
+                    if self._inflight[subject] == 0:
+                        left = True
+
+                        # Nothing more will run for a failed subject. The
+                        # intermediates of a cancelled subject may already
+                        # be used by whoever took it over
+                        if self.free_intermediates and \
+                           subject not in self._passed and \
+                           subject not in self._cancelled:
+                            freed += [name for name in records \
+                                      if len(self.dependents[name]) > 0]
+
+                        # Intermediates that are kept no longer count once
+                        # their subject is out of the pipeline
+                        self._usage[subject].clear()
+
+                    for name in freed:
+                        self._usage[subject].pop(name, None)
+        finally:
+            if len(freed) > 0:
+                logger.debug(f'Freeing {freed} for {subject}')
+                self._clean(subject, freed)
+
+            if left:
+                if self._on_done is not None:
+                    try:
+                        self._on_done(subject, records)
+                    except Exception as e:
+                        logger.error(f'Callback failed for {subject}: {e}')
+
+                # The subject only makes room for another once it is
+                # reported
+                with self._condition:
+                    self._active -= 1
+
+    def _scratch_usage(self) -> int:
+        # Called with the condition held
+        return sum([sum(sizes.values()) for sizes in self._usage.values()])
+
+    def _admit(self, max_subjects: int = None) -> None:
+        """Blocks while the given number of subjects are in progress, or
+        while their intermediates are over the scratch limit, unless no
+        subjects are in progress"""
+        paused = False
+
+        # Both only change when a stage finishes, which notifies the
+        # condition
+        with self._condition:
+            while self._active > 0 and max_subjects is not None and \
+                  self._active >= max_subjects:
+                self._condition.wait()
+
+            while self.scratch_limit is not None and self._active > 0 and \
+                  self._scratch_usage() >= self.scratch_limit:
+                if not paused:
+                    logger.info((f'Intermediates hold '
+                                 f'{self._scratch_usage() / 2**20:.0f}MB. '
+                                 'Pausing new subjects'))
+                    paused = True
+
+                self._condition.wait()
+
+        if paused:
+            logger.info('Resuming new subjects')
+
+    def _consume(self, on_ready: Callable[[List[str]], None],
+                 batch_size: int) -> None:
+        batch = []
+
+        while True:
+            subject = self._ready.get()
+
+            if subject is not None:
+                batch.append(subject)
+
+            if len(batch) > 0 and \
+               (len(batch) >= batch_size or subject is None):
+                logger.info(f'Passing {len(batch)} ready subjects on')
+
+                try:
+                    on_ready(batch)
+                except Exception as e:
+                    logger.error(f'Consumer failed for {batch}: {e}')
+
+                batch = []
+
+            if subject is None:
+                break
+
+    def cancel(self, subject: str) -> None:
+        """Stops a subject in progress from moving on to further stages.
+        Stages that are already running for it are left to finish"""
+        with self._condition:
+            self._cancelled.add(subject)
+
+    def run(self, subjects: Iterable[str], *,
+            on_ready: Callable[[List[str]], None] = None,
+            batch_size: int = 1, max_subjects: int = None,
+            on_done: Callable[[str, Dict[str, JobRecord]], None] = None
+            ) -> Dict[str, Dict[str, JobRecord]]:
+        """Runs all stages for all subjects.
+
+        Args:
+            subjects (Iterable[str]): Ids of the subjects to process. The
+                next subject is only taken when it can be started, so this
+                can be a generator that e.g. claims subjects from a queue
+            on_ready (Callable[[List[str]], None]): Optional consumer which
+                is called from a separate thread with batches of subjects
+                that have passed all stages
+            batch_size (int): Number of ready subjects passed to the
+                consumer at once. The last batch may be smaller
+            max_subjects (int): If given, no new subjects are started while
+                this many are in progress
+            on_done (Callable[[str, Dict[str, JobRecord]], None]): Optional
+                callback which is called with each subject and its records
+                as soon as nothing more runs for it, whether it passed all
+                stages or not
+
+        Returns:
+            Dict[str, Dict[str, JobRecord]]: The record of each stage for
+                each subject
+        """
+        start = time()
+
+        self._records = {}
+        self._outstanding = 0
+        self._passed = set()
+        self._cancelled = set()
+        self._inflight = {}
+        self._usage = {}
+        self._active = 0
+        self._on_done = on_done
+        self._condition = Condition()
+        self._ready = Queue()
+        self._executors = {
+            name: ThreadPoolExecutor(max_workers=stage.concurrency) \
+            for name, stage in self.stages.items()
+        }
+
+        consumer = None
+
+        if on_ready is not None:
+            consumer = Thread(target=self._consume,
+                              args=(on_ready, batch_size))
+            consumer.start()
+
+        roots = [name for name, dependencies in self.dependencies.items() \
+                 if len(dependencies) == 0]
+
+        subjects = iter(subjects)
+
+        while True:
+            self._admit(max_subjects)
+
+            subject = next(subjects, None)
+
+            if subject is None:
+                break
+
+            with self._condition:
+                self._records[subject] = {}
+                self._inflight[subject] = 0
+                self._usage[subject] = {}
+                self._active += 1
+
+                for name in roots:
+                    self._submit(subject, name)
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._outstanding == 0)
+
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+
+        # Nothing is recorded anymore, so superseded manifest lines can be
+        # dropped
+        for stage in self.stages.values():
+            if stage.manifest is not None:
+                stage.manifest.compact()
+
+        self._ready.put(None)
+
+        if consumer is not None:
+            consumer.join()
+
+        complete = [subject for subject in self._records \
+                    if all([self._finished(self._records[subject], name) \
+                            for name in self.stages])]
+
+        logger.info((f'Processed {len(complete)}/{len(self._records)} '
+                     f'subjects through {len(self.stages)} stages in '
+                     f'{time() - start:.1f}s'))
+
+        for name, timing in self.timings().items():
+            if timing['subjects'] > 0:
+                logger.info((f'{name}: {timing["mean"]:.1f}s per subject, '
+                             f'{timing["total"]:.1f}s in total over '
+                             f'{timing["subjects"]} subjects'))
+
+        return self._records
+
+    def plan(self, subjects: List[str], *,
+             history: Union[pd.DataFrame, List[pd.DataFrame]] = None
+             ) -> Plan:
+        """Returns which stages are done for each subject and an estimate
+        of the time left, without running anything. See plan_pipeline"""
+        return plan_pipeline(self, subjects, history=history)
+
+    def timings(self) -> Dict[str, Dict[str, float]]:
+        """Returns the number of subjects that ran each stage in the last
+        run, and the total and mean wall time they spent in it. Stages that
+        were skipped or failed are not counted"""
+        timings = {}
+
+        for name in self.stages:
+            times = [records[name].wall_time \
+                     for records in self._records.values() \
+                     if name in records and records[name].succeeded]
+            timings[name] = {
+                'subjects': len(times),
+                'total': sum(times),
+                'mean': sum(times) / len(times) if len(times) > 0 else 0.
+            }
+
+        return timings
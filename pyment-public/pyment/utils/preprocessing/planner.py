@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import logging
+import os
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Set, Union
+
+from .scheduler import JobRecord
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class FolderIndex(object):
+    """Answers whether paths exist by listing each folder at most once,
+    instead of calling stat for every path. Meant for checking many
+    subjects against the same stage folders, where the listings would
+    otherwise be repeated for every subject. The index is a snapshot and
+    does not see files created after a folder was listed"""
+
+    def __init__(self) -> FolderIndex:
+        self._listings = {}
+
+    def _entries(self, folder: str) -> Dict[str, os.DirEntry]:
+        folder = os.path.normpath(folder)
+
+        if folder not in self._listings:
+            try:
+                with os.scandir(folder) as entries:
+                    self._listings[folder] = {entry.name: entry \
+                                              for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                self._listings[folder] = {}
+
+        return self._listings[folder]
+
+    def listdir(self, folder: str) -> Set[str]:
+        """Returns the names in a folder, or an empty set if the folder
+        does not exist"""
+        return self._entries(folder).keys()
+
+    def exists(self, path: str) -> bool:
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+
+        if name in ['', '.', '..'] or parent == path:
+            return os.path.exists(path)
+
+        # Missing parents are found in the listing of their own parent, so
+        # that e.g. the subject folders of recon are listed only for the
+        # subjects that exist
+        if parent != '' and not self.exists(parent):
+            return False
+
+        return name in self.listdir(parent if parent != '' else '.')
+
+    def stat(self, path: str) -> os.stat_result:
+        """Returns the stat of a path from the listing of its folder, or
+        None if it does not exist. The stat of every listed path is taken
+        at most once"""
+        if not self.exists(path):
+            return None
+
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+
+        if name in ['', '.', '..'] or parent == path:
+            return os.stat(path)
+
+        return self._entries(parent if parent != '' else '.')[name].stat()
+
+
+def load_records(folder: str) -> pd.DataFrame:
+    """Reads the records written by a Pipeline, one CSV per stage, into a
+    dataframe with a stage and subject column. Subfolders are included, so
+    that the records kept by each worker of a cluster run are read
+    together"""
+    records = []
+
+    for root, _, filenames in os.walk(folder):
+        for filename in sorted(filenames):
+            if not filename.endswith('.csv'):
+                continue
+
+            path = os.path.join(root, filename)
+
+            try:
+                df = pd.read_csv(path)
+            except pd.errors.EmptyDataError:
+                continue
+
+            df['stage'] = filename[:-len('.csv')]
+            records.append(df)
+
+    if len(records) == 0:
+        return pd.DataFrame(columns=['stage', 'subject'] + JobRecord.fields)
+
+    records = pd.concat(records, ignore_index=True)
+
+    return records.rename(columns={'name': 'subject'})
+
+
+class Plan(object):
+    """The state of a pipeline for a set of subjects, and an estimate of
+    the work left.
+
+    Attributes:
+        completion (pd.DataFrame): Whether each stage (column) is done for
+            each subject (row). A stage whose output was freed counts as
+            done if every stage depending on it is
+        estimates (pd.DataFrame): For each stage, the number of subjects
+            that are done and remaining, the mean wall and CPU time per
+            subject in the history, the compute time left (remaining
+            subjects times the mean wall time) and the wall time left given
+            the concurrency of the stage. Stages without history have no
+            estimate
+    """
+
+    def __init__(self, completion: pd.DataFrame,
+                 estimates: pd.DataFrame) -> Plan:
+        self.completion = completion
+        self.estimates = estimates
+
+    @property
+    def subjects(self) -> List[str]:
+        return list(self.completion.index)
+
+    @property
+    def complete(self) -> List[str]:
+        """Subjects for which every stage is done"""
+        return list(self.completion.index[self.completion.all(axis=1)])
+
+    @property
+    def remaining(self) -> Dict[str, List[str]]:
+        """The subjects each stage has left to process"""
+        return {stage: list(self.completion.index[~self.completion[stage]]) \
+                for stage in self.completion.columns}
+
+    @property
+    def compute_time(self) -> float:
+        """Seconds of stage time left, summed over all stages and subjects.
+        NaN if a stage with remaining subjects has no history"""
+        return float(np.sum(self.estimates['compute_time'].values))
+
+    @property
+    def wall_time(self) -> float:
+        """Seconds until every subject is done. As subjects stream through
+        the stages, the stages overlap and the run is bounded by the
+        slowest of them. Limits on CPUs, memory and scratch space are not
+        accounted for"""
+        return float(np.max(self.estimates['wall_time'].values)) \
+               if len(self.estimates) > 0 else 0.
+
+    def __str__(self) -> str:
+        lines = [(f'{len(self.complete)}/{len(self.subjects)} subjects '
+                  'complete')]
+
+        for _, row in self.estimates.iterrows():
+            line = (f'  {row["stage"]}: {row["done"]} done, '
+                    f'{row["remaining"]} remaining')
+
+            if row['remaining'] > 0:
+                if np.isnan(row['per_subject']):
+                    line += ', no history to estimate from'
+                else:
+                    line += (f', {row["per_subject"]:.0f}s per subject, '
+                             f'{_hours(row["compute_time"])} of compute, '
+                             f'{_hours(row["wall_time"])} with '
+                             f'{row["concurrency"]} at once')
+
+            lines.append(line)
+
+        lines.append((f'Estimated {_hours(self.compute_time)} of compute, '
+                      f'{_hours(self.wall_time)} of wall time'))
+
+        return '\n'.join(lines)
+
+    def __repr__(self) -> str:
+        return (f'Plan({len(self.complete)}/{len(self.subjects)} '
+                'complete)')
+
+
+def _hours(seconds: float) -> str:
+    return 'unknown' if np.isnan(seconds) else f'{seconds / 3600:.1f}h'
+
+
+def plan_pipeline(pipeline, subjects: List[str], *,
+                  history: Union[pd.DataFrame, List[pd.DataFrame]] = None
+                  ) -> Plan:
+    """Builds the plan of a pipeline for the given subjects without running
+    anything. Every stage folder is listed once through a FolderIndex, and
+    outputs are checked against the manifests by their listed size and
+    modification time, without reading them.
+
+    Args:
+        pipeline (Pipeline): The pipeline
+        subjects (List[str]): Ids of the subjects
+        history (pd.DataFrame): Optional earlier runs of the stages, with at
+            least a stage, status and wall_time column, as returned by
+            load_telemetry or load_records. Several dataframes are
+            concatenated
+
+    Returns:
+        Plan: The completion of each stage and the estimated work left
+    """
+    index = FolderIndex()
+    completion = pd.DataFrame(
+        {name: [pipeline._satisfied(subject, name, exists=index.exists,
+                                    stat=index.stat) \
+                for subject in subjects] \
+         for name in pipeline.stages},
+        index=pd.Index(subjects, name='subject'), dtype=bool
+    )
+
+    if isinstance(history, list):
+        history = pd.concat(history, ignore_index=True) \
+                  if len(history) > 0 else None
+
+    if history is not None and len(history) > 0:
+        history = history[history['status'] == 'success']
+
+    rows = []
+
+    for name, stage in pipeline.stages.items():
+        remaining = int(np.sum(~completion[name]))
+        row = {'stage': name, 'done': len(subjects) - remaining,
+               'remaining': remaining, 'concurrency': stage.concurrency,
+               'per_subject': np.nan, 'cpu_time': np.nan}
+
+        if history is not None:
+            runs = history[history['stage'] == name]
+
+            if len(runs) > 0:
+                row['per_subject'] = float(np.mean(runs['wall_time']))
+
+                if 'cpu_time' in runs and runs['cpu_time'].notna().any():
+                    row['cpu_time'] = float(np.nanmean(runs['cpu_time']))
+
+        # Nothing is left of stages without remaining subjects, also when
+        # there is nothing to estimate from
+        row['compute_time'] = remaining * row['per_subject'] \
+                              if remaining > 0 else 0.
+        row['wall_time'] = row['compute_time'] / stage.concurrency
+
+        rows.append(row)
+
+    estimates = pd.DataFrame(rows, columns=['stage', 'done', 'remaining',
+                                            'concurrency', 'per_subject',
+                                            'cpu_time', 'compute_time',
+                                            'wall_time'])
+
+    return Plan(completion, estimates)
@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import logging
+import os
+import nibabel as nib
+import numpy as np
+
+from typing import Callable, List, Tuple, Union
+
+from .formats import ImageFormat, output_filename, save_image
+from .manifest import list_images, Manifest
+from .scheduler import JobRecord, Scheduler
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COSTS = ['corratio', 'mutualinfo']
+SCALES = [8, 4, 2]
+
+
+def rigid_matrix(params: np.ndarray,
+                 center: np.ndarray = None) -> np.ndarray:
+    """Builds a 4x4 rigid-body matrix from three rotations (in degrees,
+    around x, y and z) and three translations (in mm). The rotations are
+    applied around the given center, or around the origin if no center is
+    given"""
+    center = np.zeros(3) if center is None else np.asarray(center)
+    rx, ry, rz = np.radians(params[:3])
+
+    Rx = np.asarray([[1, 0, 0],
+                     [0, np.cos(rx), -np.sin(rx)],
+                     [0, np.sin(rx), np.cos(rx)]])
+    Ry = np.asarray([[np.cos(ry), 0, np.sin(ry)],
+                     [0, 1, 0],
+                     [-np.sin(ry), 0, np.cos(ry)]])
+    Rz = np.asarray([[np.cos(rz), -np.sin(rz), 0],
+                     [np.sin(rz), np.cos(rz), 0],
+                     [0, 0, 1]])
+    R = Rz @ Ry @ Rx
+
+    matrix = np.eye(4)
+    matrix[:3,:3] = R
+    matrix[:3,3] = center - R @ center + np.asarray(params[3:])
+
+    return matrix
+
+
+def trilinear(data: np.ndarray, coordinates: np.ndarray
+              ) -> Tuple[np.ndarray, np.ndarray]:
+    """Samples a volume at the given voxel coordinates with trilinear
+    interpolation.
+
+    Args:
+        data (np.ndarray): The volume
+        coordinates (np.ndarray): Voxel coordinates with shape (3, N)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The sampled values, and a mask of
+            the coordinates that are inside the volume. Values outside are
+            0
+    """
+    shape = np.asarray(data.shape)[:,None]
+    inside = np.all((coordinates >= 0) & (coordinates <= shape - 1), axis=0)
+
+    lower = np.floor(coordinates).astype(np.int64)
+    lower = np.clip(lower, 0, shape - 2)
+    weights = np.clip(coordinates - lower, 0, 1).astype(data.dtype)
+    x, y, z = lower
+    wx, wy, wz = weights
+
+    # Interpolates along x, then y, then z
+    c00 = data[x,y,z] * (1 - wx) + data[x+1,y,z] * wx
+    c01 = data[x,y,z+1] * (1 - wx) + data[x+1,y,z+1] * wx
+    c10 = data[x,y+1,z] * (1 - wx) + data[x+1,y+1,z] * wx
+    c11 = data[x,y+1,z+1] * (1 - wx) + data[x+1,y+1,z+1] * wx
+    c0 = c00 * (1 - wy) + c10 * wy
+    c1 = c01 * (1 - wy) + c11 * wy
+    values = c0 * (1 - wz) + c1 * wz
+
+    return np.where(inside, values, 0), inside
+
+
+def _grid(shape: Tuple[int], affine: np.ndarray,
+          mask: np.ndarray = None) -> np.ndarray:
+    # World coordinates of the voxels of a volume, in homogeneous form
+    if mask is None:
+        mask = np.ones(shape, dtype=bool)
+
+    voxels = np.stack(np.nonzero(mask)).astype(np.float32)
+    voxels = np.concatenate([voxels, np.ones((1, voxels.shape[1]),
+                                             dtype=np.float32)])
+
+    return (affine @ voxels).astype(np.float32)
+
+
+def _downsample(data: np.ndarray, affine: np.ndarray,
+                factor: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Averages blocks of voxels, which smooths the volume before it is
+    # subsampled
+    if factor == 1:
+        return data, affine
+
+    shape = [(s // factor) * factor for s in data.shape]
+    data = data[:shape[0],:shape[1],:shape[2]]
+    data = data.reshape(shape[0] // factor, factor, shape[1] // factor,
+                        factor, shape[2] // factor, factor)
+    data = data.mean(axis=(1, 3, 5))
+
+    scaling = np.diag([factor, factor, factor, 1.]).astype(np.float64)
+    scaling[:3,3] = (factor - 1) / 2
+
+    return data, affine @ scaling
+
+
+def _bin(values: np.ndarray, bins: int, lower: float,
+         upper: float) -> np.ndarray:
+    indices = (values - lower) / max(upper - lower, 1e-8) * bins
+
+    return np.clip(indices.astype(np.int64), 0, bins - 1)
+
+
+def _correlation_ratio(fixed_bins: np.ndarray, moving: np.ndarray,
+                       bins: int) -> float:
+    # 1 - the correlation ratio, i.e. the fraction of the variance of the
+    # moving image that is not explained by the fixed intensity bins
+    counts = np.bincount(fixed_bins, minlength=bins)
+    sums = np.bincount(fixed_bins, weights=moving, minlength=bins)
+    squares = np.bincount(fixed_bins, weights=moving ** 2, minlength=bins)
+
+    total = np.sum(squares) - np.sum(sums) ** 2 / len(moving)
+
+    if total <= 0:
+        return 1.
+
+    nonempty = counts > 0
+    within = np.sum(squares[nonempty] - \
+                    sums[nonempty] ** 2 / counts[nonempty])
+
+    return float(within / total)
+
+
+def _mutual_information(fixed_bins: np.ndarray, moving: np.ndarray,
+                        bins: int, lower: float, upper: float) -> float:
+    # Negative mutual information of the joint intensity histogram. Moving
+    # values are split between the two nearest bins, which keeps the cost
+    # smooth for small changes of the transform
+    position = np.clip((moving - lower) / max(upper - lower, 1e-8) * \
+                       (bins - 1), 0, bins - 1)
+    lowest = np.minimum(position.astype(np.int64), bins - 2)
+    weight = position - lowest
+    joint = np.bincount(fixed_bins * bins + lowest, weights=1 - weight,
+                        minlength=bins * bins) + \
+            np.bincount(fixed_bins * bins + lowest + 1, weights=weight,
+                        minlength=bins * bins)
+    joint = joint.reshape(bins, bins) / np.sum(joint)
+    fixed = np.sum(joint, axis=1, keepdims=True)
+    moving = np.sum(joint, axis=0, keepdims=True)
+    nonzero = joint > 0
+
+    return -float(np.sum(joint[nonzero] * \
+                         np.log(joint[nonzero] / (fixed @ moving)[nonzero])))
+
+
+def _minimize(func: Callable[[np.ndarray], float], x: np.ndarray, *,
+              steps: np.ndarray, min_steps: np.ndarray,
+              max_evaluations: int = 500) -> np.ndarray:
+    # Coordinate-wise pattern search. Each parameter is moved by its step
+    # in both directions, and the steps are halved when no move improves
+    # the cost
+    best = func(x)
+    steps = np.asarray(steps, dtype=np.float64)
+    evaluations = 1
+
+    while np.any(steps >= min_steps) and evaluations < max_evaluations:
+        improved = False
+
+        for i in range(len(x)):
+            for direction in [1, -1]:
+                candidate = x.copy()
+                candidate[i] += direction * steps[i]
+                cost = func(candidate)
+                evaluations += 1
+
+                if cost < best:
+                    x, best, improved = candidate, cost, True
+                    break
+
+        if not improved:
+            steps = steps / 2
+
+    return x
+
+
+def estimate_rigid(moving: nib.Nifti1Image, template: nib.Nifti1Image, *,
+                   cost: str = 'corratio', scales: List[int] = None,
+                   bins: int = 64) -> np.ndarray:
+    """Estimates the rigid-body transform that aligns an image with a
+    template, from coarse to fine resolutions.
+
+    Args:
+        moving (nib.Nifti1Image): The image to register
+        template (nib.Nifti1Image): The template
+        cost (str): The cost function, either 'corratio' (correlation ratio,
+            as used by FLIRT) or 'mutualinfo'
+        scales (List[int]): Downsampling factors of the pyramid, from
+            coarsest to finest. Defaults to [8, 4, 2]
+        bins (int): Number of intensity bins used by the cost function
+
+    Returns:
+        np.ndarray: A 4x4 matrix mapping world coordinates of the template
+            to world coordinates of the image
+    """
+    if cost not in COSTS:
+        raise ValueError(f'Invalid cost {cost}. Choose from {COSTS}')
+
+    scales = SCALES if scales is None else scales
+    moving_data = np.asarray(moving.dataobj, dtype=np.float32)
+    template_data = np.asarray(template.dataobj, dtype=np.float32)
+
+    # Starts from aligned centers of mass
+    center = (template.affine @ np.append(
+        np.mean(np.nonzero(template_data > 0), axis=1), 1))[:3]
+    moving_center = (moving.affine @ np.append(
+        np.mean(np.nonzero(moving_data > 0), axis=1), 1))[:3]
+    params = np.concatenate([np.zeros(3), moving_center - center])
+
+    moving_range = (np.min(moving_data), np.max(moving_data))
+    template_range = (np.min(template_data), np.max(template_data))
+
+    for scale in scales:
+        fixed, fixed_affine = _downsample(template_data, template.affine,
+                                          scale)
+        data, affine = _downsample(moving_data, moving.affine, scale)
+        data = data.astype(np.float32)
+
+        points = _grid(fixed.shape, fixed_affine)
+        fixed_bins = _bin(fixed.ravel(), bins, *template_range)
+        inverse = np.linalg.inv(affine).astype(np.float32)
+
+        def evaluate(params: np.ndarray) -> float:
+            matrix = (inverse @ rigid_matrix(params, center)).astype(
+                np.float32
+            )
+            values, inside = trilinear(data, (matrix @ points)[:3])
+
+            # Transforms that move the brain out of the image are rejected
+            if np.mean(inside) < 0.5:
+                return np.inf
+
+            if cost == 'corratio':
+                return _correlation_ratio(fixed_bins[inside], values[inside],
+                                          bins)
+
+            return _mutual_information(fixed_bins[inside], values[inside],
+                                       bins, *moving_range)
+
+        voxel = np.mean(np.abs(np.diag(fixed_affine)[:3]))
+        params = _minimize(evaluate, params,
+                           steps=np.asarray([4] * 3 + [voxel] * 3) * \
+                                 scale / scales[0] * 2,
+                           min_steps=np.asarray([0.1] * 3 + [voxel / 10] * 3))
+
+        logger.debug(f'Rigid parameters at scale {scale}: {params}')
+
+    return rigid_matrix(params, center)
+
+
+def apply_rigid(img: nib.Nifti1Image, matrix: np.ndarray, *,
+                template: nib.Nifti1Image) -> nib.Nifti1Image:
+    """Resamples an image into the space of a template, given the matrix
+    from estimate_rigid"""
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    points = _grid(template.shape[:3], template.affine)
+    transform = (np.linalg.inv(img.affine) @ matrix).astype(np.float32)
+    values, _ = trilinear(data, (transform @ points)[:3])
+
+    img = nib.Nifti1Image(values.reshape(template.shape[:3]),
+                          affine=template.affine)
+    img.set_qform(template.affine, code=1)
+    img.set_sform(template.affine, code=1)
+
+    return img
+
+
+def register_rigid(src: Union[str, nib.Nifti1Image], dest: str = None, *,
+                   template: Union[str, nib.Nifti1Image],
+                   cost: str = 'corratio',
+                   scales: List[int] = None, bins: int = 64,
+                   image_format: Union[str, ImageFormat] = None
+                   ) -> nib.Nifti1Image:
+    """Registers an image to a template with a rigid-body (6 degrees of
+    freedom) transform in-process, as an alternative to flirt. The result
+    is resampled into the space of the template, and can be passed
+    directly to crop_mri.
+
+    Args:
+        src (Union[str, nib.Nifti1Image]): Path to the image, or the image
+            itself
+        dest (str): Optional path where the result is stored
+        template (Union[str, nib.Nifti1Image]): Path to the template, or
+            the template itself
+        cost (str): The cost function, either 'corratio' or 'mutualinfo'
+        scales (List[int]): Downsampling factors of the pyramid, from
+            coarsest to finest. Defaults to [8, 4, 2]
+        bins (int): Number of intensity bins used by the cost function
+        image_format (Union[str, ImageFormat]): Optional format used to
+            write the result
+
+    Returns:
+        nib.Nifti1Image: The registered image
+    """
+    img = nib.load(src) if isinstance(src, str) else src
+    template = nib.load(template) if isinstance(template, str) else template
+
+    matrix = estimate_rigid(img, template, cost=cost, scales=scales,
+                            bins=bins)
+    img = apply_rigid(img, matrix, template=template)
+
+    if dest is not None:
+        save_image(img, dest, image_format)
+
+    return img
+
+
+def register_rigid_folder(src: str, dest: str, *, template: str,
+                          cost: str = 'corratio',
+                          scales: List[int] = None, bins: int = 64,
+                          workers: int = 1, image_format: str = None,
+                          scheduler: Scheduler = None) -> List[JobRecord]:
+    """Registers all images in a folder to the given template in-process.
+    With more than one worker, images are registered in separate
+    processes. If an image format is given, outputs are written in it"""
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    files = {filename.split('.')[0]: (
+                 os.path.join(src, filename),
+                 os.path.join(dest, output_filename(filename, image_format))
+             ) for filename in list_images(src)}
+
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=workers, processes=workers > 1)
+
+    # The default scales are recorded, so that passing them explicitly does
+    # not make earlier outputs stale
+    params = {'template': template, 'cost': cost,
+              'scales': SCALES if scales is None else scales, 'bins': bins}
+
+    if image_format is not None:
+        params['image_format'] = str(ImageFormat.parse(image_format))
+
+    return Manifest(dest).run(register_rigid, files, scheduler=scheduler,
+                              params=params, dependencies=[template])
@@ -0,0 +1,375 @@
+from __future__ import annotations
+
+import csv
+import logging
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+from subprocess import CalledProcessError
+from threading import Condition, Lock, Thread
+from time import time
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from ..memory import available_memory
+from ..telemetry import emit, measure
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class Job(object):
+    """A single unit of work, typically one subject in one preprocessing
+    stage. The function and its arguments are kept separate so that jobs
+    can be retried"""
+
+    def __init__(self, name: str, func: Callable, /, **kwargs) -> Job:
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs
+
+    def __call__(self) -> Any:
+        return self.func(**self.kwargs)
+
+    def __repr__(self) -> str:
+        return f'Job({self.name})'
+
+
+class ResourceUsage(object):
+    """CPU time (in seconds), peak resident memory and bytes read and
+    written used by an external process. Jobs that return it have it added
+    to their record instead of what was measured in-process"""
+
+    def __init__(self, cpu_time: float, peak_rss: int, read_bytes: int = 0,
+                 written_bytes: int = 0) -> ResourceUsage:
+        self.cpu_time = cpu_time
+        self.peak_rss = peak_rss
+        self.read_bytes = read_bytes
+        self.written_bytes = written_bytes
+
+    @classmethod
+    def from_rusage(cls, rusage: Any) -> ResourceUsage:
+        # ru_maxrss is reported in kilobytes on Linux, and block operations
+        # in units of 512 bytes
+        return cls(rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * 1024,
+                   read_bytes=rusage.ru_inblock * 512,
+                   written_bytes=rusage.ru_oublock * 512)
+
+    def __repr__(self) -> str:
+        return f'ResourceUsage({self.cpu_time:.1f}s, {self.peak_rss}B)'
+
+
+class ResourceBudget(object):
+    """Admits work only while the CPUs and memory reserved by the work that
+    is already running leave room for it on the host. Work that does not
+    fit is held back until running work finishes, but is always admitted
+    when nothing else is running.
+
+    Args:
+        cpus (int): CPUs available to the work. Defaults to the CPUs the
+            process may run on
+        memory (int): Bytes of memory available to the work. Defaults to
+            the memory available when the budget is created
+    """
+
+    def __init__(self, *, cpus: int = None,
+                 memory: int = None) -> ResourceBudget:
+        if cpus is None:
+            cpus = len(os.sched_getaffinity(0)) \
+                   if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+        self.cpus = cpus
+        self.memory = memory if memory is not None else available_memory()
+
+        self._cpus = 0
+        self._memory = 0
+        self._running = 0
+        self._condition = Condition()
+
+    def _fits(self, cpus: int, memory: int) -> bool:
+        return self._running == 0 or \
+               (self._cpus + cpus <= self.cpus and \
+                self._memory + memory <= self.memory)
+
+    @contextmanager
+    def reserve(self, cpus: int = 0, memory: int = 0) -> Iterator[None]:
+        """Blocks until the given CPUs and memory fit in the budget, and
+        holds them for the duration of the block"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(cpus, memory))
+            self._cpus += cpus
+            self._memory += memory
+            self._running += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._cpus -= cpus
+                self._memory -= memory
+                self._running -= 1
+                self._condition.notify_all()
+
+
+class JobRecord(object):
+    """The outcome of a job. Unless the job reports the usage of its own
+    process, peak_rss is the high-water mark of the whole process the job
+    ran in, not of the job alone"""
+
+    fields = ['name', 'status', 'exit_status', 'attempts', 'started',
+              'wall_time', 'cpu_time', 'peak_rss', 'read_bytes',
+              'written_bytes', 'error']
+
+    def __init__(self, name: str) -> JobRecord:
+        self.name = name
+        self.status = 'pending'
+        self.exit_status = None
+        self.attempts = 0
+        self.started = None
+        self.wall_time = 0.
+        self.cpu_time = None
+        self.peak_rss = None
+        self.read_bytes = None
+        self.written_bytes = None
+        self.error = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == 'success'
+
+    def add_usage(self, usage: ResourceUsage) -> None:
+        self.cpu_time = (self.cpu_time or 0.) + usage.cpu_time
+        self.peak_rss = max(self.peak_rss or 0, usage.peak_rss)
+        self.read_bytes = (self.read_bytes or 0) + usage.read_bytes
+        self.written_bytes = (self.written_bytes or 0) + usage.written_bytes
+
+    def emit(self, stage: str) -> None:
+        """Writes the record as a telemetry event of the given stage"""
+        emit(stage=stage, subject=self.name,
+             **{field: getattr(self, field) for field in self.fields \
+                if field != 'name'})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __repr__(self) -> str:
+        return f'JobRecord({self.name}, {self.status})'
+
+
+def _write_record(path: str, record: JobRecord) -> None:
+    if path is None:
+        return
+
+    exists = os.path.isfile(path)
+
+    with open(path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=JobRecord.fields)
+
+        if not exists:
+            writer.writeheader()
+
+        writer.writerow(record.to_dict())
+
+
+def _measured(target: Callable, /, **kwargs) -> Tuple[Any, ResourceUsage]:
+    """Runs the target and measures it where it runs, which may be another
+    process"""
+    with measure() as measurement:
+        result = target(**kwargs)
+
+    if isinstance(result, ResourceUsage):
+        return result, result
+
+    return result, ResourceUsage(measurement.cpu_time, measurement.peak_rss,
+                                 read_bytes=measurement.read_bytes,
+                                 written_bytes=measurement.written_bytes)
+
+
+def _attempt(job: Job, record: JobRecord, *,
+             pool: ProcessPoolExecutor = None) -> bool:
+    """Runs a job once, either in the calling thread or in a process from
+    the given pool, and updates its record. Returns whether the job
+    succeeded"""
+    record.attempts += 1
+    start = time()
+
+    if record.started is None:
+        record.started = start
+
+    try:
+        # External processes report their own usage, which replaces what
+        # was measured around them
+        if pool is None:
+            _, usage = _measured(job.func, **job.kwargs)
+        else:
+            _, usage = pool.submit(_measured, job.func, **job.kwargs).result()
+
+        record.add_usage(usage)
+
+        record.exit_status = 0
+        success = True
+    except Exception as e:
+        record.exit_status = e.returncode \
+                             if isinstance(e, CalledProcessError) else -1
+        record.error = f'{e.__class__.__name__}: {e}'
+        success = False
+
+    record.wall_time += time() - start
+
+    return success
+
+
+class Scheduler(object):
+    """Runs jobs from a shared queue with a bounded number of concurrent
+    workers. A worker picks up the next job as soon as it is done with the
+    previous one, so slow jobs do not hold back the rest. Failed jobs are
+    put back in the queue until they have been attempted retries + 1
+    times, and the outcome of every job is recorded.
+
+    Args:
+        concurrency (int): Maximum number of jobs running at once
+        retries (int): Number of times a failed job is retried
+        records (str): Optional path to a CSV file where a row is appended
+            for every finished job
+        processes (bool): If true, jobs are run in a pool of processes
+            instead of threads, so that jobs doing their work in Python
+            are not serialized by the GIL. Job functions and arguments
+            must then be picklable
+        job_cpus (int): CPUs reserved for each running job
+        job_memory (int): Bytes of memory reserved for each running job
+        budget (ResourceBudget): Budget jobs are admitted against. If not
+            given, and jobs reserve resources, the resources of the host
+            are used
+    """
+
+    def __init__(self, concurrency: int = 1, *, retries: int = 0,
+                 records: str = None, processes: bool = False,
+                 job_cpus: int = 0, job_memory: int = 0,
+                 budget: ResourceBudget = None) -> Scheduler:
+        if concurrency < 1:
+            raise ValueError('Scheduler concurrency must be at least 1')
+
+        self.concurrency = concurrency
+        self.retries = retries
+        self.records = records
+        self.processes = processes
+        self.job_cpus = job_cpus
+        self.job_memory = job_memory
+
+        if budget is None and (job_cpus > 0 or job_memory > 0):
+            budget = ResourceBudget()
+
+        self.budget = budget
+
+        self._lock = Lock()
+
+    def _finish(self, record: JobRecord, status: str) -> None:
+        with self._lock:
+            record.status = status
+            self._finished += 1
+            _write_record(self.records, record)
+            record.emit(self._stage)
+
+            if self._callback is not None:
+                try:
+                    self._callback(record)
+                except Exception as e:
+                    logger.error(f'Callback failed for {record.name}: {e}')
+
+            if status == 'success':
+                usage = f' ({record.cpu_time:.1f}s CPU, ' \
+                        f'{record.peak_rss / 2**20:.0f}MB peak)' \
+                        if record.cpu_time is not None else ''
+                logger.info((f'[{self._finished}/{self._total}] Finished '
+                             f'{record.name} in {record.wall_time:.1f}s'
+                             f'{usage}'))
+            else:
+                logger.warning((f'[{self._finished}/{self._total}] Failed '
+                                f'{record.name} after {record.attempts} '
+                                f'attempts: {record.error}'))
+
+    def _work(self, queue: Queue, records: Dict[str, JobRecord]) -> None:
+        while True:
+            job = queue.get()
+
+            if job is None:
+                queue.task_done()
+                break
+
+            record = records[job.name]
+
+            if self.budget is not None:
+                with self.budget.reserve(self.job_cpus, self.job_memory):
+                    success = _attempt(job, record, pool=self._pool)
+            else:
+                success = _attempt(job, record, pool=self._pool)
+
+            if success:
+                self._finish(record, 'success')
+            elif record.attempts <= self.retries:
+                logger.info((f'Retrying {job.name} ({record.attempts}/'
+                             f'{self.retries + 1}): {record.error}'))
+                queue.put(job)
+            else:
+                self._finish(record, 'failed')
+
+            queue.task_done()
+
+    def run(self, jobs: List[Job], *,
+            callback: Callable[[JobRecord], None] = None,
+            stage: str = None) -> List[JobRecord]:
+        """Runs all jobs, and returns their records in the order the jobs
+        were given. If given, the callback is called in this process with
+        the record of every job as soon as it has finished. If telemetry is
+        configured, every finished job is written as an event of the given
+        stage"""
+        names = [job.name for job in jobs]
+
+        if len(set(names)) != len(names):
+            raise ValueError('Scheduler requires jobs with unique names')
+
+        records = {job.name: JobRecord(job.name) for job in jobs}
+        self._finished = 0
+        self._total = len(jobs)
+        self._callback = callback
+        self._stage = stage
+        self._pool = None
+
+        if self.processes and len(jobs) > 0:
+            # Forking a process that is running threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=min(self.concurrency, len(jobs)),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+        queue = Queue()
+
+        for job in jobs:
+            queue.put(job)
+
+        workers = [Thread(target=self._work, args=(queue, records)) \
+                   for _ in range(min(self.concurrency, max(1, len(jobs))))]
+
+        for worker in workers:
+            worker.start()
+
+        queue.join()
+
+        for _ in workers:
+            queue.put(None)
+
+        for worker in workers:
+            worker.join()
+
+        if self._pool is not None:
+            self._pool.shutdown()
+
+        failed = [name for name in names if not records[name].succeeded]
+
+        if len(failed) > 0:
+            logger.warning(f'{len(failed)}/{len(jobs)} jobs failed: {failed}')
+
+        return [records[name] for name in names]
@@ -3,23 +3,53 @@ import os
 import subprocess
 
 from shutil import copyfile
+from typing import Dict, List
+
+from .scheduler import Job, JobRecord, ResourceUsage, Scheduler
 
 
 logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
 logging.basicConfig(format=logformat, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def run(cmd: str, *, silence: bool = True):
+def run(cmd: str, *, silence: bool = True,
+        env: Dict[str, str] = None) -> ResourceUsage:
+    """Runs a command and returns the CPU time and peak memory it used.
+    Raises a CalledProcessError if the command fails"""
     stdout = subprocess.DEVNULL if silence else None
 
-    process = subprocess.Popen(cmd.split(' '), stdout=stdout)
-    process.communicate()
+    process = subprocess.Popen(cmd.split(' '), stdout=stdout, env=env)
+    # Unlike communicate, wait4 reports the resources used by the child
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    return ResourceUsage.from_rusage(rusage)
+
+def extract_brainmask(recon: str, subject: str, dest: str,
+                      symlink: bool = False) -> None:
+    """Copies (or links) the brainmask produced by autorecon1 for a single
+    subject to the given destination"""
+    brainmask = os.path.abspath(os.path.join(recon, subject, 'mri',
+                                             'brainmask.mgz'))
+
+    if not os.path.isfile(brainmask):
+        raise FileNotFoundError(f'Missing brainmask for {subject}')
 
-def extract_brainmasks_from_recon(recon: str, destination: str, symlink: bool = False):
     copy = os.symlink if symlink else copyfile
+    copy(brainmask, dest)
 
+def extract_brainmasks_from_recon(recon: str, destination: str,
+                                  symlink: bool = False, *,
+                                  workers: int = 1,
+                                  scheduler: Scheduler = None
+                                  ) -> List[JobRecord]:
     if not os.path.isdir(destination):
         os.makedirs(destination)
+
+    jobs = []
     
     for subject in os.listdir(recon):
         brainmask = os.path.abspath(os.path.join(recon, subject, 'mri', 
@@ -35,4 +65,10 @@ def extract_brainmasks_from_recon(recon: str, destination: str, symlink: bool =
             logger.info(f'Skipping {subject}. {path} already exists')
             continue
         
-        copy(brainmask, path)
\ No newline at end of file
+        jobs.append(Job(subject, extract_brainmask, recon=recon,
+                        subject=subject, dest=path, symlink=symlink))
+
+    if scheduler is None:
+        scheduler = Scheduler(concurrency=workers, processes=workers > 1)
+
+    return scheduler.run(jobs, stage='extract_brainmask')
\ No newline at end of file
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+
+from contextlib import contextmanager
+from threading import Event, Thread
+from typing import Callable, Dict, Iterator, List
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class LeaseLost(Exception):
+    """Raised when a worker no longer holds the lease of a task, e.g.
+    because it expired and was recovered by another process"""
+
+
+class FileWorkQueue(object):
+    """A work queue kept in a folder on a filesystem shared by several
+    machines, for clusters without a scheduler service. Every task is a
+    file that moves between the subfolders pending, leases, done and
+    failed. Moves are renames, which are atomic, so exactly one worker
+    wins the claim of a task. A worker holding a lease touches it
+    regularly, and leases that have not been touched for longer than the
+    timeout are put back in pending by whoever notices first.
+
+    Args:
+        root (str): The folder of the queue
+        lease_timeout (float): Seconds without a heartbeat after which a
+            lease is considered abandoned
+        retries (int): Number of times a failed task is put back in
+            pending
+    """
+
+    states = ['pending', 'leases', 'done', 'failed']
+
+    def __init__(self, root: str, *, lease_timeout: float = 600,
+                 retries: int = 0) -> FileWorkQueue:
+        self.root = root
+        self.lease_timeout = lease_timeout
+        self.retries = retries
+
+        for state in self.states + ['tmp']:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state: str, name: str) -> str:
+        return os.path.join(self.root, state, name)
+
+    def _read(self, path: str) -> Dict:
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _write(self, path: str, content: Dict) -> None:
+        # Written to the shared tmp folder first, so that the task never
+        # appears half-written
+        partial = self._path('tmp', f'{socket.gethostname()}-{os.getpid()}-'
+                                    f'{os.path.basename(path)}')
+
+        with open(partial, 'w') as f:
+            json.dump(content, f)
+
+        os.replace(partial, path)
+
+    def _now(self) -> float:
+        # The clocks of the nodes may differ, so lease ages are measured
+        # against the clock of the filesystem
+        clock = self._path('tmp', f'clock-{socket.gethostname()}-'
+                                  f'{os.getpid()}')
+
+        with open(clock, 'w'):
+            pass
+
+        return os.stat(clock).st_mtime
+
+    def submit(self, names: List[str]) -> int:
+        """Adds tasks that are not already in the queue. Returns the number
+        of tasks added"""
+        added = 0
+
+        for name in names:
+            if any([os.path.exists(self._path(state, name)) \
+                    for state in self.states]):
+                continue
+
+            self._write(self._path('pending', name),
+                        {'name': name, 'attempts': 0})
+            added += 1
+
+        logger.info(f'Submitted {added} tasks')
+
+        return added
+
+    def claim(self, worker: str) -> str:
+        """Claims a pending task for the given worker. Returns the name of
+        the task, or None if there are no pending tasks"""
+        for name in sorted(os.listdir(os.path.join(self.root, 'pending'))):
+            try:
+                os.rename(self._path('pending', name),
+                          self._path('leases', name))
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+
+            try:
+                # The lease starts out with the age of the pending task
+                os.utime(self._path('leases', name))
+                task = self._read(self._path('leases', name))
+                task['worker'] = worker
+                task['attempts'] += 1
+                self._write(self._path('leases', name), task)
+            except FileNotFoundError:
+                # The old age let another worker recover the lease before
+                # it was renewed
+                continue
+
+            logger.debug(f'{worker} claimed {name}')
+
+            return name
+
+        return None
+
+    def heartbeat(self, name: str) -> None:
+        """Renews the lease of a task"""
+        try:
+            os.utime(self._path('leases', name))
+        except FileNotFoundError:
+            raise LeaseLost(f'Lease of {name} was lost')
+
+    @contextmanager
+    def keep_alive(self, name: str, *, interval: float = None,
+                   on_lost: Callable[[], None] = None) -> Iterator[None]:
+        """Renews the lease of a task from a background thread while the
+        block runs. If the lease is lost, on_lost is called from the
+        background thread, e.g. to stop working on the task"""
+        interval = interval if interval is not None \
+                   else self.lease_timeout / 4
+        stopped = Event()
+
+        def beat():
+            while not stopped.wait(interval):
+                try:
+                    self.heartbeat(name)
+                except LeaseLost as e:
+                    logger.warning(str(e))
+
+                    if on_lost is not None:
+                        on_lost()
+
+                    break
+
+        thread = Thread(target=beat, daemon=True)
+        thread.start()
+
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def complete(self, name: str) -> None:
+        """Marks a leased task as done"""
+        try:
+            os.rename(self._path('leases', name), self._path('done', name))
+        except FileNotFoundError:
+            raise LeaseLost(f'Lease of {name} was lost before completion')
+
+    def fail(self, name: str, error: str = None) -> None:
+        """Marks a leased task as failed, or puts it back in pending if it
+        has retries left"""
+        lease = self._path('leases', name)
+
+        try:
+            task = self._read(lease)
+        except FileNotFoundError:
+            raise LeaseLost(f'Lease of {name} was lost before failing')
+
+        task['error'] = error
+        state = 'pending' if task['attempts'] <= self.retries else 'failed'
+        self._write(lease, task)
+
+        os.rename(lease, self._path(state, name))
+
+    def recover(self) -> List[str]:
+        """Puts leases that have expired back in pending, or in failed if
+        the task has no retries left. Returns the names of the recovered
+        tasks"""
+        now = self._now()
+        recovered = []
+
+        for name in os.listdir(os.path.join(self.root, 'leases')):
+            lease = self._path('leases', name)
+
+            try:
+                age = now - os.stat(lease).st_mtime
+
+                if age <= self.lease_timeout:
+                    continue
+
+                # A task that keeps crashing its workers is not retried
+                # forever
+                task = self._read(lease)
+                state = 'pending' if task['attempts'] <= self.retries \
+                        else 'failed'
+
+                if state == 'failed':
+                    task['error'] = 'Lease expired'
+                    self._write(lease, task)
+
+                os.rename(lease, self._path(state, name))
+            except FileNotFoundError:
+                # Completed or recovered by another process meanwhile
+                continue
+
+            logger.warning((f'Recovered {name} after {age:.0f}s without a '
+                            'heartbeat'))
+            recovered.append(name)
+
+        return recovered
+
+    def status(self) -> Dict[str, int]:
+        """Returns the number of tasks in each state"""
+        return {state: len(os.listdir(os.path.join(self.root, state))) \
+                for state in self.states}
+
+    def leases(self) -> Dict[str, Dict]:
+        """Returns the worker holding each lease and the seconds since its
+        last heartbeat"""
+        now = self._now()
+        leases = {}
+
+        for name in sorted(os.listdir(os.path.join(self.root, 'leases'))):
+            try:
+                task = self._read(self._path('leases', name))
+                age = now - os.stat(self._path('leases', name)).st_mtime
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+
+            leases[name] = {'worker': task.get('worker'), 'age': age}
+
+        return leases
+
+    def errors(self) -> Dict[str, str]:
+        """Returns the errors of failed tasks"""
+        errors = {}
+
+        for name in sorted(os.listdir(os.path.join(self.root, 'failed'))):
+            errors[name] = self._read(self._path('failed', name)).get('error')
+
+        return errors
+
+    def is_finished(self) -> bool:
+        status = self.status()
+
+        return status['pending'] == 0 and status['leases'] == 0
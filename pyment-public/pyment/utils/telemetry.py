@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import resource
+import numpy as np
+import pandas as pd
+import socket
+import threading
+
+from contextlib import contextmanager
+from time import process_time, thread_time, time
+from typing import Any, Dict, Iterator, List, Union
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_sink = None
+_active = 0
+_active_lock = threading.Lock()
+
+
+def _io(process: bool = False) -> Dict[str, int]:
+    # Bytes passed through read and write calls by the current thread (or
+    # process), whether they hit the disk or the page cache
+    try:
+        with open(f'/proc/{"self" if process else "thread-self"}/io',
+                  'r') as f:
+            counters = dict([line.split(': ') for line in f.read().split('\n') \
+                             if ': ' in line])
+
+        return {'read_bytes': int(counters['rchar']),
+                'written_bytes': int(counters['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return {'read_bytes': 0, 'written_bytes': 0}
+
+
+def _peak_rss() -> int:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss() -> None:
+    # Only possible on Linux, and only meaningful when nothing else in the
+    # process is being measured. Resets the high-water mark for everything
+    # else in the process that reads it
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class Measurement(object):
+    """Resources used by a block of code. CPU time and bytes read and
+    written are those of the calling thread, or of the whole process for
+    blocks that hand their work to other threads. The peak resident memory
+    is always the high-water mark of the whole process. It includes
+    whatever else ran in the process at the same time, and everything
+    before the block unless the block reset it"""
+
+    fields = ['started', 'wall_time', 'cpu_time', 'peak_rss', 'read_bytes',
+              'written_bytes']
+
+    def __init__(self) -> Measurement:
+        self.started = None
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.read_bytes = None
+        self.written_bytes = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.fields}
+
+    def __repr__(self) -> str:
+        return (f'Measurement({self.wall_time:.1f}s, {self.cpu_time:.1f}s '
+                f'CPU, {self.peak_rss}B)')
+
+
+@contextmanager
+def measure(*, process: bool = False,
+            reset_peak: bool = False) -> Iterator[Measurement]:
+    """Measures the wall time, CPU time, peak memory and bytes read and
+    written by the block. The measurement is filled in when the block
+    finishes, also if it fails. CPU time and bytes are counted for the
+    calling thread, or for the whole process if process is true. If
+    reset_peak is true, telemetry is enabled and nothing else is being
+    measured, the peak memory of the process is reset when the block
+    starts, so that it is not carried over from earlier work"""
+    global _active
+
+    with _active_lock:
+        if reset_peak and _sink is not None and _active == 0:
+            _reset_peak_rss()
+
+        _active += 1
+
+    measurement = Measurement()
+    measurement.started = time()
+    clock = process_time if process else thread_time
+    cpu = clock()
+    io = _io(process)
+
+    try:
+        yield measurement
+    finally:
+        measurement.wall_time = time() - measurement.started
+        measurement.cpu_time = clock() - cpu
+        measurement.peak_rss = _peak_rss()
+
+        for key, value in _io(process).items():
+            setattr(measurement, key, value - io[key])
+
+        with _active_lock:
+            _active -= 1
+
+
+class Telemetry(object):
+    """Appends events as JSON lines to a file. Every event is written with
+    a single call, so several threads, processes or hosts can append to
+    the same file"""
+
+    def __init__(self, path: str) -> Telemetry:
+        folder = os.path.dirname(path)
+
+        if folder != '' and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event: Dict[str, Any]) -> None:
+        event = {'time': time(), 'host': socket.gethostname(),
+                 'pid': os.getpid(), **event}
+        line = json.dumps(event, default=str) + '\n'
+
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+def configure_telemetry(path: str = None) -> None:
+    """Sets the file telemetry events are written to. Without a path,
+    telemetry is turned off"""
+    global _sink
+
+    _sink = Telemetry(path) if path is not None else None
+
+
+def telemetry_enabled() -> bool:
+    return _sink is not None
+
+
+def emit(**event) -> None:
+    """Writes an event if telemetry is configured"""
+    if _sink is None:
+        return
+
+    try:
+        _sink.emit(event)
+    except Exception as e:
+        logger.warning(f'Unable to write telemetry: {e}')
+
+
+@contextmanager
+def track(stage: str, subject: str = None, *, process: bool = False,
+          reset_peak: bool = False, **fields) -> Iterator[None]:
+    """Measures the block and writes an event for it if telemetry is
+    configured. Does nothing otherwise. See measure for process and
+    reset_peak"""
+    if _sink is None:
+        yield
+        return
+
+    status = 'success'
+
+    try:
+        with measure(process=process, reset_peak=reset_peak) as measurement:
+            yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        emit(stage=stage, subject=subject, status=status,
+             **measurement.to_dict(), **fields)
+
+
+def load_telemetry(paths: Union[str, List[str]]) -> pd.DataFrame:
+    """Reads the events of one or more telemetry files into a dataframe.
+    Lines that were cut short, e.g. by a crash, are skipped"""
+    paths = [paths] if isinstance(paths, str) else paths
+    events = []
+
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+
+    return pd.DataFrame(events)
+
+
+def summarize_telemetry(events: pd.DataFrame) -> pd.DataFrame:
+    """Summarizes the successful events of each stage: how many subjects
+    ran it and how many failed, its throughput while it was running,
+    percentiles of its wall time, and its CPU, memory and I/O"""
+    rows = []
+
+    for stage, group in events.groupby('stage', sort=False):
+        done = group[group['status'] == 'success']
+        row = {'stage': stage, 'subjects': len(done),
+               'failed': int(np.sum(group['status'] == 'failed'))}
+
+        if len(done) > 0:
+            # The time from the first start to the last finish, so that
+            # stages running several subjects at once get credit for it
+            span = np.max(done['started'] + done['wall_time']) - \
+                   np.min(done['started'])
+            wall_time = done['wall_time']
+
+            row.update({
+                'per_hour': len(done) / span * 3600 if span > 0 else np.nan,
+                'p50': np.percentile(wall_time, 50),
+                'p90': np.percentile(wall_time, 90),
+                'p99': np.percentile(wall_time, 99),
+                'max': np.max(wall_time),
+                'cpu_time': np.mean(done['cpu_time']),
+                'peak_rss_mb': np.max(done['peak_rss']) / 2**20,
+                'read_mb': np.sum(done['read_bytes']) / 2**20,
+                'written_mb': np.sum(done['written_bytes']) / 2**20
+            })
+
+        rows.append(row)
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,149 @@
+import argparse
+import logging
+import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from time import time
+from typing import List
+
+from pyment.utils.preprocessing import apply_rigid, estimate_rigid, \
+                                       list_images
+from pyment.utils.preprocessing.utils import run
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _fsl_coordinates(img: nib.Nifti1Image) -> np.ndarray:
+    # FSL matrices work on voxel coordinates scaled by the voxel size, with
+    # the first axis flipped for images in neurological orientation
+    zooms = img.header.get_zooms()[:3]
+    matrix = np.diag(list(zooms) + [1.])
+
+    if np.linalg.det(img.affine) > 0:
+        flip = np.eye(4)
+        flip[0,0] = -1
+        flip[0,3] = img.shape[0] - 1
+        matrix = matrix @ flip
+
+    return matrix
+
+def flirt_to_world(omat: np.ndarray, src: nib.Nifti1Image,
+                   template: nib.Nifti1Image) -> np.ndarray:
+    """Converts a FLIRT matrix to a matrix mapping world coordinates of the
+    template to world coordinates of the image, like estimate_rigid"""
+    return src.affine @ np.linalg.inv(_fsl_coordinates(src)) @ \
+           np.linalg.inv(omat) @ _fsl_coordinates(template) @ \
+           np.linalg.inv(template.affine)
+
+def _correlation(img: nib.Nifti1Image, template: nib.Nifti1Image) -> float:
+    return np.corrcoef(np.asarray(img.dataobj).ravel(),
+                       np.asarray(template.dataobj).ravel())[0, 1]
+
+def _displacement(first: np.ndarray, second: np.ndarray,
+                  template: nib.Nifti1Image) -> float:
+    # Mean distance in mm between where the two matrices map the brain
+    # voxels of the template
+    voxels = np.stack(np.nonzero(np.asarray(template.dataobj) > 0))
+    voxels = voxels[:,::max(1, voxels.shape[1] // 10000)]
+    points = template.affine @ np.concatenate([voxels,
+                                               np.ones((1, voxels.shape[1]))])
+
+    return float(np.mean(np.linalg.norm((first @ points - \
+                                         second @ points)[:3], axis=0)))
+
+def benchmark_registration(*, folder: str, template: str, cost: str,
+                           scales: List[int], bins: int,
+                           limit: int = None,
+                           destination: str = None) -> pd.DataFrame:
+    template_path = template
+    template = nib.load(template)
+    filenames = list_images(folder)[:limit]
+    use_flirt = which('flirt') is not None
+
+    if not use_flirt:
+        logger.warning('Unable to locate flirt. Only the native registration '
+                       'is benchmarked')
+
+    scratch = mkdtemp()
+    results = []
+
+    try:
+        for i, filename in enumerate(filenames):
+            logger.info(f'Registering {filename} ({i + 1}/{len(filenames)})')
+            path = os.path.join(folder, filename)
+            result = {'image': filename}
+
+            start = time()
+            img = nib.load(path)
+            matrix = estimate_rigid(img, template, cost=cost, scales=scales,
+                                    bins=bins)
+            registered = apply_rigid(img, matrix, template=template)
+            result['native_seconds'] = time() - start
+            result['native_correlation'] = _correlation(registered, template)
+
+            if use_flirt:
+                output = os.path.join(scratch, 'flirt.nii.gz')
+                omat = os.path.join(scratch, 'flirt.mat')
+
+                start = time()
+                run((f'flirt -in {path} -ref {template_path} -out {output} '
+                     f'-omat {omat} -dof 6'), silence=True)
+                result['flirt_seconds'] = time() - start
+                result['flirt_correlation'] = _correlation(nib.load(output),
+                                                           template)
+                result['displacement_mm'] = _displacement(
+                    matrix, flirt_to_world(np.loadtxt(omat), img, template),
+                    template
+                )
+
+            results.append(result)
+    finally:
+        rmtree(scratch)
+
+    df = pd.DataFrame(results)
+
+    print(df.to_string())
+    print('\nMean:')
+    print(df.drop(columns='image').mean().to_string())
+
+    if destination is not None:
+        df.to_csv(destination, index=False)
+
+    return df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Compares the native rigid registration '
+                                      'with FLIRT on speed, and on how far '
+                                      'apart their alignments are'))
+
+    parser.add_argument('-f', '--folder', required=True,
+                        help=('Folder containing reoriented images, e.g. the '
+                              'reoriented stage of the preprocessing'))
+    parser.add_argument('-i', '--mni152_template', required=True,
+                        help='Path to the MNI152 template')
+    parser.add_argument('-c', '--cost', required=False, default='corratio',
+                        choices=['corratio', 'mutualinfo'],
+                        help='Cost function of the native registration')
+    parser.add_argument('-s', '--scales', required=False, default=[8, 4, 2],
+                        nargs='+', type=int,
+                        help=('Downsampling factors of the pyramid, from '
+                              'coarsest to finest'))
+    parser.add_argument('-b', '--bins', required=False, default=64, type=int,
+                        help='Number of intensity bins of the cost function')
+    parser.add_argument('-n', '--limit', required=False, default=None,
+                        type=int, help='Maximum number of images to register')
+    parser.add_argument('-d', '--destination', required=False, default=None,
+                        help='Optional path where the results are stored')
+
+    args = parser.parse_args()
+
+    benchmark_registration(folder=args.folder,
+                           template=args.mni152_template, cost=args.cost,
+                           scales=args.scales, bins=args.bins,
+                           limit=args.limit, destination=args.destination)
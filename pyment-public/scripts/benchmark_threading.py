@@ -0,0 +1,214 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import pandas as pd
+
+from itertools import product
+from time import time
+from typing import Any, Dict, List
+
+from pyment.utils import numa_nodes
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _placements() -> Dict[str, Dict[str, str]]:
+    placements = {'none': {'loader_cpus': None, 'compute_cpus': None}}
+    nodes = list(numa_nodes().keys())
+
+    if len(nodes) > 1:
+        placements['numa'] = {
+            'loader_cpus': f'numa:{nodes[1]}',
+            'compute_cpus': f'numa:{nodes[0]}'
+        }
+
+    return placements
+
+
+def run_configuration(*, folder: str, model_name: str, weights: str = None,
+                      batch_size: int, batches: int, normalize: bool = False,
+                      loader_threads: int, intra_op_threads: int,
+                      inter_op_threads: int, loader_cpus: str = None,
+                      compute_cpus: str = None) -> Dict[str, Any]:
+    """Measures prediction throughput for a single configuration. TensorFlow
+    threading can only be configured once per process, so this is run in
+    a separate process for every configuration"""
+    from pyment.data import AsyncNiftiGenerator, NiftiDataset
+    from pyment.models import get as get_model
+    from pyment.utils import configure_tensorflow_threads, \
+                             pin_current_thread, resolve_cpus
+
+    pin_current_thread(resolve_cpus(compute_cpus))
+    configure_tensorflow_threads(intra_op=intra_op_threads,
+                                 inter_op=inter_op_threads)
+
+    dataset = NiftiDataset.from_folder(folder, target='age',
+                                       show_missing_warnings=False)
+    preprocessor = lambda x: x/255. if normalize else x
+    generator = AsyncNiftiGenerator(dataset, preprocessor=preprocessor,
+                                    batch_size=batch_size,
+                                    threads=loader_threads,
+                                    cpus=resolve_cpus(loader_cpus),
+                                    infinite=True)
+    model = get_model(model_name, weights=weights)
+
+    # The first batch includes graph construction and is not timed
+    X, _ = next(generator)
+    model.predict(X, batch_size=batch_size, verbose=0)
+
+    start = time()
+    images = 0
+
+    for _ in range(batches):
+        X, _ = next(generator)
+        model.predict(X, batch_size=batch_size, verbose=0)
+        images += len(X)
+
+    elapsed = time() - start
+    generator.release()
+
+    return {'images': images, 'seconds': elapsed,
+            'images_per_second': images / elapsed}
+
+
+def benchmark_threading(*, folder: str, model_name: str, weights: str = None,
+                        batch_size: int, batches: int,
+                        normalize: bool = False, loader_threads: List[int],
+                        intra_op_threads: List[int],
+                        inter_op_threads: List[int],
+                        placements: List[str] = None,
+                        destination: str = None) -> pd.DataFrame:
+    available = _placements()
+    placements = placements if placements is not None \
+                 else list(available.keys())
+
+    for placement in placements:
+        if placement not in available:
+            raise ValueError((f'Placement {placement} is not available on '
+                              f'this host. Choose from {list(available)}'))
+
+    results = []
+    grid = list(product(loader_threads, intra_op_threads, inter_op_threads,
+                        placements))
+
+    for i, (loader, intra, inter, placement) in enumerate(grid):
+        configuration = {
+            'folder': folder,
+            'model_name': model_name,
+            'weights': weights,
+            'batch_size': batch_size,
+            'batches': batches,
+            'normalize': normalize,
+            'loader_threads': loader,
+            'intra_op_threads': intra,
+            'inter_op_threads': inter,
+            **available[placement]
+        }
+
+        logger.info(f'Running configuration {i + 1}/{len(grid)}: '
+                    f'{loader} loader threads, {intra} intra-op threads, '
+                    f'{inter} inter-op threads, placement {placement}')
+
+        process = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                  '--configuration',
+                                  json.dumps(configuration)],
+                                 stdout=subprocess.PIPE)
+
+        result = {'loader_threads': loader, 'intra_op_threads': intra,
+                  'inter_op_threads': inter, 'placement': placement}
+
+        if process.returncode != 0:
+            logger.warning('Configuration failed')
+            result['images_per_second'] = float('nan')
+        else:
+            output = process.stdout.decode().strip().split('\n')[-1]
+            result['images_per_second'] = \
+                json.loads(output)['images_per_second']
+
+        results.append(result)
+
+    df = pd.DataFrame(results)
+    df = df.sort_values('images_per_second', ascending=False)
+    df = df.reset_index(drop=True)
+
+    print(df.to_string())
+
+    if df['images_per_second'].notna().any():
+        best = df.iloc[0]
+        print((f'\nBest configuration: --threads {best["loader_threads"]} '
+               f'--intra_op_threads {best["intra_op_threads"]} '
+               f'--inter_op_threads {best["inter_op_threads"]}' +
+               ''.join([f' --{key} {value}' for key, value \
+                        in available[best['placement']].items() \
+                        if value is not None])))
+
+    if destination is not None:
+        df.to_csv(destination, index=False)
+
+    return df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Measures prediction throughput for '
+                                      'combinations of loader threads, '
+                                      'TensorFlow threads and CPU placement, '
+                                      'and reports the best configuration '
+                                      'for the host'))
+
+    parser.add_argument('--configuration', required=False, default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('-f', '--folder', required=False,
+                        help=('Folder containing images. Should have a '
+                              'csv-file called \'labels.csv\' with columns '
+                              'id and age, and a subfolder \'images\' '
+                              'containing nifti files'))
+    parser.add_argument('-m', '--model_name', required=False,
+                        default='sfcn-reg',
+                        help='Name of the model to use (e.g. sfcn-reg)')
+    parser.add_argument('-w', '--weights', required=False, default=None,
+                        help='Weights to load in the model')
+    parser.add_argument('-b', '--batch_size', required=False, default=2,
+                        type=int, help='Batch size to use while predicting')
+    parser.add_argument('-k', '--batches', required=False, default=5,
+                        type=int, help='Number of timed batches')
+    parser.add_argument('-n', '--normalize', action='store_true',
+                        help=('If set, images will be normalized to range '
+                              '(0, 1) before prediction'))
+    parser.add_argument('-t', '--loader_threads', required=False,
+                        default=[2, 4], nargs='+', type=int,
+                        help='Numbers of loader threads to try')
+    parser.add_argument('-a', '--intra_op_threads', required=False,
+                        default=[os.cpu_count() // 2, os.cpu_count()],
+                        nargs='+', type=int,
+                        help='Numbers of intra-op threads to try')
+    parser.add_argument('-e', '--inter_op_threads', required=False,
+                        default=[1, 2], nargs='+', type=int,
+                        help='Numbers of inter-op threads to try')
+    parser.add_argument('-p', '--placements', required=False, default=None,
+                        nargs='+', help=('CPU placements to try (none, numa). '
+                                         'Defaults to all available on the '
+                                         'host'))
+    parser.add_argument('-d', '--destination', required=False, default=None,
+                        help='Optional path where the results are stored')
+
+    args = parser.parse_args()
+
+    if args.configuration is not None:
+        result = run_configuration(**json.loads(args.configuration))
+        print(json.dumps(result))
+    else:
+        if args.folder is None:
+            parser.error('the following arguments are required: -f/--folder')
+
+        benchmark_threading(folder=args.folder, model_name=args.model_name,
+                            weights=args.weights, batch_size=args.batch_size,
+                            batches=args.batches, normalize=args.normalize,
+                            loader_threads=args.loader_threads,
+                            intra_op_threads=args.intra_op_threads,
+                            inter_op_threads=args.inter_op_threads,
+                            placements=args.placements,
+                            destination=args.destination)
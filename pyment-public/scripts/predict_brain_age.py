@@ -1,14 +1,61 @@
 import os
 import argparse
+import logging
+import numpy as np
 import pandas as pd
+import tensorflow as tf
 
-from pyment.data import AsyncNiftiGenerator, NiftiDataset
+from typing import List, Union
+
+from pyment.data import AsyncNiftiGenerator, BatchAugmenter, NiftiDataset
 from pyment.models import get as get_model, ModelType
+from pyment.utils import auto_batch_size, configure_tensorflow_threads, \
+                         configure_telemetry, estimate_sample_memory, \
+                         find_batch_size, parse_batch_size, peak_memory, \
+                         pin_current_thread, resolve_cpus
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def choose_batch_size(model: tf.keras.Model, *,
+                      augmenter: BatchAugmenter = None,
+                      memory_limit: int = None, maximum: int = None) -> int:
+    # Images are decoded as float64, and the generator holds the next
+    # batch in memory while the current one is predicted
+    sample_memory = estimate_sample_memory(model, dtype='float64') + \
+                    np.prod(model.input_shape[1:]) * 8
 
+    if augmenter is not None:
+        sample_memory *= len(augmenter)
+
+    batch_size = auto_batch_size(sample_memory, maximum=maximum)
+    trial = lambda b: model.predict(
+        np.zeros((b,) + model.input_shape[1:], dtype=np.float32),
+        augmenter=augmenter, memory_limit=memory_limit, batch_size=b,
+        verbose=0
+    )
+
+    return find_batch_size(trial, batch_size,
+                           exceptions=(MemoryError,
+                                       tf.errors.ResourceExhaustedError))
 
 def predict_brain_age(*, folder: str, model_name: str, weights: str = None,
-                      batch_size: int, threads: int = None, 
-                      normalize: bool = False, destination: str):
+                      batch_size: Union[int, str], threads: int = None, 
+                      normalize: bool = False, destination: str,
+                      augmentations: List[str] = None,
+                      memory_limit: int = None, intra_op_threads: int = None,
+                      inter_op_threads: int = None, loader_cpus: str = None,
+                      compute_cpus: str = None, telemetry: str = None):
+    configure_telemetry(telemetry)
+
+    # TensorFlow threads inherit the affinity of the thread creating them,
+    # so compute is pinned before the model is built
+    pin_current_thread(resolve_cpus(compute_cpus))
+    configure_tensorflow_threads(intra_op=intra_op_threads,
+                                 inter_op=inter_op_threads)
+
     dataset = NiftiDataset.from_folder(folder, target='age')
 
     preprocessor = lambda x: x/255. if normalize else x
@@ -17,14 +64,27 @@ def predict_brain_age(*, folder: str, model_name: str, weights: str = None,
         raise NotImplementedError(('Predicting from synchronous generator '
                                    'is not implemented'))
 
-    generator = AsyncNiftiGenerator(dataset, preprocessor=preprocessor,
-                                    batch_size=batch_size, threads=threads)
-
     model = get_model(model_name, weights=weights)
 
+    augmenter = BatchAugmenter(augmentations) \
+                if augmentations is not None else None
+
+    if batch_size == 'auto':
+        batch_size = choose_batch_size(model, augmenter=augmenter,
+                                       memory_limit=memory_limit,
+                                       maximum=len(dataset))
+
+    generator = AsyncNiftiGenerator(dataset, preprocessor=preprocessor,
+                                    batch_size=batch_size, threads=threads,
+                                    cpus=resolve_cpus(loader_cpus))
+
     ids = dataset.ids
     labels = dataset.y
-    predictions = model.predict(generator)
+    predictions = model.predict(generator, augmenter=augmenter,
+                                memory_limit=memory_limit)
+    logger.info((f'Predicted {len(dataset)} images with batch size '
+                 f'{batch_size}. Peak memory: '
+                 f'{peak_memory() / 2**20:.1f}MB'))
 
     if model.type == ModelType.REGRESSION:
         predictions = predictions.squeeze()
@@ -49,8 +109,11 @@ if __name__ == '__main__':
                         help='Name of the model to use (e.g. sfcn-reg)')
     parser.add_argument('-w', '--weights', required=False, default=None,
                         help='Weights to load in the model')
-    parser.add_argument('-b', '--batch_size', required=True, type=int,
-                        help='Batch size to use while predicting')
+    parser.add_argument('-b', '--batch_size', required=True,
+                        type=parse_batch_size,
+                        help=('Batch size to use while predicting. If '
+                              '\'auto\', the largest batch size that fits '
+                              'in the available memory is used'))
     parser.add_argument('-t', '--threads', required=False, default=None, 
                         type=int, help=('Number of threads to use for reading '
                                         'data. If not set, a synchronous '
@@ -61,10 +124,44 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--destination', required=True,
                         help=('Path where CSV containing ids, labels '
                               'and predictions are stored'))
+    parser.add_argument('--tta', required=False, default=None, nargs='+',
+                        help=('If set, predictions are averaged over the '
+                              'given test-time augmentations, e.g. identity '
+                              'flip shift:2,0,0 shift:-2,0,0'))
+    parser.add_argument('--memory_limit', required=False, default=None,
+                        type=int, help=('If set, the high-resolution blocks '
+                                        'of the model are run in spatial '
+                                        'tiles whose activations fit within '
+                                        'the given number of megabytes'))
+    parser.add_argument('--intra_op_threads', required=False, default=None,
+                        type=int, help=('Number of threads used within each '
+                                        'TensorFlow operation'))
+    parser.add_argument('--inter_op_threads', required=False, default=None,
+                        type=int, help=('Number of TensorFlow operations run '
+                                        'in parallel'))
+    parser.add_argument('--loader_cpus', required=False, default=None,
+                        help=('CPUs the threads reading data are pinned to, '
+                              'either as a list (e.g. 0-7,16) or a NUMA node '
+                              '(e.g. numa:1)'))
+    parser.add_argument('--compute_cpus', required=False, default=None,
+                        help=('CPUs TensorFlow is pinned to, either as a list '
+                              '(e.g. 8-15) or a NUMA node (e.g. numa:0)'))
+    parser.add_argument('--telemetry', required=False, default=None,
+                        help=('Optional JSON lines file where the time, CPU, '
+                              'memory and I/O of loading and predicting are '
+                              'recorded'))
     args = parser.parse_args()
 
     predict_brain_age(folder=args.folder, 
                       model_name=args.model_name, 
                       weights=args.weights, batch_size=args.batch_size,
                       threads=args.threads, normalize=args.normalize,
-                      destination=args.destination)
\ No newline at end of file
+                      destination=args.destination,
+                      augmentations=args.tta,
+                      memory_limit=args.memory_limit * 2**20 \
+                                   if args.memory_limit is not None else None,
+                      intra_op_threads=args.intra_op_threads,
+                      inter_op_threads=args.inter_op_threads,
+                      loader_cpus=args.loader_cpus,
+                      compute_cpus=args.compute_cpus,
+                      telemetry=args.telemetry)
\ No newline at end of file
@@ -1,31 +1,199 @@
 import argparse
 import logging
 import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
 
-from shutil import copyfile, rmtree, which
+from shutil import rmtree, which
+from typing import Dict, List, Union
 
-from pyment.utils.preprocessing import autorecon1_folder, \
-                                       convert_mgz_to_nii_gz_folder, \
-                                       crop_folder, \
-                                       extract_brainmasks_from_recon, \
-                                       flirt_folder, \
-                                       reorient2std_folder
-from predict_brain_age import predict_brain_age
+from pyment.models import get as get_model, ModelType
+from pyment.utils import configure_telemetry, load_telemetry, \
+                         parse_batch_size
+from pyment.utils.preprocessing import autorecon1, crop_mri, flirt, \
+                                       ImageFormat, load_records, Manifest, \
+                                       mgz_to_nifti, Pipeline, Plan, \
+                                       register_rigid, ResourceUsage, \
+                                       reorient_to_standard, Stage
+from predict_brain_age import choose_batch_size
 
 
 logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
 logging.basicConfig(format=logformat, level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+STAGES = ['recon', 'reoriented', 'mni152', 'cropped']
+REGISTRATIONS = ['flirt', 'native']
+
+def stage_path(temporary_folder: str, stage: str, subject: str,
+               image_format: str = None) -> str:
+    return os.path.join(temporary_folder, stage, 'images',
+                        ImageFormat.parse(image_format).filename(subject))
+
+def build_stages(*, images: Dict[str, str], temporary_folder: str,
+                 mni152_template: str, threads: int = None,
+                 verbose: bool = False, recon_threads: int = 1,
+                 recon_memory: int = 0, registration: str = 'flirt',
+                 intermediate_format: str = None,
+                 read_only: bool = False,
+                 shard: str = None) -> List[Stage]:
+    """Builds the preprocessing stages for the given images, keyed by
+    subject id, with intermediates stored in the temporary folder. The
+    registration to MNI152 space is done either by FLIRT or in-process
+    (registration='native'). Intermediates are written in the given
+    format, while the cropped images are always compressed. If a shard is
+    given, the stages record their outputs in manifests of their own. If
+    read_only is set, e.g. for planning, no folders are created and the
+    manifests are never written"""
+    if registration not in REGISTRATIONS:
+        raise ValueError(f'Invalid registration {registration}')
+
+    folders = {stage: os.path.join(temporary_folder, stage, 'images') \
+               for stage in STAGES}
+    folders['recon'] = os.path.join(temporary_folder, 'recon')
+
+    for path in folders.values():
+        if not read_only and not os.path.isdir(path):
+            os.makedirs(path)
+
+    formats = {'reoriented': intermediate_format,
+               'mni152': intermediate_format}
+    paths = lambda stage: \
+        lambda subject: stage_path(temporary_folder, stage, subject,
+                                   formats.get(stage))
+    brainmask = lambda subject: os.path.join(folders['recon'], subject, 'mri',
+                                             'brainmask.mgz')
+    silence = not verbose
+
+    def recon(src: str, dest: str, *, threads: int) -> ResourceUsage:
+        # recon-all refuses to start over a folder left by an interrupted
+        # run, and the brainmask is only moved to dest once it is done
+        subject = os.path.relpath(dest, folders['recon']).split(os.sep)[0]
+
+        if os.path.isdir(os.path.join(folders['recon'], subject)):
+            rmtree(os.path.join(folders['recon'], subject))
+
+        usage = autorecon1(src, subject=subject,
+                           subjects_dir=folders['recon'], silence=silence,
+                           threads=threads)
+        os.replace(brainmask(subject), dest)
+
+        return usage
+
+    # The brainmask is converted and reoriented in memory, instead of
+    # writing an intermediate image for each step
+    def reorient(src: str, dest: str, *, image_format: str = None) -> None:
+        reorient_to_standard(mgz_to_nifti(src), dest,
+                             image_format=image_format)
+
+    intermediate = {} if intermediate_format is None else \
+                   {'image_format': str(ImageFormat.parse(intermediate_format))}
+
+    if registration == 'flirt':
+        register = {'func': flirt,
+                    'params': {'template': mni152_template},
+                    'options': {'silence': silence}}
+    else:
+        # The template is loaded once and shared by all subjects
+        register = {'func': register_rigid, 'params': intermediate,
+                    'options': {'template': nib.load(mni152_template)}}
+
+    # Every stage records what its outputs were produced from, so that
+    # outputs left by an interrupted run, or produced from other inputs or
+    # parameters, are not taken as done
+    manifests = {stage: Manifest(path, shard=shard, read_only=read_only) \
+                 for stage, path in folders.items()}
+
+    # Each subject moves on to the next stage as soon as its own previous
+    # stage is done
+    concurrency = threads or 1
+    stages = [
+        Stage('autorecon1', recon,
+              input=lambda subject: images[subject], output=brainmask,
+              options={'threads': recon_threads},
+              manifest=manifests['recon'],
+              concurrency=concurrency, cpus=recon_threads,
+              memory=recon_memory,
+              cleanup=lambda subject: rmtree(os.path.join(folders['recon'],
+                                                          subject)),
+              workspace=lambda subject: os.path.join(folders['recon'],
+                                                     subject)),
+        Stage('reoriented', reorient,
+              input=brainmask, output=paths('reoriented'),
+              params=intermediate, manifest=manifests['reoriented'],
+              concurrency=concurrency),
+        Stage('mni152', register['func'],
+              input=paths('reoriented'), output=paths('mni152'),
+              params=register['params'], options=register['options'],
+              tracked=[mni152_template], manifest=manifests['mni152'],
+              concurrency=concurrency),
+        Stage('cropped', crop_mri,
+              input=paths('mni152'), output=paths('cropped'),
+              params={'bounds': ((6, 173), (2, 214), (0, 160))},
+              manifest=manifests['cropped'],
+              concurrency=concurrency)
+    ]
+
+    return stages
+
+def load_history(*, temporary_folder: str,
+                 telemetry: List[str] = None) -> pd.DataFrame:
+    """Returns the stage timings of earlier runs, from the given telemetry
+    files if there are any, and otherwise from the records kept in the
+    temporary folder"""
+    telemetry = [path for path in telemetry or [] if os.path.isfile(path)]
+
+    if len(telemetry) > 0:
+        return load_telemetry(telemetry)
+
+    return load_records(os.path.join(temporary_folder, 'records'))
+
+def plan(*, folder: str, temporary_folder: str, mni152_template: str,
+         threads: int = None, registration: str = 'flirt',
+         intermediate_format: str = 'nii',
+         telemetry: List[str] = None) -> Plan:
+    """Reports how far preprocessing has come for the images in the
+    folder, and estimates the time left, without running anything"""
+    images = {filename.split('.')[0]: os.path.join(folder, 'images', filename) \
+              for filename in sorted(os.listdir(os.path.join(folder,
+                                                             'images')))}
+    stages = build_stages(images=images, temporary_folder=temporary_folder,
+                          mni152_template=mni152_template, threads=threads,
+                          registration=registration,
+                          intermediate_format=intermediate_format,
+                          read_only=True)
+    history = load_history(temporary_folder=temporary_folder,
+                           telemetry=telemetry)
+    result = Pipeline(stages).plan(list(images.keys()), history=history)
+
+    print(result)
+
+    return result
+
 def preprocess_and_predict_brain_age(*, folder: str, model_name: str, 
                                      weights: str = None,
-                                     batch_size: int, threads: int = None, 
+                                     batch_size: Union[int, str],
+                                     threads: int = None, 
                                      normalize: bool = False, destination: str,
                                      temporary_folder: str = '.', 
                                      remove_temporary_folders: bool = False,
                                      verbose: bool = False, 
-                                     mni152_template: str):
-    for tool in ['recon-all', 'mri_convert', 'fslreorient2std', 'flirt']:
+                                     mni152_template: str,
+                                     retries: int = 0,
+                                     recon_threads: int = 1,
+                                     recon_memory: int = 0,
+                                     free_intermediates: bool = False,
+                                     scratch_limit: int = None,
+                                     registration: str = 'flirt',
+                                     intermediate_format: str = 'nii',
+                                     telemetry: str = None):
+    configure_telemetry(telemetry)
+
+    tools = ['recon-all', 'flirt'] if registration == 'flirt' \
+            else ['recon-all']
+
+    for tool in tools:
         assert which(tool) is not None, ('Unable to locate required tool '
                                          f'\'{tool}\'')
 
@@ -37,48 +205,72 @@ def preprocess_and_predict_brain_age(*, folder: str, model_name: str,
     if not os.path.isdir(temporary_folder):
         os.mkdir(temporary_folder)
 
-    recon = os.path.join(temporary_folder, 'recon')
+    images = {filename.split('.')[0]: os.path.join(folder, 'images', filename) \
+              for filename in sorted(os.listdir(os.path.join(folder,
+                                                             'images')))}
+    stages = build_stages(images=images, temporary_folder=temporary_folder,
+                          mni152_template=mni152_template, threads=threads,
+                          verbose=verbose, recon_threads=recon_threads,
+                          recon_memory=recon_memory,
+                          registration=registration,
+                          intermediate_format=intermediate_format)
+
+    # The model is built up front so that predictions can start as soon as
+    # the first subjects are preprocessed
+    model = get_model(model_name, weights=weights)
+
+    if batch_size == 'auto':
+        batch_size = choose_batch_size(model, maximum=len(images))
+
+    labels = pd.read_csv(labelsfile, index_col='id')
+    labels.index = labels.index.astype(str)
+
+    destination_dir = os.path.dirname(destination)
+
+    if destination_dir != '' and not os.path.exists(destination_dir):
+        os.makedirs(destination_dir)
 
-    autorecon1_folder(os.path.join(folder, 'images'), recon, threads=threads,
-                      silence=not verbose)
-    logger.info(f'Finished autorecon for {len(os.listdir(recon))} subjects')
+    if os.path.isfile(destination):
+        os.remove(destination)
 
-    brainmasks = os.path.join(temporary_folder, 'brainmasks', 'images')
-    extract_brainmasks_from_recon(recon, brainmasks, symlink=True)
-    logger.info(f'Found {len(os.listdir(brainmasks))} brainmasks')
+    def predict(subjects: List[str]) -> None:
+        X = np.stack([nib.load(stage_path(temporary_folder, 'cropped',
+                                          subject)).get_fdata() \
+                      for subject in subjects])
+        X = X/255. if normalize else X
 
-    nii = os.path.join(temporary_folder, 'nifti', 'images')
-    convert_mgz_to_nii_gz_folder(brainmasks, nii, silence=not verbose)
-    logger.info(f'Converted {len(os.listdir(nii))} images to nifti')
+        predictions = model.predict(X, batch_size=batch_size, verbose=0)
 
-    reoriented = os.path.join(temporary_folder, 'reoriented', 'images')
-    reorient2std_folder(nii, reoriented, silence=not verbose)
-    logger.info(f'Reoriented {len(os.listdir(reoriented))} images')
+        if model.type == ModelType.REGRESSION:
+            predictions = predictions.squeeze(-1)
 
-    mni152 = os.path.join(temporary_folder, 'mni152', 'images')
-    flirt_folder(reoriented, mni152, template=mni152_template, 
-                 silence=not verbose)
-    logger.info((f'Registered {len(os.listdir(mni152))} images to MNI152 '
-                 'space'))
+        df = pd.DataFrame({'age': labels.reindex(subjects)['age'].values,
+                           'prediction': list(predictions)},
+                          index=subjects)
+        df.to_csv(destination, mode='a',
+                  header=not os.path.isfile(destination))
+        logger.info(f'Predicted {len(subjects)} subjects: {subjects}')
 
-    cropped = os.path.join(temporary_folder, 'cropped', 'images')
-    crop_folder(mni152, cropped, bounds=((6, 173), (2, 214), (0, 160)))
-    logger.info(f'Cropped {len(os.listdir(cropped))} images')
-    cropped = os.path.join(temporary_folder, 'cropped')
+    pipeline = Pipeline(stages, retries=retries,
+                        records=os.path.join(temporary_folder, 'records'),
+                        free_intermediates=free_intermediates,
+                        scratch_limit=scratch_limit)
+    records = pipeline.run(list(images.keys()), on_ready=predict,
+                           batch_size=batch_size)
 
-    copyfile(labelsfile, os.path.join(cropped, 'labels.csv'))
+    failed = {subject: [stage for stage, record in subject_records.items() \
+                        if record.status == 'failed'] \
+              for subject, subject_records in records.items()}
+    failed = {subject: names for subject, names in failed.items() \
+              if len(names) > 0}
 
-    predict_brain_age(folder=cropped, model_name=model_name, weights=weights, 
-                      batch_size=batch_size, threads=threads, 
-                      normalize=normalize, destination=destination)
+    if len(failed) > 0:
+        logger.warning(f'Preprocessing failed for {len(failed)} subjects: '
+                       f'{failed}')
 
     if remove_temporary_folders:
-        rmtree(os.path.join(temporary_folder, 'recon'))
-        rmtree(os.path.join(temporary_folder, 'brainmasks'))
-        rmtree(os.path.join(temporary_folder, 'nifti'))
-        rmtree(os.path.join(temporary_folder, 'reoriented'))
-        rmtree(os.path.join(temporary_folder, 'mni152'))
-        rmtree(os.path.join(temporary_folder, 'cropped'))
+        for stage in STAGES:
+            rmtree(os.path.join(temporary_folder, stage))
 
         if len(os.listdir(temporary_folder)) == 0:
             os.rmdir(temporary_folder)
@@ -99,12 +291,15 @@ if __name__ == '__main__':
                         help='Name of the model to use (e.g. sfcn-reg)')
     parser.add_argument('-w', '--weights', required=False, default=None,
                         help='Weights to load in the model')
-    parser.add_argument('-b', '--batch_size', required=True, type=int,
-                        help='Batch size to use while predicting')
+    parser.add_argument('-b', '--batch_size', required=True,
+                        type=parse_batch_size,
+                        help=('Batch size to use while predicting. If '
+                              '\'auto\', the largest batch size that fits '
+                              'in the available memory is used'))
     parser.add_argument('-t', '--threads', required=False, default=None, 
-                        type=int, help=('Number of threads to use for reading '
-                                        'data. If not set, a synchronous '
-                                        'generator will be used'))
+                        type=int, help=('Number of subjects processed in '
+                                        'parallel by each preprocessing '
+                                        'stage'))
     parser.add_argument('-n', '--normalize', action='store_true',
                         help=('If set, images will be normalized to range '
                               '(0, 1) before prediction'))
@@ -126,17 +321,81 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--mni152_template', required=True,
                         help=('Path to MNI152 template used for FLIRT '
                               'registration'))
+    parser.add_argument('--registration', required=False, default='flirt',
+                        choices=REGISTRATIONS,
+                        help=('Whether images are registered to the MNI152 '
+                              'template by FLIRT, or in-process without '
+                              'FSL (native)'))
+    parser.add_argument('--intermediate_format', required=False,
+                        default='nii', type=str,
+                        help=('Format of the intermediate images, as '
+                              'suffix[:level[:threads]], e.g. nii (the '
+                              'default, uncompressed), nii.gz:1 or '
+                              'nii.gz:1:4. Cropped images are always '
+                              'compressed'))
+    parser.add_argument('--telemetry', required=False, default=None,
+                        help=('Optional JSON lines file where the time, CPU, '
+                              'memory and I/O of every stage are recorded '
+                              'for every subject'))
+    parser.add_argument('--dry_run', action='store_true',
+                        help=('If set, nothing is run. Instead, the number '
+                              'of subjects each stage has left and the time '
+                              'they are estimated to take are printed, '
+                              'based on the telemetry file or the records '
+                              'of earlier runs'))
+    parser.add_argument('-y', '--retries', required=False, default=0,
+                        type=int, help=('Number of times a failed '
+                                        'preprocessing job is retried'))
+    parser.add_argument('-x', '--free_intermediates', action='store_true',
+                        help=('If set, the intermediates of a subject are '
+                              'removed as soon as the next stage is done '
+                              'with them. Cropped images are kept'))
+    parser.add_argument('--scratch_limit', required=False, default=None,
+                        type=int, help=('If set, no new subjects are started '
+                                        'while the intermediates of the '
+                                        'subjects in progress hold more '
+                                        'than this many megabytes'))
+    parser.add_argument('--recon_threads', required=False, default=1,
+                        type=int, help=('Number of OpenMP threads used by '
+                                        'each recon-all job'))
+    parser.add_argument('--recon_memory', required=False, default=0,
+                        type=int, help=('Megabytes of memory reserved for '
+                                        'each recon-all job. A job is only '
+                                        'started when its threads and memory '
+                                        'fit in what the host has left'))
     args = parser.parse_args()
 
-    preprocess_and_predict_brain_age(folder=args.folder,
-                                     model_name=args.model_name, 
-                                     weights=args.weights, 
-                                     batch_size=args.batch_size,
-                                     threads=args.threads, 
-                                     normalize=args.normalize,
-                                     destination=args.destination,
-                                     temporary_folder=args.temp_folder,
-                                     remove_temporary_folders=\
-                                         args.remove_temporary_folders,
-                                     verbose=args.verbose,
-                                     mni152_template=args.mni152_template)
\ No newline at end of file
+    if args.dry_run:
+        plan(folder=args.folder, temporary_folder=args.temp_folder,
+             mni152_template=args.mni152_template, threads=args.threads,
+             registration=args.registration,
+             intermediate_format=args.intermediate_format,
+             telemetry=[args.telemetry] if args.telemetry is not None \
+                       else None)
+    else:
+        preprocess_and_predict_brain_age(folder=args.folder,
+                                         model_name=args.model_name, 
+                                         weights=args.weights, 
+                                         batch_size=args.batch_size,
+                                         threads=args.threads, 
+                                         normalize=args.normalize,
+                                         destination=args.destination,
+                                         temporary_folder=args.temp_folder,
+                                         remove_temporary_folders=\
+                                             args.remove_temporary_folders,
+                                         verbose=args.verbose,
+                                         mni152_template=args.mni152_template,
+                                         retries=args.retries,
+                                         recon_threads=args.recon_threads,
+                                         recon_memory=\
+                                             args.recon_memory * 2**20,
+                                         free_intermediates=\
+                                             args.free_intermediates,
+                                         scratch_limit=\
+                                             args.scratch_limit * 2**20 \
+                                             if args.scratch_limit \
+                                             is not None else None,
+                                         registration=args.registration,
+                                         intermediate_format=\
+                                             args.intermediate_format,
+                                         telemetry=args.telemetry)
\ No newline at end of file
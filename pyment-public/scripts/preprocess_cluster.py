@@ -0,0 +1,279 @@
+import argparse
+import logging
+import os
+import socket
+
+from contextlib import ExitStack
+from shutil import which
+from time import sleep
+from typing import Dict, Iterator
+
+from pyment.utils import configure_telemetry
+from pyment.utils.preprocessing import FileWorkQueue, JobRecord, LeaseLost, \
+                                       Pipeline
+from preprocess_and_predict_brain_age import build_stages, plan, \
+                                             REGISTRATIONS
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _images(folder: str):
+    return {filename.split('.')[0]: os.path.join(folder, 'images', filename) \
+            for filename in sorted(os.listdir(os.path.join(folder,
+                                                           'images')))}
+
+def submit(*, queue: str, folder: str):
+    added = FileWorkQueue(queue).submit(list(_images(folder).keys()))
+
+    print(f'Added {added} subjects to {queue}')
+
+def work(*, queue: str, folder: str, temporary_folder: str,
+         mni152_template: str, threads: int = None, verbose: bool = False,
+         recon_threads: int = 1, recon_memory: int = 0,
+         free_intermediates: bool = False, lease_timeout: float = 600,
+         retries: int = 0, poll_interval: float = 30,
+         registration: str = 'flirt', intermediate_format: str = 'nii',
+         telemetry: str = None):
+    configure_telemetry(telemetry)
+
+    tools = ['recon-all', 'flirt'] if registration == 'flirt' \
+            else ['recon-all']
+
+    for tool in tools:
+        assert which(tool) is not None, ('Unable to locate required tool '
+                                         f'\'{tool}\'')
+
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    workqueue = FileWorkQueue(queue, lease_timeout=lease_timeout,
+                              retries=retries)
+    stages = build_stages(images=_images(folder),
+                          temporary_folder=temporary_folder,
+                          mni152_template=mni152_template, threads=threads,
+                          verbose=verbose, recon_threads=recon_threads,
+                          recon_memory=recon_memory,
+                          registration=registration,
+                          intermediate_format=intermediate_format,
+                          shard=worker)
+    # Every worker keeps its own records and manifests, as appending to the
+    # same file from several nodes is not safe on all shared filesystems
+    pipeline = Pipeline(stages,
+                        records=os.path.join(temporary_folder, 'records',
+                                             worker),
+                        free_intermediates=free_intermediates)
+
+    logger.info(f'Started worker {worker}')
+
+    leases = {}
+    lost = set()
+
+    def lose(name: str) -> None:
+        lost.add(name)
+        pipeline.cancel(name)
+
+    # Subjects are claimed one at a time, whenever the pipeline has room
+    # for another
+    def claims() -> Iterator[str]:
+        while True:
+            workqueue.recover()
+
+            name = workqueue.claim(worker)
+
+            if name is not None:
+                # The subject may have been recorded by another worker that
+                # lost its lease
+                for stage in stages:
+                    stage.manifest.reload()
+
+                leases[name] = ExitStack()
+                leases[name].enter_context(
+                    workqueue.keep_alive(name,
+                                         on_lost=lambda name=name: lose(name))
+                )
+
+                yield name
+            elif workqueue.is_finished():
+                return
+            else:
+                # Other workers are still busy, and their leases may expire
+                sleep(poll_interval)
+
+    def finish(name: str, records: Dict[str, JobRecord]) -> None:
+        leases.pop(name).close()
+
+        # The subject may already be claimed by another worker
+        if name in lost:
+            logger.warning(f'Stopped {name} after losing its lease')
+
+            return
+
+        failed = {stage: record.error for stage, record in records.items() \
+                  if record.status == 'failed'}
+
+        try:
+            if len(failed) > 0:
+                workqueue.fail(name, error=str(failed))
+            else:
+                workqueue.complete(name)
+        except LeaseLost as e:
+            logger.warning(str(e))
+
+    pipeline.run(claims(), max_subjects=threads or 1, on_done=finish)
+
+    logger.info(f'Worker {worker} found no more work')
+
+def status(*, queue: str):
+    workqueue = FileWorkQueue(queue)
+    counts = workqueue.status()
+    total = sum(counts.values())
+
+    print((f'{counts["done"]}/{total} done, {counts["leases"]} running, '
+           f'{counts["pending"]} pending, {counts["failed"]} failed'))
+
+    for name, lease in workqueue.leases().items():
+        print(f'  {name}: {lease["worker"]} ({lease["age"]:.0f}s since '
+              'heartbeat)')
+
+    for name, error in workqueue.errors().items():
+        print(f'  {name} failed: {error}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Preprocesses images with workers on '
+                                      'any number of machines sharing a '
+                                      'filesystem. Subjects are submitted to '
+                                      'a queue folder, claimed by workers, '
+                                      'and put back if a worker stops '
+                                      'renewing its claim'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = subparsers.add_parser('submit', help=('Adds the subjects '
+                                                          'of a folder to the '
+                                                          'queue'))
+    submit_parser.add_argument('-q', '--queue', required=True,
+                               help='Folder of the queue')
+    submit_parser.add_argument('-f', '--folder', required=True,
+                               help=('Folder containing images in a '
+                                     'subfolder \'images\''))
+
+    work_parser = subparsers.add_parser('work', help=('Processes subjects '
+                                                      'from the queue until '
+                                                      'it is empty'))
+    work_parser.add_argument('-q', '--queue', required=True,
+                             help='Folder of the queue')
+    work_parser.add_argument('-f', '--folder', required=True,
+                             help=('Folder containing images in a subfolder '
+                                   '\'images\''))
+    work_parser.add_argument('-e', '--temp_folder', required=True,
+                             help=('Shared folder where preprocessed images '
+                                   'are stored'))
+    work_parser.add_argument('-i', '--mni152_template', required=True,
+                             help=('Path to MNI152 template used for FLIRT '
+                                   'registration'))
+    work_parser.add_argument('--registration', required=False,
+                             default='flirt', choices=REGISTRATIONS,
+                             help=('Whether images are registered to the '
+                                   'MNI152 template by FLIRT, or in-process '
+                                   'without FSL (native)'))
+    work_parser.add_argument('--intermediate_format', required=False,
+                             default='nii', type=str,
+                             help=('Format of the intermediate images, as '
+                                   'suffix[:level[:threads]], e.g. nii (the '
+                                   'default, uncompressed), nii.gz:1 or '
+                                   'nii.gz:1:4'))
+    work_parser.add_argument('--telemetry', required=False, default=None,
+                             help=('Optional JSON lines file where the time, '
+                                   'CPU, memory and I/O of every stage are '
+                                   'recorded. Can be shared by all workers'))
+    work_parser.add_argument('-t', '--threads', required=False, default=None,
+                             type=int, help=('Number of subjects claimed and '
+                                             'processed in parallel by the '
+                                             'worker'))
+    work_parser.add_argument('-v', '--verbose', action='store_true',
+                             help=('If set, logs from underlying processes '
+                                   '(e.g. FreeSurfer) are shown'))
+    work_parser.add_argument('-x', '--free_intermediates',
+                             action='store_true',
+                             help=('If set, the intermediates of a subject '
+                                   'are removed as soon as the next stage is '
+                                   'done with them'))
+    work_parser.add_argument('--recon_threads', required=False, default=1,
+                             type=int, help=('Number of OpenMP threads used '
+                                             'by each recon-all job'))
+    work_parser.add_argument('--recon_memory', required=False, default=0,
+                             type=int, help=('Megabytes of memory reserved '
+                                             'for each recon-all job'))
+    work_parser.add_argument('-l', '--lease_timeout', required=False,
+                             default=600, type=float,
+                             help=('Seconds without a heartbeat after which '
+                                   'the claim of a worker is considered '
+                                   'abandoned'))
+    work_parser.add_argument('-y', '--retries', required=False, default=0,
+                             type=int, help=('Number of times a failed '
+                                             'subject is put back in the '
+                                             'queue'))
+    work_parser.add_argument('-p', '--poll_interval', required=False,
+                             default=30, type=float,
+                             help=('Seconds to wait before checking the '
+                                   'queue again when no subjects are '
+                                   'pending'))
+
+    status_parser = subparsers.add_parser('status', help=('Reports the '
+                                                          'progress of the '
+                                                          'queue'))
+    status_parser.add_argument('-q', '--queue', required=True,
+                               help='Folder of the queue')
+
+    plan_parser = subparsers.add_parser('plan', help=('Reports the stages '
+                                                      'left for each subject '
+                                                      'and the estimated '
+                                                      'time, without running '
+                                                      'anything'))
+    plan_parser.add_argument('-f', '--folder', required=True,
+                             help=('Folder containing images in a subfolder '
+                                   '\'images\''))
+    plan_parser.add_argument('-e', '--temp_folder', required=True,
+                             help=('Shared folder where preprocessed images '
+                                   'are stored'))
+    plan_parser.add_argument('-i', '--mni152_template', required=True,
+                             help='Path to the MNI152 template')
+    plan_parser.add_argument('--registration', required=False,
+                             default='flirt', choices=REGISTRATIONS,
+                             help='Registration used by the workers')
+    plan_parser.add_argument('--intermediate_format', required=False,
+                             default='nii', type=str,
+                             help='Format of the intermediate images')
+    plan_parser.add_argument('-t', '--threads', required=False, default=None,
+                             type=int, help=('Number of subjects processed '
+                                             'in parallel, summed over all '
+                                             'workers'))
+    plan_parser.add_argument('--telemetry', required=False, default=None,
+                             nargs='+', help=('Telemetry files of earlier '
+                                              'runs. If not given, the '
+                                              'records of the workers are '
+                                              'used'))
+
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        submit(queue=args.queue, folder=args.folder)
+    elif args.command == 'work':
+        work(queue=args.queue, folder=args.folder,
+             temporary_folder=args.temp_folder,
+             mni152_template=args.mni152_template, threads=args.threads,
+             verbose=args.verbose, recon_threads=args.recon_threads,
+             recon_memory=args.recon_memory * 2**20,
+             free_intermediates=args.free_intermediates,
+             lease_timeout=args.lease_timeout, retries=args.retries,
+             poll_interval=args.poll_interval,
+             registration=args.registration,
+             intermediate_format=args.intermediate_format,
+             telemetry=args.telemetry)
+    elif args.command == 'status':
+        status(queue=args.queue)
+    elif args.command == 'plan':
+        plan(folder=args.folder, temporary_folder=args.temp_folder,
+             mni152_template=args.mni152_template, threads=args.threads,
+             registration=args.registration,
+             intermediate_format=args.intermediate_format,
+             telemetry=args.telemetry)
@@ -0,0 +1,78 @@
+import argparse
+import logging
+import pandas as pd
+
+from typing import List
+
+from pyment.utils import load_telemetry, summarize_telemetry
+
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def summarize(*, paths: List[str], slowest: int = 5,
+              stages: List[str] = None,
+              destination: str = None) -> pd.DataFrame:
+    events = load_telemetry(paths)
+
+    if len(events) == 0:
+        logger.warning(f'No telemetry events found in {paths}')
+        return pd.DataFrame()
+
+    if stages is not None:
+        events = events[events['stage'].isin(stages)]
+
+    summary = summarize_telemetry(events)
+
+    print(summary.to_string(index=False, float_format='{:.1f}'.format))
+
+    done = events[(events['status'] == 'success') & \
+                  events['subject'].notna()]
+
+    for stage, group in done.groupby('stage', sort=False):
+        group = group.sort_values('wall_time', ascending=False)
+        group = group.head(slowest)
+        median = summary.loc[summary['stage'] == stage, 'p50'].values[0]
+
+        print(f'\nSlowest subjects in {stage} (median {median:.1f}s):')
+
+        for _, event in group.iterrows():
+            print((f'  {event["subject"]}: {event["wall_time"]:.1f}s, '
+                   f'{event["cpu_time"]:.1f}s CPU, '
+                   f'{event["peak_rss"] / 2**20:.0f}MB peak'))
+
+    failed = events[events['status'] == 'failed']
+
+    if len(failed) > 0:
+        print('\nFailures:')
+
+        for _, event in failed.iterrows():
+            error = event['error'] if 'error' in event else None
+            print(f'  {event["stage"]} for {event["subject"]}: {error}')
+
+    if destination is not None:
+        summary.to_csv(destination, index=False)
+
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Summarizes telemetry written by the '
+                                      'preprocessing and prediction scripts '
+                                      'into per-stage throughput, wall time '
+                                      'percentiles and the slowest subjects'))
+
+    parser.add_argument('paths', nargs='+',
+                        help='One or more telemetry files')
+    parser.add_argument('-k', '--slowest', required=False, default=5,
+                        type=int, help=('Number of slowest subjects shown for '
+                                        'each stage'))
+    parser.add_argument('-s', '--stages', required=False, default=None,
+                        nargs='+', help='Only summarize the given stages')
+    parser.add_argument('-d', '--destination', required=False, default=None,
+                        help='Optional path where the summary is stored')
+
+    args = parser.parse_args()
+
+    summarize(paths=args.paths, slowest=args.slowest, stages=args.stages,
+              destination=args.destination)
@@ -0,0 +1,116 @@
+import numpy as np
+
+from pyment.data import BatchAugmenter
+from pyment.models import RegressionSFCN
+from tensorflow.keras import Model as KerasModel
+
+
+def test_batch_augmenter_length():
+    augmenter = BatchAugmenter(['identity', 'flip', 'shift:1,0,0'])
+
+    assert 3 == len(augmenter), ('BatchAugmenter does not report the correct '
+                                 'number of augmentations')
+
+def test_batch_augmenter_invalid_augmentation():
+    exception = False
+
+    try:
+        BatchAugmenter(['rotate'])
+    except ValueError:
+        exception = True
+
+    assert exception, ('BatchAugmenter does not raise an error for an '
+                       'unknown augmentation')
+
+def test_batch_augmenter_augment_shape():
+    X = np.random.uniform(size=(3, 4, 5, 6))
+    augmenter = BatchAugmenter(['identity', 'flip', 'flip:2'])
+
+    augmented = augmenter.augment(X)
+
+    assert (9, 4, 5, 6) == augmented.shape, ('BatchAugmenter.augment does not '
+                                             'return an enlarged batch')
+
+def test_batch_augmenter_augment_consecutive():
+    X = np.random.uniform(size=(2, 4, 5, 6))
+    augmenter = BatchAugmenter(['identity', 'flip'])
+
+    augmented = augmenter.augment(X)
+
+    assert np.array_equal(X[1], augmented[2]), ('BatchAugmenter.augment does '
+                                                'not store the copies of each '
+                                                'image consecutively')
+    assert np.array_equal(X[1, ::-1], augmented[3]), ('BatchAugmenter.augment '
+                                                      'does not flip along the '
+                                                      'first image axis')
+
+def test_batch_augmenter_shift():
+    X = np.reshape(np.arange(2 * 4 * 4 * 4), (2, 4, 4, 4)).astype(float)
+    augmenter = BatchAugmenter(['shift:1,-1,0'])
+
+    augmented = augmenter.augment(X)
+
+    assert np.array_equal(X[:, :-1, 1:], augmented[:, 1:, :-1]), \
+           'BatchAugmenter does not shift images by the given offsets'
+    assert 0 == np.sum(augmented[:, 0]), ('BatchAugmenter does not zero '
+                                          'voxels shifted in from outside '
+                                          'the volume')
+    assert 0 == np.sum(augmented[:, :, -1]), ('BatchAugmenter does not zero '
+                                              'voxels shifted in from outside '
+                                              'the volume')
+
+def test_batch_augmenter_reduce():
+    predictions = np.asarray([[1.], [3.], [5.], [9.]])
+    augmenter = BatchAugmenter(['identity', 'flip'])
+
+    reduced = augmenter.reduce(predictions)
+
+    assert np.array_equal([[2.], [7.]], reduced), ('BatchAugmenter.reduce '
+                                                   'does not average the '
+                                                   'predictions per image')
+
+def test_batch_augmenter_reduce_median():
+    predictions = np.asarray([1., 2., 9., 4., 4., 0.])
+    augmenter = BatchAugmenter(['identity', 'flip', 'flip:1'],
+                               reduction='median')
+
+    reduced = augmenter.reduce(predictions)
+
+    assert np.array_equal([2., 4.], reduced), ('BatchAugmenter.reduce does not '
+                                               'use the median reduction')
+
+def test_model_predict_augmenter():
+    model = RegressionSFCN(input_shape=(32, 32, 32), prediction_range=None)
+    X = np.random.uniform(size=(2, 32, 32, 32)).astype(np.float32)
+    augmenter = BatchAugmenter(['identity', 'flip'])
+
+    predictions = model.predict(X, augmenter=augmenter)
+    expected = (model.predict(X) + model.predict(X[:, ::-1].copy())) / 2
+
+    assert (2, 1) == predictions.shape, ('Model.predict with an augmenter '
+                                         'does not return one prediction '
+                                         'per image')
+    assert np.allclose(expected, predictions, atol=1e-5), \
+           ('Model.predict with an augmenter does not average predictions '
+            'over the augmented copies')
+
+
+def test_model_predict_augmenter_batch_size(monkeypatch):
+    model = RegressionSFCN(input_shape=(32, 32, 32), prediction_range=None)
+    X = np.random.uniform(size=(2, 32, 32, 32)).astype(np.float32)
+    augmenter = BatchAugmenter(['identity', 'flip'])
+    batch_sizes = []
+    predict = KerasModel.predict
+
+    def recording_predict(self, X, **kwargs):
+        batch_sizes.append(kwargs.get('batch_size'))
+        return predict(self, X, **kwargs)
+
+    monkeypatch.setattr(KerasModel, 'predict', recording_predict)
+
+    model.predict(X, augmenter=augmenter)
+    model.predict(X, augmenter=augmenter, batch_size=1)
+
+    assert [4, 2] == batch_sizes, ('Model.predict with an augmenter does '
+                                   'not scale the batch size by the number '
+                                   'of augmentations')
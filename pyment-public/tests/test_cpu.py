@@ -0,0 +1,60 @@
+import os
+
+from threading import Thread
+
+from pyment.utils import numa_nodes, parse_cpulist, pin_current_thread, \
+                         resolve_cpus
+
+
+def test_parse_cpulist():
+    cpus = parse_cpulist('0-3,8,10-11\n')
+
+    assert [0, 1, 2, 3, 8, 10, 11] == cpus, ('parse_cpulist does not parse '
+                                             'ranges and single CPUs')
+
+def test_numa_nodes():
+    nodes = numa_nodes()
+
+    assert 0 < len(nodes), 'numa_nodes does not return any nodes'
+    assert all([len(cpus) > 0 for cpus in nodes.values()]), \
+           'numa_nodes returns a node without CPUs'
+
+def test_resolve_cpus_numa():
+    nodes = numa_nodes()
+    node = list(nodes.keys())[0]
+
+    assert nodes[node] == resolve_cpus(f'numa:{node}'), \
+           'resolve_cpus does not resolve NUMA nodes'
+
+def test_resolve_cpus_invalid_numa():
+    exception = False
+
+    try:
+        resolve_cpus('numa:10000')
+    except ValueError:
+        exception = True
+
+    assert exception, ('resolve_cpus does not raise an error for a '
+                       'non-existing NUMA node')
+
+def test_resolve_cpus_none():
+    assert resolve_cpus(None) is None, 'resolve_cpus does not pass on None'
+
+def test_pin_current_thread():
+    cpu = sorted(os.sched_getaffinity(0))[0]
+    affinity = {}
+
+    def pin():
+        pin_current_thread([cpu])
+        affinity['thread'] = os.sched_getaffinity(0)
+
+    before = os.sched_getaffinity(0)
+    thread = Thread(target=pin)
+    thread.start()
+    thread.join()
+
+    assert {cpu} == affinity['thread'], ('pin_current_thread does not pin '
+                                         'the calling thread')
+    assert before == os.sched_getaffinity(0), ('pin_current_thread changes '
+                                               'the affinity of other '
+                                               'threads')
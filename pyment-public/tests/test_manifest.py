@@ -0,0 +1,329 @@
+import os
+import nibabel as nib
+import numpy as np
+import pytest
+
+from mock import patch
+from shutil import rmtree
+
+from pyment.utils.preprocessing import atomic_output, crop_folder, \
+                                       crop_mri, list_images, Manifest
+
+
+def _create_images(folder: str, n: int = 3):
+    os.makedirs(folder)
+
+    for i in range(n):
+        img = nib.Nifti1Image(np.random.uniform(size=(10, 10, 10)),
+                              affine=np.eye(4))
+        nib.save(img, os.path.join(folder, f'sub{i}.nii.gz'))
+
+def test_atomic_output():
+    try:
+        os.mkdir('tmp')
+        path = os.path.join('tmp', 'out.txt')
+
+        with atomic_output(path) as partial:
+            assert not os.path.exists(path), ('atomic_output creates the '
+                                              'output before the block is '
+                                              'finished')
+            assert f'-{os.getpid()}-' in os.path.basename(partial), \
+                   'atomic_output does not make partial outputs unique'
+
+            with open(partial, 'w') as f:
+                f.write('test')
+
+        assert os.path.isfile(path), 'atomic_output does not move the output'
+
+        with pytest.raises(RuntimeError):
+            with atomic_output(os.path.join('tmp', 'failed.txt')) as partial:
+                with open(partial, 'w') as f:
+                    f.write('half')
+
+                raise RuntimeError()
+
+        assert ['out.txt'] == os.listdir('tmp'), ('atomic_output leaves '
+                                                  'partial outputs behind')
+    finally:
+        rmtree('tmp')
+
+def test_manifest_skips_current_subjects():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        _create_images(src)
+
+        records = crop_folder(src, dest, bounds=((1, 9), (1, 9), (1, 9)))
+
+        assert 3 == len(records), 'crop_folder does not crop every image'
+        assert 3 == len(Manifest(dest)), ('crop_folder does not record '
+                                          'outputs in the manifest')
+        assert ['sub0.nii.gz', 'sub1.nii.gz', 'sub2.nii.gz'] == \
+               list_images(dest), ('crop_folder leaves extra files in the '
+                                   'destination')
+
+        records = crop_folder(src, dest, bounds=((1, 9), (1, 9), (1, 9)))
+
+        assert 0 == len(records), 'crop_folder recomputes current subjects'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_recomputes_changed_params():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        _create_images(src)
+
+        crop_folder(src, dest, bounds=((1, 9), (1, 9), (1, 9)))
+        records = crop_folder(src, dest, bounds=((2, 8), (2, 8), (2, 8)))
+
+        assert 3 == len(records), ('crop_folder does not recompute subjects '
+                                   'when the parameters change')
+        assert (6, 6, 6) == nib.load(os.path.join(dest, 'sub0.nii.gz')).shape, \
+               'crop_folder does not replace stale outputs'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_recomputes_changed_inputs():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src)
+
+        crop_folder(src, dest, bounds=bounds)
+
+        img = nib.Nifti1Image(np.zeros((10, 10, 10)), affine=np.eye(4))
+        nib.save(img, os.path.join(src, 'sub1.nii.gz'))
+
+        # Touching a file without changing it does not invalidate it
+        os.utime(os.path.join(src, 'sub0.nii.gz'))
+
+        records = crop_folder(src, dest, bounds=bounds)
+
+        assert ['sub1'] == [r.name for r in records], \
+               'crop_folder does not recompute exactly the changed subjects'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_recomputes_damaged_outputs():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src)
+
+        crop_folder(src, dest, bounds=bounds)
+
+        with open(os.path.join(dest, 'sub2.nii.gz'), 'wb') as f:
+            f.write(b'half')
+
+        records = crop_folder(src, dest, bounds=bounds)
+
+        assert ['sub2'] == [r.name for r in records], \
+               'crop_folder does not recompute damaged outputs'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_removed_input_is_current():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src, n=1)
+
+        crop_folder(src, dest, bounds=bounds)
+
+        path = os.path.join(src, 'sub0.nii.gz')
+        output = os.path.join(dest, 'sub0.nii.gz')
+        manifest = Manifest(dest)
+
+        os.remove(path)
+
+        assert manifest.is_current('sub0', crop_mri, src=path, dest=output,
+                                   params={'bounds': bounds}), \
+               'Manifest does not keep outputs whose input was removed'
+    finally:
+        rmtree('tmp')
+
+@patch('pyment.utils.preprocessing.crop.crop_mri')
+def test_manifest_failed_jobs_are_not_recorded(mock):
+    mock.__name__ = 'crop_mri'
+    mock.side_effect = RuntimeError('killed')
+
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        _create_images(src, n=1)
+
+        records = crop_folder(src, dest, bounds=((1, 9), (1, 9), (1, 9)))
+
+        assert 'failed' == records[0].status, ('crop_folder does not record '
+                                               'failed subjects')
+        assert 0 == len(Manifest(dest)), ('crop_folder records failed '
+                                          'subjects in the manifest')
+        assert [] == list_images(dest), ('crop_folder leaves outputs of '
+                                         'failed subjects')
+    finally:
+        rmtree('tmp')
+
+def test_manifest_workers():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src, n=4)
+
+        records = crop_folder(src, dest, bounds=bounds, workers=2)
+
+        assert all([r.succeeded for r in records]), \
+               'crop_folder with workers does not crop every image'
+        assert 4 == len(Manifest(dest)), ('crop_folder with workers does not '
+                                          'record outputs in the manifest')
+        assert 0 == len(crop_folder(src, dest, bounds=bounds, workers=2)), \
+               'crop_folder with workers recomputes current subjects'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_ignores_truncated_lines():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src, n=2)
+
+        crop_folder(src, dest, bounds=bounds)
+
+        with open(os.path.join(dest, '.manifest.jsonl'), 'a') as f:
+            f.write('{"subject": "sub1", "to')
+
+        assert 2 == len(Manifest(dest)), ('Manifest does not ignore lines '
+                                          'cut short')
+        assert 0 == len(crop_folder(src, dest, bounds=bounds)), \
+               'A truncated manifest line invalidates current subjects'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_appends_after_truncated_lines():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src, n=2)
+
+        crop_folder(src, dest, bounds=bounds)
+
+        with open(os.path.join(dest, '.manifest.jsonl'), 'a') as f:
+            f.write('{"subject": "sub1", "to')
+
+        Manifest(dest).record('sub0', crop_mri,
+                              src=os.path.join(src, 'sub0.nii.gz'),
+                              dest=os.path.join(dest, 'sub0.nii.gz'),
+                              params={'bounds': bounds})
+
+        with open(os.path.join(dest, '.manifest.jsonl'), 'r') as f:
+            lines = f.readlines()
+
+        assert 4 == len(lines), ('Manifest appends to a line cut short')
+        assert 2 == len(Manifest(dest)), ('Manifest loses lines appended '
+                                          'after a line cut short')
+    finally:
+        rmtree('tmp')
+
+def test_manifest_is_compacted_explicitly():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src, n=2)
+
+        crop_folder(src, dest, bounds=bounds)
+        path = os.path.join(dest, '.manifest.jsonl')
+
+        with open(path, 'r') as f:
+            lines = f.readlines()
+
+        with open(path, 'a') as f:
+            f.writelines(lines)
+
+        manifest = Manifest(dest)
+
+        with open(path, 'r') as f:
+            assert 4 == len(f.readlines()), ('Manifest is compacted when '
+                                             'it is loaded')
+
+        # A subject recorded by another process after this one loaded the
+        # manifest
+        other = Manifest(dest)
+        other.entries = {}
+        other.record('sub2', crop_mri, src=os.path.join(src, 'sub0.nii.gz'),
+                     dest=os.path.join(dest, 'sub0.nii.gz'),
+                     params={'bounds': bounds})
+
+        manifest.compact()
+
+        with open(path, 'r') as f:
+            assert 3 == len(f.readlines()), ('Manifest.compact does not drop '
+                                             'superseded lines')
+
+        assert 3 == len(Manifest(dest)), ('Manifest.compact drops lines '
+                                          'appended by other processes')
+        assert 3 == len(manifest), ('Manifest.compact does not pick up '
+                                    'lines appended by other processes')
+        assert ['sub0.nii.gz', 'sub1.nii.gz'] == list_images(dest), \
+               'Manifest.compact leaves files in the folder'
+    finally:
+        rmtree('tmp')
+
+def test_manifest_shards():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        bounds = ((1, 9), (1, 9), (1, 9))
+        _create_images(src, n=2)
+
+        crop_folder(src, dest, bounds=bounds)
+
+        paths = lambda subject: {'src': os.path.join(src, f'{subject}.nii.gz'),
+                                 'dest': os.path.join(dest,
+                                                      f'{subject}.nii.gz')}
+        first = Manifest(dest, shard='first')
+        second = Manifest(dest, shard='second')
+
+        first.record('sub0', crop_mri, **paths('sub0'),
+                     params={'bounds': bounds})
+        second.record('sub0', crop_mri, **paths('sub0'),
+                      params={'bounds': ((2, 8), (2, 8), (2, 8))})
+
+        assert ['.manifest-first.jsonl', '.manifest-second.jsonl',
+                '.manifest.jsonl'] == \
+               sorted([f for f in os.listdir(dest) \
+                       if f.endswith('.jsonl')]), \
+               'Manifest does not record subjects in its own shard'
+
+        manifest = Manifest(dest)
+
+        assert 2 == len(manifest), 'Manifest does not read every shard'
+        assert not manifest.is_current('sub0', crop_mri, **paths('sub0'),
+                                       params={'bounds': bounds}), \
+               'Manifest does not take the latest record over all shards'
+
+        first.record('sub0', crop_mri, **paths('sub0'),
+                     params={'bounds': bounds})
+        manifest.reload()
+
+        assert manifest.is_current('sub0', crop_mri, **paths('sub0'),
+                                   params={'bounds': bounds}), \
+               'Manifest.reload does not read lines appended to other shards'
+
+        first.compact()
+
+        with open(os.path.join(dest, '.manifest-first.jsonl'), 'r') as f:
+            assert 1 == len(f.readlines()), ('Manifest.compact does not '
+                                             'compact its own shard')
+
+        with open(os.path.join(dest, '.manifest.jsonl'), 'r') as f:
+            assert 2 == len(f.readlines()), ('Manifest.compact rewrites the '
+                                             'shards of other processes')
+    finally:
+        rmtree('tmp')
@@ -0,0 +1,89 @@
+import numpy as np
+
+from pyment.models import RegressionSFCN
+from pyment.utils import auto_batch_size, available_memory, \
+                         estimate_sample_memory, find_batch_size, \
+                         parse_batch_size
+
+
+def test_available_memory():
+    assert 0 < available_memory(), ('available_memory does not return a '
+                                    'positive number of bytes')
+
+def test_estimate_sample_memory_input_dtype():
+    model = RegressionSFCN(input_shape=(32, 32, 32))
+
+    float32 = estimate_sample_memory(model, dtype='float32')
+    float64 = estimate_sample_memory(model, dtype='float64')
+
+    assert 32 ** 3 * 4 == float64 - float32, ('estimate_sample_memory does '
+                                              'not account for the input '
+                                              'dtype')
+
+def test_estimate_sample_memory_first_block():
+    model = RegressionSFCN(input_shape=(32, 32, 32))
+
+    memory = estimate_sample_memory(model)
+
+    assert 32 ** 3 * 32 * 4 * 2 <= memory, ('estimate_sample_memory does not '
+                                            'account for the first block')
+
+def test_estimate_sample_memory_training():
+    model = RegressionSFCN(input_shape=(32, 32, 32))
+
+    inference = estimate_sample_memory(model)
+    training = estimate_sample_memory(model, training=True)
+
+    assert inference < training, ('estimate_sample_memory does not estimate '
+                                  'more memory for training')
+
+def test_parse_batch_size():
+    assert 'auto' == parse_batch_size('auto'), \
+           'parse_batch_size does not keep auto'
+    assert 8 == parse_batch_size('8'), \
+           'parse_batch_size does not parse integers'
+
+def test_auto_batch_size():
+    batch_size = auto_batch_size(100, available=1000, fraction=.5)
+
+    assert 5 == batch_size, 'auto_batch_size does not use the given fraction'
+
+def test_auto_batch_size_maximum():
+    batch_size = auto_batch_size(1, available=1000, maximum=8)
+
+    assert 8 == batch_size, 'auto_batch_size does not respect the maximum'
+
+def test_auto_batch_size_minimum():
+    batch_size = auto_batch_size(10000, available=1000)
+
+    assert 1 == batch_size, 'auto_batch_size returns a batch size below 1'
+
+def test_find_batch_size_backs_off():
+    attempts = []
+
+    def trial(batch_size):
+        attempts.append(batch_size)
+
+        if batch_size > 5:
+            raise MemoryError()
+
+    batch_size = find_batch_size(trial, 16)
+
+    assert 4 == batch_size, ('find_batch_size does not halve the batch size '
+                             'when the trial fails')
+    assert [16, 8, 4] == attempts, ('find_batch_size does not retry with '
+                                    'halved batch sizes')
+
+def test_find_batch_size_raises():
+    def trial(batch_size):
+        raise MemoryError()
+
+    exception = False
+
+    try:
+        find_batch_size(trial, 4)
+    except MemoryError:
+        exception = True
+
+    assert exception, ('find_batch_size does not raise when a batch size of '
+                       '1 fails')
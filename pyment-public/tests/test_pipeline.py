@@ -0,0 +1,466 @@
+import os
+import pandas as pd
+import pytest
+
+from shutil import rmtree
+from threading import Event, Lock
+from time import sleep
+from typing import List
+
+from pyment.utils.preprocessing import Manifest, Pipeline, Stage
+
+
+def test_pipeline_runs_stages_in_order():
+    calls = []
+    stages = [Stage(name, lambda subject, name=name: \
+                    calls.append((subject, name))) \
+              for name in ['a', 'b', 'c']]
+
+    records = Pipeline(stages).run(['sub0', 'sub1'])
+
+    for subject in ['sub0', 'sub1']:
+        order = [name for s, name in calls if s == subject]
+
+        assert ['a', 'b', 'c'] == order, ('Pipeline does not run stages in '
+                                          'order for each subject')
+        assert all([records[subject][name].succeeded \
+                    for name in ['a', 'b', 'c']]), \
+               'Pipeline does not record successful stages'
+
+def test_pipeline_streams_subjects():
+    # Without stage barriers sub1 reaches the last stage while sub0 is
+    # still in the first
+    released = Event()
+
+    def first(subject: str):
+        if subject == 'sub0':
+            released.wait(timeout=5)
+
+    stages = [
+        Stage('first', first, concurrency=2),
+        Stage('last', lambda subject: released.set() \
+                                      if subject == 'sub1' else None)
+    ]
+
+    records = Pipeline(stages).run(['sub0', 'sub1'])
+
+    assert released.is_set(), ('Pipeline waits for all subjects before '
+                               'starting the next stage')
+    assert records['sub0']['last'].succeeded, \
+           'Pipeline does not finish the slow subject'
+
+def test_pipeline_dependencies():
+    calls = []
+    lock = Lock()
+
+    def record(subject: str, name: str):
+        with lock:
+            calls.append(name)
+
+    stages = [
+        Stage('a', lambda subject: record(subject, 'a')),
+        Stage('b', lambda subject: record(subject, 'b'), dependencies=['a']),
+        Stage('c', lambda subject: record(subject, 'c'), dependencies=['a']),
+        Stage('d', lambda subject: record(subject, 'd'),
+              dependencies=['b', 'c'])
+    ]
+
+    Pipeline(stages).run(['sub0'])
+
+    assert 'a' == calls[0], 'Pipeline does not run roots first'
+    assert 'd' == calls[-1], ('Pipeline runs a stage before all its '
+                              'dependencies are done')
+    assert 4 == len(calls), 'Pipeline runs a stage more than once'
+
+def test_pipeline_invalid_dependency():
+    stages = [Stage('a', print), Stage('b', print, dependencies=['c'])]
+
+    with pytest.raises(ValueError):
+        Pipeline(stages)
+
+def test_pipeline_skips_existing_outputs():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        os.mkdir(folder)
+
+        with open(os.path.join(folder, 'sub0'), 'w') as f:
+            f.write('')
+
+        calls = []
+        stages = [Stage('a', lambda subject: calls.append(subject),
+                        output=lambda subject: os.path.join(folder, subject))]
+
+        records = Pipeline(stages).run(['sub0', 'sub1'])
+
+        assert ['sub1'] == calls, ('Pipeline runs stages with existing '
+                                   'outputs')
+        assert 'skipped' == records['sub0']['a'].status, \
+               'Pipeline does not record skipped stages'
+    finally:
+        rmtree(folder)
+
+def test_pipeline_manifest_stage():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        os.mkdir(folder)
+        calls = []
+
+        def scale(src: str, dest: str, *, factor: int):
+            calls.append(os.path.basename(src))
+
+            with open(src, 'r') as f:
+                value = int(f.read())
+
+            with open(dest, 'w') as f:
+                f.write(str(value * factor))
+
+        for subject in ['sub0', 'sub1']:
+            with open(os.path.join(folder, f'in-{subject}'), 'w') as f:
+                f.write('1')
+
+        # An output left without a record, e.g. by an interrupted run
+        with open(os.path.join(folder, 'out-sub1'), 'w') as f:
+            f.write('')
+
+        def stages(factor: int) -> List[Stage]:
+            return [Stage('a', scale,
+                          input=lambda subject: \
+                              os.path.join(folder, f'in-{subject}'),
+                          output=lambda subject: \
+                              os.path.join(folder, f'out-{subject}'),
+                          params={'factor': factor},
+                          manifest=Manifest(folder))]
+
+        Pipeline(stages(2)).run(['sub0', 'sub1'])
+
+        assert ['in-sub0', 'in-sub1'] == sorted(calls), \
+               'Pipeline skips outputs that were never recorded'
+
+        with open(os.path.join(folder, 'out-sub1'), 'r') as f:
+            assert '2' == f.read(), 'Pipeline does not write the output'
+
+        calls.clear()
+        records = Pipeline(stages(2)).run(['sub0', 'sub1'])
+
+        assert [] == calls, 'Pipeline reruns stages with current outputs'
+        assert 'skipped' == records['sub0']['a'].status, \
+               'Pipeline does not record skipped stages'
+
+        with open(os.path.join(folder, 'in-sub0'), 'w') as f:
+            f.write('3')
+
+        Pipeline(stages(2)).run(['sub0', 'sub1'])
+
+        assert ['in-sub0'] == calls, ('Pipeline does not rerun stages whose '
+                                      'input changed')
+
+        calls.clear()
+        Pipeline(stages(3)).run(['sub0', 'sub1'])
+
+        assert ['in-sub0', 'in-sub1'] == sorted(calls), \
+               'Pipeline does not rerun stages whose parameters changed'
+        assert [] == [f for f in os.listdir(folder) \
+                      if f.startswith('.partial')], \
+               'Pipeline leaves partial outputs behind'
+    finally:
+        rmtree(folder)
+
+def test_stage_input_requires_manifest():
+    with pytest.raises(ValueError):
+        Stage('a', print, input=lambda subject: subject,
+              output=lambda subject: subject)
+
+def test_pipeline_failure_stops_subject():
+    calls = []
+
+    def fail(subject: str):
+        if subject == 'sub0':
+            raise RuntimeError('fail')
+
+    stages = [Stage('a', fail),
+              Stage('b', lambda subject: calls.append(subject))]
+    ready = []
+
+    records = Pipeline(stages, retries=1).run(['sub0', 'sub1'],
+                                              on_ready=ready.extend)
+
+    assert ['sub1'] == calls, ('Pipeline runs later stages for subjects '
+                               'that failed')
+    assert 'failed' == records['sub0']['a'].status, \
+           'Pipeline does not record failed stages'
+    assert 2 == records['sub0']['a'].attempts, \
+           'Pipeline does not retry failed stages'
+    assert 'b' not in records['sub0'], ('Pipeline records stages that never '
+                                        'ran')
+    assert ['sub1'] == ready, 'Pipeline passes failed subjects on'
+
+def test_pipeline_callback_failure_completes():
+    calls = []
+    stages = [Stage('a', lambda subject: None),
+              Stage('b', lambda subject: calls.append(subject))]
+    pipeline = Pipeline(stages)
+    execute = pipeline._execute
+
+    def failing_execute(subject, stage):
+        if subject == 'sub0' and stage.name == 'a':
+            raise RuntimeError('fail')
+
+        return execute(subject, stage)
+
+    pipeline._execute = failing_execute
+
+    records = pipeline.run(['sub0', 'sub1'])
+
+    assert 'failed' == records['sub0']['a'].status, \
+           'Pipeline does not record stages whose execution raised'
+    assert ['sub1'] == calls, ('Pipeline does not continue with other '
+                               'subjects when the execution of a stage '
+                               'raised')
+
+def test_pipeline_completion_failure_completes():
+    stages = [Stage('a', lambda subject: None),
+              Stage('b', lambda subject: None)]
+    pipeline = Pipeline(stages)
+
+    def failing_advance(subject, stage, records, freed):
+        raise RuntimeError('fail')
+
+    pipeline._advance = failing_advance
+
+    records = pipeline.run(['sub0'])
+
+    assert 'failed' == records['sub0']['a'].status, \
+           'Pipeline does not record stages whose completion raised'
+    assert 'b' not in records['sub0'], ('Pipeline continues a subject whose '
+                                        'completion raised')
+
+def test_pipeline_takes_subjects_when_there_is_room():
+    lock = Lock()
+    active = [0]
+    taken = []
+
+    def subjects():
+        for i in range(6):
+            with lock:
+                taken.append(active[0])
+                active[0] += 1
+
+            yield f'sub{i}'
+
+    def leave(subject: str, records):
+        with lock:
+            active[0] -= 1
+
+    stages = [Stage('a', lambda subject: sleep(0.02), concurrency=4),
+              Stage('b', lambda subject: None)]
+
+    records = Pipeline(stages).run(subjects(), max_subjects=2,
+                                   on_done=leave)
+
+    assert 6 == len(records), 'Pipeline does not run every subject'
+    assert max(taken) < 2, ('Pipeline takes new subjects while the maximum '
+                            'is in progress')
+
+def test_pipeline_on_done():
+    done = {}
+
+    def fail(subject: str):
+        if subject == 'sub0':
+            raise RuntimeError('fail')
+
+    stages = [Stage('a', fail), Stage('b', lambda subject: None)]
+
+    Pipeline(stages).run(['sub0', 'sub1'],
+                         on_done=lambda subject, records: \
+                             done.update({subject: list(records)}))
+
+    assert {'sub0': ['a'], 'sub1': ['a', 'b']} == done, \
+           ('Pipeline does not report every subject with its records when '
+            'nothing more runs for it')
+
+def test_pipeline_cancel():
+    calls = []
+    pipeline = Pipeline([Stage('a', lambda subject: pipeline.cancel(subject) \
+                                                    if subject == 'sub0' \
+                                                    else None),
+                         Stage('b', lambda subject: calls.append(subject))])
+
+    records = pipeline.run(['sub0', 'sub1'])
+
+    assert ['sub1'] == calls, 'Pipeline continues cancelled subjects'
+    assert 'b' not in records['sub0'], ('Pipeline records stages of '
+                                        'cancelled subjects that never ran')
+
+def test_pipeline_batches_ready_subjects():
+    batches = []
+    subjects = [f'sub{i}' for i in range(5)]
+
+    Pipeline([Stage('a', lambda subject: None)]).run(
+        subjects, on_ready=lambda batch: batches.append(list(batch)),
+        batch_size=2
+    )
+
+    assert [2, 2, 1] == [len(batch) for batch in batches], \
+           'Pipeline does not pass ready subjects on in batches'
+    assert subjects == sorted(sum(batches, [])), \
+           'Pipeline does not pass every subject on'
+
+def test_pipeline_stage_concurrency():
+    lock = Lock()
+    running = [0]
+    peaks = {'a': 0, 'b': 0}
+
+    def work(subject: str, name: str):
+        with lock:
+            running[0] += 1
+            peaks[name] = max(peaks[name], running[0])
+
+        sleep(0.02)
+
+        with lock:
+            running[0] -= 1
+
+    stages = [Stage('a', lambda subject: work(subject, 'a'), concurrency=3),
+              Stage('b', lambda subject: None)]
+
+    Pipeline(stages).run([f'sub{i}' for i in range(6)])
+
+    assert 1 < peaks['a'] <= 3, ('Pipeline does not respect the stage '
+                                 'concurrency')
+
+def test_pipeline_records():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        stages = [Stage('a', lambda subject: None),
+                  Stage('b', lambda subject: None)]
+
+        Pipeline(stages, records=folder).run(['sub0', 'sub1'])
+
+        df = pd.read_csv(os.path.join(folder, 'b.csv'))
+
+        assert ['sub0', 'sub1'] == sorted(df['name'].values), \
+               'Pipeline does not write a record for every subject'
+    finally:
+        rmtree(folder)
+
+def _file_stages(folder: str, names: List[str]) -> List[Stage]:
+    def write(subject: str, name: str):
+        with open(os.path.join(folder, f'{name}-{subject}'), 'w') as f:
+            f.write('x' * 100)
+
+    return [Stage(name, lambda subject, name=name: write(subject, name),
+                  output=lambda subject, name=name: \
+                      os.path.join(folder, f'{name}-{subject}')) \
+            for name in names]
+
+def test_pipeline_free_intermediates():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        os.mkdir(folder)
+        stages = _file_stages(folder, ['a', 'b', 'c'])
+
+        records = Pipeline(stages, free_intermediates=True).run(
+            ['sub0', 'sub1']
+        )
+
+        assert ['c-sub0', 'c-sub1'] == sorted(os.listdir(folder)), \
+               'Pipeline does not free intermediates'
+
+        calls = []
+        stages[0].func = lambda subject: calls.append(subject)
+        records = Pipeline(stages, free_intermediates=True).run(['sub0'])
+
+        assert [] == calls, ('Pipeline reruns stages whose intermediates '
+                             'were freed')
+        assert 'skipped' == records['sub0']['a'].status, \
+               'Pipeline does not skip stages whose intermediates were freed'
+    finally:
+        rmtree(folder)
+
+def test_pipeline_free_intermediates_after_failure():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        os.mkdir(folder)
+        stages = _file_stages(folder, ['a', 'b', 'c'])
+
+        def fail(subject: str):
+            raise RuntimeError('fail')
+
+        stages[2].func = fail
+
+        Pipeline(stages, free_intermediates=True).run(['sub0'])
+
+        assert [] == os.listdir(folder), ('Pipeline does not free '
+                                          'intermediates of failed subjects')
+    finally:
+        rmtree(folder)
+
+def test_pipeline_scratch_usage():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        os.mkdir(folder)
+        usage = []
+
+        # Files other than the intermediates of the subjects in progress
+        # are not counted
+        with open(os.path.join(folder, 'other'), 'w') as f:
+            f.write('x' * 1000)
+
+        stages = _file_stages(folder, ['a', 'b', 'c'])
+        pipeline = Pipeline(stages, scratch_limit=10**6)
+        write = stages[2].func
+
+        def measure(subject: str):
+            with pipeline._condition:
+                usage.append(pipeline._scratch_usage())
+
+            write(subject)
+
+        stages[2].func = measure
+
+        pipeline.run(['sub0'])
+
+        assert [200] == usage, ('Pipeline does not count exactly the '
+                                'intermediates of the subjects in progress')
+        assert 0 == pipeline._scratch_usage(), ('Pipeline counts '
+                                                'intermediates of subjects '
+                                                'that are done')
+    finally:
+        rmtree(folder)
+
+def test_pipeline_scratch_limit():
+    folder = os.path.join(os.path.dirname(__file__), 'tmp')
+
+    try:
+        os.mkdir(folder)
+        stages = _file_stages(folder, ['a', 'b'])
+        stages[1].concurrency = 4
+
+        records = Pipeline(stages, scratch_limit=50).run(
+            [f'sub{i}' for i in range(4)]
+        )
+
+        assert all([records[f'sub{i}']['b'].succeeded for i in range(4)]), \
+               'Pipeline does not finish subjects held back by the limit'
+    finally:
+        rmtree(folder)
+
+def test_pipeline_timings():
+    stages = [Stage('a', lambda subject: sleep(0.05)),
+              Stage('b', lambda subject: None)]
+    pipeline = Pipeline(stages)
+
+    pipeline.run(['sub0', 'sub1'])
+    timings = pipeline.timings()
+
+    assert 2 == timings['a']['subjects'], ('Pipeline does not time every '
+                                           'subject')
+    assert timings['a']['mean'] >= 0.05, 'Pipeline does not time stages'
+    assert timings['a']['total'] > timings['b']['total'], \
+           'Pipeline does not time stages separately'
@@ -0,0 +1,179 @@
+import os
+import numpy as np
+import pandas as pd
+
+from shutil import rmtree
+from unittest import mock
+
+from pyment.utils.preprocessing import FolderIndex, load_records, \
+                                       Manifest, Pipeline, Stage
+
+
+def _touch(path: str):
+    folder = os.path.dirname(path)
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    with open(path, 'w') as f:
+        f.write('')
+
+def _stages(root: str):
+    output = lambda name: lambda subject: os.path.join(root, name,
+                                                       f'{subject}.nii')
+
+    return [Stage(name, lambda subject: None, output=output(name),
+                  concurrency=2 if name == 'b' else 1) \
+            for name in ['a', 'b', 'c']]
+
+def test_folder_index():
+    try:
+        _touch(os.path.join('tmp', 'recon', 'sub0', 'mri', 'brainmask.mgz'))
+
+        index = FolderIndex()
+
+        assert index.exists(os.path.join('tmp', 'recon', 'sub0', 'mri',
+                                         'brainmask.mgz')), \
+               'FolderIndex does not find existing files'
+        assert not index.exists(os.path.join('tmp', 'recon', 'sub1', 'mri',
+                                             'brainmask.mgz')), \
+               'FolderIndex finds files that do not exist'
+
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            for i in range(10):
+                index.exists(os.path.join('tmp', 'recon', f'sub{i}', 'mri',
+                                          'brainmask.mgz'))
+
+            assert 0 == scandir.call_count, \
+                   'FolderIndex lists folders more than once'
+
+        path = os.path.join('tmp', 'recon', 'sub0', 'mri', 'brainmask.mgz')
+
+        assert os.stat(path).st_mtime_ns == index.stat(path).st_mtime_ns, \
+               'FolderIndex does not return the stat of existing files'
+        assert index.stat(os.path.join('tmp', 'recon', 'sub1')) is None, \
+               'FolderIndex returns a stat for files that do not exist'
+    finally:
+        rmtree('tmp')
+
+def test_plan_completion():
+    try:
+        for subject in ['sub0', 'sub1']:
+            _touch(os.path.join('tmp', 'a', f'{subject}.nii'))
+
+        # sub0 is done, with the intermediates of b freed
+        _touch(os.path.join('tmp', 'c', 'sub0.nii'))
+
+        calls = []
+        stages = _stages('tmp')
+
+        for stage in stages:
+            stage.func = lambda subject: calls.append(subject)
+
+        plan = Pipeline(stages).plan(['sub0', 'sub1', 'sub2'])
+
+        assert [] == calls, 'Pipeline.plan runs stages'
+        assert ['sub0'] == plan.complete, \
+               'Pipeline.plan does not find complete subjects'
+        assert ['sub1', 'sub2'] == plan.remaining['b'], \
+               'Pipeline.plan does not count freed stages as done'
+        assert ['sub2'] == plan.remaining['a'], \
+               'Pipeline.plan does not find remaining subjects'
+        assert np.isnan(plan.wall_time), \
+               'Pipeline.plan estimates time without history'
+    finally:
+        rmtree('tmp')
+
+def test_plan_reads_manifests_without_hashing():
+    try:
+        folder = 'tmp'
+        os.mkdir(folder)
+
+        def copy(src: str, dest: str) -> None:
+            with open(src, 'r') as f, open(dest, 'w') as g:
+                g.write(f.read())
+
+        for subject in ['sub0', 'sub1']:
+            _touch(os.path.join(folder, f'in-{subject}'))
+
+        stages = lambda manifest: [
+            Stage('a', copy,
+                  input=lambda subject: os.path.join(folder,
+                                                     f'in-{subject}'),
+                  output=lambda subject: os.path.join(folder,
+                                                      f'out-{subject}'),
+                  manifest=manifest)
+        ]
+
+        Pipeline(stages(Manifest(folder))).run(['sub0', 'sub1'])
+
+        # Touched without being changed
+        os.utime(os.path.join(folder, 'out-sub1'), ns=(0, 0))
+
+        path = os.path.join(folder, '.manifest.jsonl')
+        modified = os.stat(path).st_mtime_ns
+
+        with mock.patch('pyment.utils.preprocessing.manifest.hash_file') \
+             as hash_file:
+            plan = Pipeline(stages(Manifest(folder, read_only=True))) \
+                   .plan(['sub0', 'sub1'])
+
+            assert 0 == hash_file.call_count, 'Pipeline.plan hashes files'
+
+        assert ['sub0'] == plan.complete, ('Pipeline.plan does not compare '
+                                           'outputs by size and modification '
+                                           'time')
+        assert modified == os.stat(path).st_mtime_ns, \
+               'Pipeline.plan writes the manifest'
+    finally:
+        rmtree('tmp')
+
+def test_plan_estimates():
+    try:
+        _touch(os.path.join('tmp', 'a', 'sub0.nii'))
+
+        history = pd.DataFrame({
+            'stage': ['a', 'b', 'b', 'c', 'c'],
+            'status': ['success', 'success', 'success', 'success', 'failed'],
+            'wall_time': [10., 20., 40., 5., 1000.],
+            'cpu_time': [10., 20., 40., 5., 1000.]
+        })
+
+        plan = Pipeline(_stages('tmp')).plan(['sub0', 'sub1'],
+                                             history=history)
+        estimates = plan.estimates.set_index('stage')
+
+        assert 10 == estimates.loc['a', 'compute_time'], \
+               'Pipeline.plan does not estimate remaining compute'
+        assert 30 == estimates.loc['b', 'wall_time'], \
+               'Pipeline.plan does not account for stage concurrency'
+        assert 10 == estimates.loc['c', 'compute_time'], \
+               'Pipeline.plan uses failed runs for estimates'
+        assert 80 == plan.compute_time, \
+               'Pipeline.plan does not sum compute over stages'
+        assert 30 == plan.wall_time, \
+               'Pipeline.plan does not bound the run by the slowest stage'
+    finally:
+        rmtree('tmp')
+
+def test_plan_from_records():
+    try:
+        records = os.path.join('tmp', 'records')
+        Pipeline(_stages('tmp'), records=os.path.join(records, 'worker0')) \
+            .run(['sub0'])
+        _touch(os.path.join('tmp', 'a', 'sub0.nii'))
+
+        history = load_records(records)
+
+        assert ['a', 'b', 'c'] == sorted(history['stage'].unique()), \
+               'load_records does not read the records of workers'
+        assert ['sub0'] == list(history['subject'].unique()), \
+               'load_records does not read subjects'
+
+        plan = Pipeline(_stages('tmp')).plan(['sub0', 'sub1'],
+                                             history=history)
+
+        assert not np.isnan(plan.compute_time), \
+               'Pipeline.plan does not estimate from records'
+    finally:
+        rmtree('tmp')
@@ -0,0 +1,119 @@
+import gzip
+import os
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from shutil import rmtree
+
+from pyment.data import NiftiDataset, NiftiLoader
+from pyment.utils.preprocessing import crop_folder, ImageFormat, \
+                                       list_images, save_image
+
+
+def _create_image(shape=(10, 10, 10)) -> nib.Nifti1Image:
+    return nib.Nifti1Image(np.random.uniform(size=shape).astype(np.float32),
+                           affine=np.eye(4))
+
+def test_image_format_parse():
+    image_format = ImageFormat.parse('nii.gz:1:4')
+
+    assert image_format.compressed, 'ImageFormat does not parse compression'
+    assert 1 == image_format.level, ('ImageFormat does not parse the '
+                                     'compression level')
+    assert 4 == image_format.threads, 'ImageFormat does not parse threads'
+    assert 'nii.gz:1:4' == str(image_format), \
+           'ImageFormat does not describe itself as it was parsed'
+    assert '.nii' == ImageFormat.parse('nii').suffix, \
+           'ImageFormat does not parse uncompressed formats'
+
+def test_image_format_invalid():
+    for image_format in ['mgz', 'nii:1', 'nii.gz:0', 'nii.gz:1:0']:
+        with pytest.raises(ValueError):
+            ImageFormat.parse(image_format)
+
+def test_save_image_formats():
+    try:
+        os.mkdir('tmp')
+        img = _create_image()
+
+        for image_format in ['nii', 'nii.gz:1', 'nii.gz:9']:
+            path = os.path.join(
+                'tmp', ImageFormat.parse(image_format).filename('sub0')
+            )
+            save_image(img, path, image_format)
+
+            assert np.array_equal(img.get_fdata(),
+                                  nib.load(path).get_fdata()), \
+                   f'save_image does not store images as {image_format}'
+    finally:
+        rmtree('tmp')
+
+def test_save_image_threads():
+    try:
+        os.mkdir('tmp')
+        img = _create_image((40, 40, 40))
+        path = os.path.join('tmp', 'sub0.nii.gz')
+
+        ImageFormat(level=1, threads=4, chunk_size=2**14).save(img, path)
+
+        assert np.array_equal(img.get_fdata(), nib.load(path).get_fdata()), \
+               'Images compressed by several threads can not be read back'
+
+        with open(path, 'rb') as f:
+            assert img.to_bytes() == gzip.decompress(f.read()), \
+                   'Images compressed by several threads are not valid gzip'
+    finally:
+        rmtree('tmp')
+
+def test_crop_folder_image_format():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        os.makedirs(src)
+        nib.save(_create_image(), os.path.join(src, 'sub0.nii.gz'))
+
+        crop_folder(src, dest, bounds=((1, 9), (1, 9), (1, 9)),
+                    image_format='nii')
+
+        assert ['sub0.nii'] == list_images(dest), \
+               'crop_folder does not write outputs in the given format'
+
+        records = crop_folder(src, dest, bounds=((1, 9), (1, 9), (1, 9)),
+                              image_format='nii.gz:1')
+
+        assert 1 == len(records), ('crop_folder does not recompute subjects '
+                                   'when the format changes')
+    finally:
+        rmtree('tmp')
+
+def test_nifti_loader_resolves_suffix():
+    try:
+        os.mkdir('tmp')
+        img = _create_image()
+        nib.save(img, os.path.join('tmp', 'sub0.nii'))
+
+        data = NiftiLoader().load(os.path.join('tmp', 'sub0.nii.gz'))
+
+        assert np.array_equal(img.get_fdata(), data), \
+               'NiftiLoader does not find uncompressed images'
+    finally:
+        rmtree('tmp')
+
+def test_nifti_dataset_detects_suffix():
+    try:
+        os.makedirs(os.path.join('tmp', 'images'))
+        nib.save(_create_image(), os.path.join('tmp', 'images', 'sub0.nii'))
+        nib.save(_create_image(), os.path.join('tmp', 'images',
+                                               'sub1.nii.gz'))
+        pd.DataFrame({'id': ['sub0', 'sub1'], 'age': [50, 60]}).to_csv(
+            os.path.join('tmp', 'labels.csv'), index=False
+        )
+
+        dataset = NiftiDataset.from_folder('tmp')
+
+        assert ['sub0.nii', 'sub1.nii.gz'] == sorted(dataset.filenames), \
+               'NiftiDataset does not use images with mixed suffixes'
+    finally:
+        rmtree('tmp')
@@ -1,11 +1,28 @@
 import os
+import nibabel as nib
+import numpy as np
+import pytest
 
 from mock import patch, MagicMock
-from shutil import rmtree
+from shutil import rmtree, which
 
 from pyment.utils.preprocessing import autorecon1, autorecon1_folder, \
                                        convert_mgz_to_nii_gz, \
-                                       convert_mgz_to_nii_gz_folder
+                                       convert_mgz_to_nii_gz_folder, \
+                                       mgz_to_nifti
+
+
+# Orientation of volumes conformed by FreeSurfer (LIA)
+CONFORMED = np.array([[-1., 0., 0., 128.],
+                      [0., 0., 1., -128.],
+                      [0., -1., 0., 128.],
+                      [0., 0., 0., 1.]])
+
+def _create_mgz(path: str) -> np.ndarray:
+    data = np.random.randint(0, 255, size=(12, 13, 14)).astype(np.uint8)
+    nib.save(nib.MGHImage(data, CONFORMED), path)
+
+    return data
 
 @patch('pyment.utils.preprocessing.freesurfer.run')
 def test_autorecon1(mock):
@@ -22,6 +39,23 @@ def test_autorecon1(mock):
     finally:
         rmtree('tmp')
 
+@patch('pyment.utils.preprocessing.freesurfer.run')
+def test_autorecon1_threads(mock):
+    try:
+        os.mkdir('tmp')
+        autorecon1('mock.nii.gz', subject='mock', subjects_dir='tmp',
+                   threads=4)
+
+        cmd = mock.call_args[0][0]
+        expected_cmd = ('recon-all -s mock -sd tmp -i mock.nii.gz '
+                        '-autorecon1 -no-isrunning -parallel -openmp 4')
+        assert expected_cmd == cmd, ('autorecon1 does not pass threads on to '
+                                     'recon-all')
+        assert '4' == mock.call_args[1]['env']['OMP_NUM_THREADS'], \
+               'autorecon1 does not limit the OpenMP threads'
+    finally:
+        rmtree('tmp')
+
 @patch('pyment.utils.preprocessing.freesurfer.run')
 def test_autorecon1_disable_noisrunning(mock):
     try:
@@ -114,4 +148,68 @@ def test_convert_mgz_to_nii_gz_folder(mock):
         assert 5 == mock.call_count, ('convert_mgz_to_nii_gz_folder does not '
                                       'call run for every subject')
     finally:
-        rmtree('tmp')
\ No newline at end of file
+        rmtree('tmp')
+
+def test_mgz_to_nifti():
+    try:
+        os.mkdir('tmp')
+        data = _create_mgz(os.path.join('tmp', 'src.mgz'))
+
+        img = mgz_to_nifti(os.path.join('tmp', 'src.mgz'),
+                           os.path.join('tmp', 'dest.nii.gz'))
+
+        assert isinstance(img, nib.Nifti1Image), ('mgz_to_nifti does not '
+                                                  'return a nifti image')
+        assert np.array_equal(data, np.asanyarray(img.dataobj)), \
+               'mgz_to_nifti does not keep the voxels'
+        assert np.uint8 == img.get_data_dtype(), \
+               'mgz_to_nifti does not keep the data type'
+        assert np.allclose(CONFORMED, img.affine), \
+               'mgz_to_nifti does not keep the affine'
+
+        stored = nib.load(os.path.join('tmp', 'dest.nii.gz'))
+
+        assert np.array_equal(data, np.asanyarray(stored.dataobj)), \
+               'mgz_to_nifti does not store the converted image'
+    finally:
+        rmtree('tmp')
+
+@pytest.mark.skipif(which('mri_convert') is None,
+                    reason='mri_convert is not installed')
+def test_mgz_to_nifti_matches_mri_convert():
+    try:
+        os.mkdir('tmp')
+        src = os.path.join('tmp', 'src.mgz')
+        _create_mgz(src)
+
+        convert_mgz_to_nii_gz(src, os.path.join('tmp', 'external.nii.gz'))
+        external = nib.load(os.path.join('tmp', 'external.nii.gz'))
+        img = mgz_to_nifti(src)
+
+        assert np.array_equal(external.get_fdata(), img.get_fdata()), \
+               'mgz_to_nifti does not match the voxels of mri_convert'
+        assert np.allclose(external.affine, img.affine, atol=1e-4), \
+               'mgz_to_nifti does not match the affine of mri_convert'
+    finally:
+        rmtree('tmp')
+
+def test_convert_mgz_to_nii_gz_folder_nibabel():
+    try:
+        os.mkdir('tmp')
+        src = os.path.join('tmp', 'src')
+        os.mkdir(src)
+        dest = os.path.join('tmp', 'dest')
+
+        for i in range(3):
+            _create_mgz(os.path.join(src, f'sub{i}.mgz'))
+
+        records = convert_mgz_to_nii_gz_folder(src, dest, backend='nibabel')
+
+        assert all([r.succeeded for r in records]), \
+               'convert_mgz_to_nii_gz_folder with nibabel fails'
+        assert ['sub0.nii.gz', 'sub1.nii.gz', 'sub2.nii.gz'] == \
+               sorted([f for f in os.listdir(dest) if not f.startswith('.')]), \
+               ('convert_mgz_to_nii_gz_folder with nibabel does not convert '
+                'every image')
+    finally:
+        rmtree('tmp')
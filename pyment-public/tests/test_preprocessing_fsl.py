@@ -1,10 +1,22 @@
 import os
+import nibabel as nib
+import numpy as np
+import pytest
 
 from mock import patch, MagicMock
-from shutil import rmtree
+from nibabel.orientations import aff2axcodes
+from shutil import rmtree, which
 
-from pyment.utils.preprocessing import flirt, flirt_folder, reorient2std, \
-                                       reorient2std_folder
+from pyment.utils.preprocessing import flirt, flirt_folder, mgz_to_nifti, \
+                                       reorient2std, reorient2std_folder, \
+                                       reorient_to_standard
+
+
+def _create_image(path: str, affine: np.ndarray) -> np.ndarray:
+    data = np.random.uniform(size=(12, 13, 14)).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, affine), path)
+
+    return data
 
 
 @patch('pyment.utils.preprocessing.fsl.run')
@@ -106,4 +118,77 @@ def test_flirt_folder_degrees_of_freedom(mock):
         assert 9 == degrees_of_freedom, ('flirt_folder does not pass on '
                                          'correct degrees of freedom')
     finally:
-        rmtree('tmp')
\ No newline at end of file
+        rmtree('tmp')
+
+def test_reorient_to_standard():
+    # FreeSurfer conformed orientation (LIA)
+    affine = np.array([[-1., 0., 0., 128.],
+                       [0., 0., 1., -128.],
+                       [0., -1., 0., 128.],
+                       [0., 0., 0., 1.]])
+
+    try:
+        os.mkdir('tmp')
+        data = _create_image(os.path.join('tmp', 'src.nii.gz'), affine)
+
+        img = reorient_to_standard(os.path.join('tmp', 'src.nii.gz'),
+                                   os.path.join('tmp', 'dest.nii.gz'))
+
+        assert ('L', 'A', 'S') == aff2axcodes(img.affine), \
+               'reorient_to_standard does not reorient to LAS'
+        assert (12, 14, 13) == img.shape, ('reorient_to_standard does not '
+                                           'permute the axes')
+
+        # Every voxel keeps its position in world coordinates
+        voxels = np.stack(np.meshgrid(*[np.arange(s) for s in data.shape],
+                                      indexing='ij'), axis=-1).reshape(-1, 3)
+        world = nib.affines.apply_affine(affine, voxels)
+        reoriented = np.round(nib.affines.apply_affine(
+            np.linalg.inv(img.affine), world
+        )).astype(int)
+
+        assert np.array_equal(data[tuple(voxels.T)],
+                              img.get_fdata()[tuple(reoriented.T)]), \
+               'reorient_to_standard moves voxels in world coordinates'
+        assert os.path.isfile(os.path.join('tmp', 'dest.nii.gz')), \
+               'reorient_to_standard does not store the result'
+    finally:
+        rmtree('tmp')
+
+def test_reorient_to_standard_chains_in_memory():
+    affine = np.array([[0., 0., 1., 0.],
+                       [1., 0., 0., 0.],
+                       [0., 1., 0., 0.],
+                       [0., 0., 0., 1.]])
+    data = np.random.randint(0, 255, size=(4, 5, 6)).astype(np.uint8)
+
+    img = reorient_to_standard(mgz_to_nifti(nib.MGHImage(data, affine)))
+
+    assert ('L', 'A', 'S') == aff2axcodes(img.affine), \
+           'reorient_to_standard does not reorient converted images'
+    assert np.uint8 == img.get_data_dtype(), \
+           'reorient_to_standard does not keep the data type'
+
+@pytest.mark.skipif(which('fslreorient2std') is None,
+                    reason='fslreorient2std is not installed')
+def test_reorient_to_standard_matches_fslreorient2std():
+    affine = np.array([[-1., 0., 0., 128.],
+                       [0., 0., 1., -128.],
+                       [0., -1., 0., 128.],
+                       [0., 0., 0., 1.]])
+
+    try:
+        os.mkdir('tmp')
+        src = os.path.join('tmp', 'src.nii.gz')
+        _create_image(src, affine)
+
+        reorient2std(src, os.path.join('tmp', 'external.nii.gz'))
+        external = nib.load(os.path.join('tmp', 'external.nii.gz'))
+        img = reorient_to_standard(src)
+
+        assert np.allclose(external.get_fdata(), img.get_fdata()), \
+               'reorient_to_standard does not match fslreorient2std'
+        assert np.allclose(external.affine, img.affine, atol=1e-4), \
+               'reorient_to_standard does not match the affine of FSL'
+    finally:
+        rmtree('tmp')
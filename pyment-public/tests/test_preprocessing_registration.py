@@ -0,0 +1,147 @@
+import os
+import nibabel as nib
+import numpy as np
+import pytest
+
+from shutil import rmtree
+
+from pyment.utils.preprocessing import crop_mri, estimate_rigid, \
+                                       register_rigid, register_rigid_folder, \
+                                       rigid_matrix
+from pyment.utils.preprocessing.registration import trilinear
+
+
+SIZE = 48
+CENTER = np.asarray([SIZE / 2] * 3)
+
+
+def _create_template() -> nib.Nifti1Image:
+    x, y, z = np.meshgrid(*[np.arange(SIZE)] * 3, indexing='ij')
+    distance = ((x - 24) / 16) ** 2 + ((y - 24) / 19) ** 2 + \
+               ((z - 24) / 13) ** 2
+    data = np.where(distance < 1, 100, 0).astype(np.float32)
+    data[distance < 0.4] = 60
+    data[(x - 30) ** 2 + (y - 20) ** 2 + (z - 26) ** 2 < 25] = 150
+
+    return nib.Nifti1Image(data, affine=np.eye(4))
+
+def _transform(img: nib.Nifti1Image, matrix: np.ndarray) -> nib.Nifti1Image:
+    voxels = np.stack(np.meshgrid(*[np.arange(SIZE)] * 3, indexing='ij'))
+    voxels = np.concatenate([voxels.reshape(3, -1),
+                             np.ones((1, SIZE ** 3))])
+    values, _ = trilinear(img.get_fdata().astype(np.float32),
+                          (np.linalg.inv(matrix) @ voxels)[:3])
+
+    return nib.Nifti1Image(values.reshape(img.shape), affine=np.eye(4))
+
+def _error(estimated: np.ndarray, expected: np.ndarray) -> float:
+    corners = np.asarray([[0, 0, 0, 1], [SIZE, 0, 0, 1], [0, SIZE, SIZE, 1],
+                          [SIZE, SIZE, SIZE, 1]]).T
+
+    return np.mean(np.linalg.norm((estimated @ corners - \
+                                   expected @ corners)[:3], axis=0))
+
+def test_rigid_matrix_identity():
+    assert np.allclose(np.eye(4), rigid_matrix(np.zeros(6), CENTER)), \
+           'rigid_matrix without rotations and translations is not identity'
+
+    matrix = rigid_matrix(np.asarray([10, 20, 30, 0, 0, 0]), CENTER)
+
+    assert np.allclose(CENTER, (matrix @ np.append(CENTER, 1))[:3]), \
+           'rigid_matrix does not rotate around the center'
+
+def test_trilinear():
+    data = np.random.uniform(size=(4, 5, 6)).astype(np.float32)
+    coordinates = np.asarray([[1, 2, 3], [1.5, 2, 3], [-1, 0, 0]]).T
+
+    values, inside = trilinear(data, coordinates)
+
+    assert np.isclose(data[1, 2, 3], values[0]), \
+           'trilinear does not return voxel values at voxel centers'
+    assert np.isclose((data[1, 2, 3] + data[2, 2, 3]) / 2, values[1]), \
+           'trilinear does not interpolate between voxels'
+    assert [True, True, False] == list(inside), \
+           'trilinear does not mask coordinates outside the volume'
+    assert 0 == values[2], 'trilinear does not zero values outside the volume'
+
+def test_estimate_rigid_corratio():
+    template = _create_template()
+    expected = rigid_matrix(np.asarray([6.3, -4.7, 5.2, 3.6, -2.1, 2.4]),
+                            CENTER)
+    moving = _transform(template, expected)
+
+    matrix = estimate_rigid(moving, template, scales=[4, 2, 1])
+
+    assert _error(matrix, expected) < 0.5, \
+           'estimate_rigid does not recover a known transform'
+
+def test_estimate_rigid_mutualinfo():
+    template = _create_template()
+    expected = rigid_matrix(np.asarray([0, 0, 5, 4, 0, -2]), CENTER)
+    moving = _transform(template, expected)
+
+    matrix = estimate_rigid(moving, template, cost='mutualinfo', bins=32,
+                            scales=[4, 2, 1])
+
+    assert _error(matrix, expected) < 1, ('estimate_rigid with mutual '
+                                          'information does not recover a '
+                                          'known transform')
+
+def test_estimate_rigid_invalid_cost():
+    template = _create_template()
+
+    with pytest.raises(ValueError):
+        estimate_rigid(template, template, cost='leastsq')
+
+def test_register_rigid_to_crop():
+    try:
+        os.mkdir('tmp')
+        template = _create_template()
+        moving = _transform(template,
+                            rigid_matrix(np.asarray([0, 0, 4, 3, -2, 0]),
+                                         CENTER))
+        registered = register_rigid(moving, template=template,
+                                    scales=[4, 2, 1])
+
+        assert template.shape == registered.shape, \
+               'register_rigid does not resample into the template space'
+
+        correlation = np.corrcoef(template.get_fdata().ravel(),
+                                  registered.get_fdata().ravel())[0, 1]
+
+        assert correlation > 0.95, ('register_rigid does not align the image '
+                                    'with the template')
+
+        crop_mri(registered, os.path.join('tmp', 'cropped.nii.gz'),
+                 bounds=((4, 44), (4, 44), (4, 44)))
+
+        assert (40, 40, 40) == nib.load(os.path.join('tmp',
+                                                     'cropped.nii.gz')).shape, \
+               'crop_mri does not crop registered images in memory'
+    finally:
+        rmtree('tmp')
+
+def test_register_rigid_folder():
+    try:
+        src = os.path.join('tmp', 'src')
+        dest = os.path.join('tmp', 'dest')
+        os.makedirs(src)
+        template = os.path.join('tmp', 'template.nii.gz')
+        nib.save(_create_template(), template)
+
+        for i in range(2):
+            moving = _transform(_create_template(),
+                                rigid_matrix(np.asarray([0, 0, i, i, 0, 0]),
+                                             CENTER))
+            nib.save(moving, os.path.join(src, f'sub{i}.nii.gz'))
+
+        records = register_rigid_folder(src, dest, template=template,
+                                        scales=[4, 2])
+
+        assert all([r.succeeded for r in records]), \
+               'register_rigid_folder does not register every image'
+        assert 0 == len(register_rigid_folder(src, dest, template=template,
+                                              scales=[4, 2])), \
+               'register_rigid_folder recomputes current subjects'
+    finally:
+        rmtree('tmp')
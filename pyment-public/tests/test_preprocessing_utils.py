@@ -0,0 +1,22 @@
+import sys
+import pytest
+
+from subprocess import CalledProcessError
+
+from pyment.utils.preprocessing import ResourceUsage
+from pyment.utils.preprocessing.utils import run
+
+
+def test_run_usage():
+    usage = run(f'{sys.executable} -c x=[0]*10**7')
+
+    assert isinstance(usage, ResourceUsage), ('run does not return the '
+                                              'resources used')
+    assert 0 < usage.cpu_time, 'run does not measure CPU time'
+    assert 10**7 * 8 < usage.peak_rss, 'run does not measure peak memory'
+
+def test_run_failure():
+    with pytest.raises(CalledProcessError) as e:
+        run(f'{sys.executable} -c exit(3)')
+
+    assert 3 == e.value.returncode, 'run does not raise the exit status'
@@ -0,0 +1,213 @@
+import os
+import pandas as pd
+
+from shutil import rmtree
+from subprocess import CalledProcessError
+from threading import Event, Lock
+from time import sleep
+
+from pyment.utils.preprocessing import Job, ResourceBudget, ResourceUsage, \
+                                       Scheduler
+
+
+def _write_pid(path: str):
+    with open(path, 'w') as f:
+        f.write(str(os.getpid()))
+
+def _exit(code: int):
+    raise CalledProcessError(code, 'flirt')
+
+def test_scheduler_runs_jobs():
+    calls = []
+    jobs = [Job(f'sub{i}', lambda i: calls.append(i), i=i) \
+            for i in range(5)]
+
+    Scheduler(concurrency=2).run(jobs)
+
+    assert [0, 1, 2, 3, 4] == sorted(calls), ('Scheduler does not run every '
+                                              'job')
+
+def test_scheduler_records_order():
+    jobs = [Job(f'sub{i}', sleep, secs=0.01 * (5 - i)) for i in range(5)]
+
+    records = Scheduler(concurrency=5).run(jobs)
+
+    assert [f'sub{i}' for i in range(5)] == [r.name for r in records], \
+           'Scheduler does not return records in the order of the jobs'
+
+def test_scheduler_dynamic_queue():
+    # With a static split sub1 would wait for the slow sub0
+    released = Event()
+    finished = []
+
+    def work(name: str, slow: bool):
+        if slow:
+            released.wait(timeout=5)
+        else:
+            finished.append(name)
+
+            if len(finished) == 3:
+                released.set()
+
+    jobs = [Job('sub0', work, name='sub0', slow=True)] + \
+           [Job(f'sub{i}', work, name=f'sub{i}', slow=False) \
+            for i in range(1, 4)]
+
+    records = Scheduler(concurrency=2).run(jobs)
+
+    assert released.is_set(), ('Scheduler does not let idle workers pick up '
+                               'remaining jobs')
+    assert all([r.succeeded for r in records]), 'Scheduler jobs did not succeed'
+
+def test_scheduler_retries():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+
+        if len(attempts) < 3:
+            raise RuntimeError('flaky')
+
+    records = Scheduler(retries=2).run([Job('sub0', flaky)])
+
+    assert 3 == records[0].attempts, 'Scheduler does not retry failed jobs'
+    assert records[0].succeeded, ('Scheduler does not record success after a '
+                                  'retry')
+
+def test_scheduler_failure():
+    def fail():
+        raise CalledProcessError(3, 'recon-all')
+
+    calls = []
+    jobs = [Job('sub0', fail), Job('sub1', lambda: calls.append(1))]
+
+    records = Scheduler(retries=1).run(jobs)
+
+    assert 'failed' == records[0].status, ('Scheduler does not record failed '
+                                           'jobs')
+    assert 3 == records[0].exit_status, ('Scheduler does not record the exit '
+                                         'status of failed processes')
+    assert 2 == records[0].attempts, ('Scheduler does not attempt failed jobs '
+                                      'retries + 1 times')
+    assert [1] == calls, 'A failed job stops the Scheduler from running others'
+
+def test_scheduler_records_file():
+    try:
+        os.mkdir('tmp')
+        path = os.path.join('tmp', 'records.csv')
+        jobs = [Job(f'sub{i}', sleep, secs=0) for i in range(3)]
+
+        Scheduler(records=path).run(jobs)
+
+        df = pd.read_csv(path)
+
+        assert 3 == len(df), 'Scheduler does not write a record for every job'
+        assert {'name', 'status', 'exit_status', 'wall_time'} <= \
+               set(df.columns), ('Scheduler records are missing wall time or '
+                                 'exit status')
+    finally:
+        rmtree('tmp')
+
+def test_scheduler_unique_names():
+    exception = False
+
+    try:
+        Scheduler().run([Job('sub0', sleep, secs=0),
+                         Job('sub0', sleep, secs=0)])
+    except ValueError:
+        exception = True
+
+    assert exception, ('Scheduler does not raise an error for jobs with '
+                       'duplicate names')
+
+def test_scheduler_processes():
+    try:
+        os.mkdir('tmp')
+        jobs = [Job(f'sub{i}', _write_pid,
+                    path=os.path.join('tmp', f'sub{i}.txt')) \
+                for i in range(4)]
+
+        records = Scheduler(concurrency=2, processes=True).run(jobs)
+
+        assert all([r.succeeded for r in records]), \
+               'Scheduler with processes does not run jobs'
+
+        pids = set()
+
+        for i in range(4):
+            with open(os.path.join('tmp', f'sub{i}.txt'), 'r') as f:
+                pids.add(int(f.read()))
+
+        assert os.getpid() not in pids, ('Scheduler with processes runs jobs '
+                                         'in the calling process')
+    finally:
+        rmtree('tmp')
+
+def test_scheduler_processes_failure():
+    jobs = [Job('sub0', _exit, code=4), Job('sub1', os.getpid)]
+
+    records = Scheduler(concurrency=2, processes=True).run(jobs)
+
+    assert 'failed' == records[0].status, ('Scheduler with processes does not '
+                                           'collect failures')
+    assert 4 == records[0].exit_status, ('Scheduler with processes does not '
+                                         'record the exit status')
+    assert records[1].succeeded, ('A failed process stops the Scheduler from '
+                                  'running others')
+
+def test_scheduler_callback():
+    finished = []
+    jobs = [Job(f'sub{i}', sleep, secs=0) for i in range(3)]
+
+    Scheduler(concurrency=2).run(jobs, callback=finished.append)
+
+    assert ['sub0', 'sub1', 'sub2'] == sorted([r.name for r in finished]), \
+           'Scheduler does not call the callback for every job'
+
+def _peak_concurrency(scheduler: Scheduler, n: int) -> int:
+    lock = Lock()
+    running = [0, 0]
+
+    def work():
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+
+        sleep(0.02)
+
+        with lock:
+            running[0] -= 1
+
+    scheduler.run([Job(f'sub{i}', work) for i in range(n)])
+
+    return running[1]
+
+def test_scheduler_budget_cpus():
+    scheduler = Scheduler(concurrency=4, job_cpus=2,
+                          budget=ResourceBudget(cpus=4, memory=100))
+
+    assert 2 == _peak_concurrency(scheduler, 6), \
+           'Scheduler does not admit jobs by their CPUs'
+
+def test_scheduler_budget_memory():
+    scheduler = Scheduler(concurrency=4, job_memory=60,
+                          budget=ResourceBudget(cpus=4, memory=100))
+
+    assert 1 == _peak_concurrency(scheduler, 3), \
+           'Scheduler does not admit jobs by their memory'
+
+def test_scheduler_budget_oversized_job():
+    scheduler = Scheduler(concurrency=2, job_cpus=8,
+                          budget=ResourceBudget(cpus=4, memory=100))
+
+    records = scheduler.run([Job('sub0', os.getpid)])
+
+    assert records[0].succeeded, ('Scheduler does not run jobs larger than '
+                                  'the budget')
+
+def test_scheduler_records_usage():
+    records = Scheduler().run([Job('sub0', lambda: ResourceUsage(1.5, 2**20))])
+
+    assert 1.5 == records[0].cpu_time, 'Scheduler does not record CPU time'
+    assert 2**20 == records[0].peak_rss, ('Scheduler does not record peak '
+                                          'memory')
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pytest
+
+from mock import patch
+from shutil import rmtree
+
+from pyment.utils import configure_telemetry, load_telemetry, measure, \
+                         summarize_telemetry, track
+from pyment.utils.preprocessing import Job, Pipeline, Scheduler, Stage
+
+
+def _write(path: str, size: int = 2**16):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+def test_measure():
+    try:
+        os.mkdir('tmp')
+
+        with measure() as measurement:
+            np.linalg.svd(np.random.uniform(size=(200, 200)))
+            _write(os.path.join('tmp', 'file'))
+
+        assert 0 < measurement.cpu_time, 'measure does not measure CPU time'
+        assert 0 < measurement.wall_time, 'measure does not measure wall time'
+        assert 0 < measurement.peak_rss, 'measure does not measure memory'
+
+        if os.path.exists('/proc/thread-self/io'):
+            assert 2**16 <= measurement.written_bytes, \
+                   'measure does not count bytes written'
+    finally:
+        rmtree('tmp')
+
+@patch('pyment.utils.telemetry._reset_peak_rss')
+def test_measure_reset_peak(mock):
+    try:
+        with measure(reset_peak=True):
+            pass
+
+        assert not mock.called, ('measure resets the peak memory without '
+                                 'telemetry')
+
+        configure_telemetry(os.path.join('tmp', 'telemetry.jsonl'))
+
+        with measure():
+            pass
+
+        assert not mock.called, ('measure resets the peak memory without '
+                                 'being asked to')
+
+        with measure(reset_peak=True):
+            pass
+
+        assert mock.called, 'measure does not reset the peak memory'
+    finally:
+        configure_telemetry(None)
+
+        if os.path.isdir('tmp'):
+            rmtree('tmp')
+
+def test_track_disabled():
+    try:
+        os.mkdir('tmp')
+
+        with track('stage', subject='sub0'):
+            pass
+
+        assert [] == os.listdir('tmp'), 'track writes without telemetry'
+    finally:
+        rmtree('tmp')
+
+def test_track():
+    try:
+        path = os.path.join('tmp', 'telemetry.jsonl')
+        configure_telemetry(path)
+
+        with track('load', subject='sub0', generator='test'):
+            pass
+
+        with pytest.raises(RuntimeError):
+            with track('load', subject='sub1'):
+                raise RuntimeError()
+
+        events = load_telemetry(path)
+
+        assert ['sub0', 'sub1'] == list(events['subject']), \
+               'track does not write an event for every block'
+        assert ['success', 'failed'] == list(events['status']), \
+               'track does not record whether blocks failed'
+        assert 'test' == events['generator'][0], \
+               'track does not write additional fields'
+    finally:
+        configure_telemetry(None)
+        rmtree('tmp')
+
+def test_pipeline_telemetry():
+    try:
+        os.mkdir('tmp')
+        path = os.path.join('tmp', 'telemetry.jsonl')
+        configure_telemetry(path)
+
+        stages = [
+            Stage('a', lambda subject: _write(os.path.join('tmp', subject))),
+            Stage('b', lambda subject: None)
+        ]
+        Pipeline(stages).run(['sub0', 'sub1'])
+
+        events = load_telemetry(path)
+
+        assert 4 == len(events), ('Pipeline does not write an event for every '
+                                  'stage and subject')
+
+        written = events[events['stage'] == 'a']['written_bytes']
+
+        if os.path.exists('/proc/thread-self/io'):
+            assert all(written >= 2**16), \
+                   'Pipeline does not record bytes written by stages'
+    finally:
+        configure_telemetry(None)
+        rmtree('tmp')
+
+def test_scheduler_telemetry():
+    try:
+        path = os.path.join('tmp', 'telemetry.jsonl')
+        configure_telemetry(path)
+
+        Scheduler().run([Job('sub0', os.getpid), Job('sub1', os.getpid)],
+                        stage='getpid')
+
+        events = load_telemetry(path)
+
+        assert ['getpid', 'getpid'] == list(events['stage']), \
+               'Scheduler does not write events with the stage'
+        assert all(events['cpu_time'].notna()), \
+               'Scheduler does not measure jobs in-process'
+    finally:
+        configure_telemetry(None)
+        rmtree('tmp')
+
+def test_summarize_telemetry():
+    try:
+        path = os.path.join('tmp', 'telemetry.jsonl')
+        configure_telemetry(path)
+
+        for i in range(10):
+            with track('load', subject=f'sub{i}'):
+                pass
+
+        with pytest.raises(ValueError):
+            with track('predict'):
+                raise ValueError()
+
+        # Lines cut short are skipped
+        with open(path, 'a') as f:
+            f.write('{"stage": "lo')
+
+        summary = summarize_telemetry(load_telemetry(path))
+        summary = summary.set_index('stage')
+
+        assert 10 == summary.loc['load', 'subjects'], \
+               'summarize_telemetry does not count subjects'
+        assert 1 == summary.loc['predict', 'failed'], \
+               'summarize_telemetry does not count failures'
+        assert summary.loc['load', 'p50'] <= summary.loc['load', 'max'], \
+               'summarize_telemetry does not compute percentiles'
+    finally:
+        configure_telemetry(None)
+        rmtree('tmp')
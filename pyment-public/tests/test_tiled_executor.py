@@ -0,0 +1,97 @@
+import numpy as np
+
+from pyment.models import RegressionSFCN
+from pyment.models.utils import TiledExecutor
+
+
+def _model():
+    model = RegressionSFCN(input_shape=(40, 36, 34), prediction_range=None)
+
+    # Non-trivial normalization statistics, so that errors in the halos
+    # are not hidden by an identity-like normalization
+    for layer in model.layers:
+        if layer.name.endswith('/norm'):
+            weights = [np.random.uniform(.5, 1.5, size=w.shape) \
+                       for w in layer.get_weights()]
+            layer.set_weights(weights)
+
+    return model
+
+
+def test_tiled_executor_requires_limit():
+    exception = False
+
+    try:
+        TiledExecutor(_model())
+    except ValueError:
+        exception = True
+
+    assert exception, ('TiledExecutor does not raise an error without a '
+                       'memory limit or number of tiles')
+
+def test_tiled_executor_matches_model():
+    model = _model()
+    X = np.random.uniform(size=(2, 40, 36, 34)).astype(np.float32)
+    expected = model.predict(X)
+
+    for blocks in [1, 2, 3]:
+        executor = TiledExecutor(model, blocks=blocks, tiles=(3, 2, 4))
+        predictions = executor.predict(X)
+
+        assert np.allclose(expected, predictions, atol=1e-4), \
+               (f'TiledExecutor with {blocks} tiled blocks does not match '
+                'the untiled model')
+
+def test_tiled_executor_more_tiles_than_voxels():
+    model = _model()
+    X = np.random.uniform(size=(1, 40, 36, 34)).astype(np.float32)
+    executor = TiledExecutor(model, blocks=3, tiles=(10, 10, 10))
+
+    assert np.allclose(model.predict(X), executor.predict(X), atol=1e-4), \
+           ('TiledExecutor does not handle more tiles than voxels after the '
+            'tiled blocks')
+
+def test_tiled_executor_features_in():
+    model = _model()
+    X = np.random.uniform(size=(2, 40, 36, 34)).astype(np.float32)
+    executor = TiledExecutor(model, blocks=2, tiles=(1, 1, 1))
+
+    mask = np.zeros((40, 36, 34), dtype=bool)
+    mask[10:14, 20:23, 5:9] = True
+    occluded = np.where(mask[None], 0., X).astype(np.float32)
+
+    intact = executor.features(X)
+    expected = executor.features(occluded)
+    region = executor.region(mask)
+    (y0, y1), (x0, x1), (z0, z1) = region
+
+    assert np.allclose(expected[:, y0:y1, x0:x1, z0:z1],
+                       executor.features_in(occluded, region), atol=1e-4), \
+           'TiledExecutor does not compute the features within a region'
+
+    expected[:, y0:y1, x0:x1, z0:z1] = intact[:, y0:y1, x0:x1, z0:z1]
+
+    assert np.allclose(intact, expected, atol=1e-4), \
+           ('TiledExecutor returns a region that does not cover every '
+            'feature the mask can change')
+
+def test_tiled_executor_memory_limit():
+    model = _model()
+    executor = TiledExecutor(model, memory_limit=2**21)
+
+    tiles = executor._plan(batch_size=1)
+    shape = [int(np.ceil(n / t)) for n, t in zip(executor.sizes[-1], tiles)]
+
+    assert np.prod(tiles) > 1, ('TiledExecutor does not split the volume '
+                                'when it does not fit the memory limit')
+    assert executor.estimate_memory(shape) <= 2**21, \
+           'TiledExecutor chooses tiles that do not fit the memory limit'
+
+def test_model_predict_memory_limit():
+    model = _model()
+    X = np.random.uniform(size=(2, 40, 36, 34)).astype(np.float32)
+
+    predictions = model.predict(X, memory_limit=2**21)
+
+    assert np.allclose(model.predict(X), predictions, atol=1e-4), \
+           'Model.predict with a memory limit does not match untiled predict'
@@ -0,0 +1,201 @@
+import os
+import pytest
+
+from shutil import rmtree
+from threading import Lock, Thread
+from time import sleep, time
+
+from pyment.utils.preprocessing import FileWorkQueue, LeaseLost
+
+
+def _expire(queue: FileWorkQueue, name: str):
+    past = time() - 2 * queue.lease_timeout
+    os.utime(os.path.join(queue.root, 'leases', name), (past, past))
+
+def test_workqueue_submit():
+    try:
+        queue = FileWorkQueue('tmp')
+
+        assert 3 == queue.submit(['sub0', 'sub1', 'sub2']), \
+               'FileWorkQueue does not add submitted tasks'
+        assert 1 == queue.submit(['sub0', 'sub3']), \
+               'FileWorkQueue adds tasks that are already in the queue'
+        assert 4 == queue.status()['pending'], \
+               'FileWorkQueue does not count pending tasks'
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_lifecycle():
+    try:
+        queue = FileWorkQueue('tmp')
+        queue.submit(['sub0'])
+
+        name = queue.claim('worker0')
+
+        assert 'sub0' == name, 'FileWorkQueue does not claim pending tasks'
+        assert queue.claim('worker1') is None, \
+               'FileWorkQueue hands out tasks that are leased'
+        assert 'worker0' == queue.leases()['sub0']['worker'], \
+               'FileWorkQueue does not record the worker of a lease'
+
+        queue.complete(name)
+
+        assert {'pending': 0, 'leases': 0, 'done': 1, 'failed': 0} == \
+               queue.status(), 'FileWorkQueue does not complete tasks'
+        assert queue.is_finished(), 'FileWorkQueue is not finished when done'
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_exclusive_claims():
+    try:
+        queue = FileWorkQueue('tmp')
+        queue.submit([f'sub{i}' for i in range(50)])
+
+        claims = []
+        lock = Lock()
+
+        def work(worker: str):
+            while True:
+                name = queue.claim(worker)
+
+                if name is None:
+                    break
+
+                with lock:
+                    claims.append(name)
+
+        workers = [Thread(target=work, args=(f'worker{i}',)) \
+                   for i in range(4)]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        assert sorted(claims) == sorted(set(claims)), \
+               'FileWorkQueue hands out the same task to several workers'
+        assert 50 == len(claims), 'FileWorkQueue loses tasks during claims'
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_claim_recovered_lease():
+    try:
+        queue = FileWorkQueue('tmp')
+        queue.submit(['sub0', 'sub1'])
+        read = queue._read
+
+        def recovered(path: str):
+            # Another worker recovers the lease right after the rename
+            if os.path.basename(path) == 'sub0':
+                os.rename(path, os.path.join('tmp', 'pending', 'sub0'))
+
+            return read(path)
+
+        queue._read = recovered
+
+        assert 'sub1' == queue.claim('worker'), ('FileWorkQueue does not move '
+                                                 'on when a claimed lease is '
+                                                 'recovered')
+        assert 1 == queue.status()['pending'], ('FileWorkQueue loses tasks '
+                                                'recovered while claiming')
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_recovers_expired_leases():
+    try:
+        queue = FileWorkQueue('tmp', lease_timeout=10, retries=1)
+        queue.submit(['sub0', 'sub1'])
+
+        queue.claim('crashed')
+        queue.claim('alive')
+        _expire(queue, 'sub0')
+
+        assert ['sub0'] == queue.recover(), ('FileWorkQueue does not recover '
+                                             'expired leases')
+        assert 'sub0' == queue.claim('worker'), \
+               'FileWorkQueue does not hand out recovered tasks'
+
+        with pytest.raises(LeaseLost):
+            queue.heartbeat('sub2')
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_gives_up_on_crashing_tasks():
+    try:
+        queue = FileWorkQueue('tmp', lease_timeout=10)
+        queue.submit(['sub0'])
+
+        queue.claim('crashed')
+        _expire(queue, 'sub0')
+        queue.recover()
+
+        assert 1 == queue.status()['failed'], \
+               'FileWorkQueue retries tasks without retries left'
+        assert 'Lease expired' == queue.errors()['sub0'], \
+               'FileWorkQueue does not record why a task failed'
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_keep_alive():
+    try:
+        queue = FileWorkQueue('tmp', lease_timeout=10)
+        queue.submit(['sub0'])
+        queue.claim('worker')
+        _expire(queue, 'sub0')
+
+        with queue.keep_alive('sub0', interval=0.01):
+            sleep(0.1)
+
+        assert [] == queue.recover(), ('FileWorkQueue recovers leases that '
+                                       'are kept alive')
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_keep_alive_lost():
+    try:
+        queue = FileWorkQueue('tmp', lease_timeout=10)
+        queue.submit(['sub0'])
+        queue.claim('slow')
+        _expire(queue, 'sub0')
+        queue.recover()
+        lost = []
+
+        with queue.keep_alive('sub0', interval=0.01,
+                              on_lost=lambda: lost.append('sub0')):
+            sleep(0.1)
+
+        assert ['sub0'] == lost, ('FileWorkQueue does not report leases '
+                                  'that are lost while kept alive')
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_fail_retries():
+    try:
+        queue = FileWorkQueue('tmp', retries=1)
+        queue.submit(['sub0'])
+
+        queue.fail(queue.claim('worker'), error='flirt failed')
+
+        assert 1 == queue.status()['pending'], \
+               'FileWorkQueue does not retry failed tasks'
+
+        queue.fail(queue.claim('worker'), error='flirt failed')
+
+        assert {'sub0': 'flirt failed'} == queue.errors(), \
+               'FileWorkQueue does not fail tasks without retries left'
+    finally:
+        rmtree('tmp')
+
+def test_workqueue_complete_lost_lease():
+    try:
+        queue = FileWorkQueue('tmp', lease_timeout=10)
+        queue.submit(['sub0'])
+        queue.claim('slow')
+        _expire(queue, 'sub0')
+        queue.recover()
+
+        with pytest.raises(LeaseLost):
+            queue.complete('sub0')
+    finally:
+        rmtree('tmp')
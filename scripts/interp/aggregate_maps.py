@@ -0,0 +1,364 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+from guided_backprop import iterate_batches
+from saliency_store import SaliencyStore
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class P2Quantile:
+    """Streaming estimate of a quantile for every voxel, using the P^2
+    algorithm (Jain & Chlamtac, 1985). Each voxel keeps five marker heights
+    and positions, which are moved towards the desired quantiles as values
+    arrive, so memory does not grow with the number of maps. Until a voxel
+    has five values, the quantile is computed exactly from them"""
+
+    def __init__(self, p, voxels):
+        self.p = p
+        self.heights = np.zeros((5, voxels), dtype=np.float32)
+        self.positions = np.tile(np.arange(1, 6, dtype=np.int32)[:, None],
+                                 (1, voxels))
+        self.increments = np.asarray([0, p / 2, p, (1 + p) / 2, 1])
+
+    def add(self, x, count, valid, start, stop):
+        """Adds one value to each voxel in [start, stop) where valid, given
+        the number of values of each voxel including this one"""
+        heights = self.heights[:, start:stop]
+        positions = self.positions[:, start:stop]
+
+        # the first five values are kept as they are, and sorted when the
+        # fifth arrives
+        initial = np.nonzero(valid & (count <= 5))[0]
+        if len(initial) > 0:
+            heights[count[initial] - 1, initial] = x[initial]
+            full = initial[count[initial] == 5]
+            heights[:, full] = np.sort(heights[:, full], axis=0)
+
+        update = np.nonzero(valid & (count > 5))[0]
+        if len(update) == 0:
+            return
+
+        x = x[update]
+        q = heights[:, update].astype(np.float64)
+        n = positions[:, update].astype(np.float64)
+        q[0] = np.minimum(q[0], x)
+        q[4] = np.maximum(q[4], x)
+
+        # markers above the cell of the value move up one position
+        cell = np.sum(x[None] >= q[1:4], axis=0)
+        n += np.arange(5)[:, None] > cell[None]
+        desired = (count[update][None] - 1) * self.increments[:, None] + 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(1, 4):
+                d = desired[i] - n[i]
+                move = ((d >= 1) & (n[i + 1] - n[i] > 1)) | \
+                    ((d <= -1) & (n[i - 1] - n[i] < -1))
+                s = np.where(move, np.sign(d), 0)
+
+                parabolic = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) /
+                    (n[i + 1] - n[i]) + (n[i + 1] - n[i] - s) *
+                    (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                neighbour = np.where(s > 0, q[i + 1], q[i - 1])
+                neighbour_position = np.where(s > 0, n[i + 1], n[i - 1])
+                linear = q[i] + s * (neighbour - q[i]) / \
+                    (neighbour_position - n[i])
+
+                inside = (q[i - 1] < parabolic) & (parabolic < q[i + 1])
+                q[i] = np.where(move, np.where(inside, parabolic, linear),
+                                q[i])
+                n[i] += s
+
+        heights[:, update] = q
+        positions[:, update] = n
+
+    def value(self, count):
+        result = self.heights[2].astype(np.float64)
+        few = np.nonzero((count > 0) & (count < 5))[0]
+        if len(few) > 0:
+            values = self.heights[:, few].astype(np.float64)
+            values[np.arange(5)[:, None] >= count[few][None]] = np.nan
+            result[few] = np.nanquantile(values, self.p, axis=0)
+        result[count == 0] = np.nan
+
+        return result
+
+
+class GroupStats:
+    """Voxelwise count, mean, variance and quantiles of the maps of a
+    group, updated one batch of maps at a time. The mean and variance are
+    merged with Welford's algorithm in the batched form of Chan et al.
+    Values that are not finite are left out for their voxel"""
+
+    def __init__(self, voxels, quantiles=(0.5, )):
+        self.count = np.zeros(voxels, dtype=np.int64)
+        self.mean = np.zeros(voxels, dtype=np.float64)
+        self.m2 = np.zeros(voxels, dtype=np.float64)
+        self.sketches = [P2Quantile(q, voxels) for q in quantiles]
+
+    def update(self, values, start, stop):
+        """Adds a (maps, voxels) batch, restricted to the voxels in
+        [start, stop). Different voxel ranges can be updated in parallel"""
+        values = values[:, start:stop]
+        finite = np.isfinite(values)
+        count = self.count[start:stop]
+
+        # quantile sketches, one map at a time
+        running = count.copy()
+        for x, valid in zip(values, finite):
+            running += valid
+            for sketch in self.sketches:
+                sketch.add(x, running, valid, start, stop)
+
+        # mean and variance, merged with the batch
+        # nansum would keep infinite values, so they are zeroed instead
+        n_b = np.sum(finite, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_b = np.where(
+                n_b > 0,
+                np.sum(np.where(finite, values, 0), axis=0, dtype=np.float64) /
+                n_b, 0)
+            m2_b = np.sum(np.where(finite, values - mean_b, 0)**2,
+                          axis=0,
+                          dtype=np.float64)
+            total = count + n_b
+            delta = mean_b - self.mean[start:stop]
+            self.mean[start:stop] += np.where(total > 0,
+                                              delta * n_b / total, 0)
+            self.m2[start:stop] += m2_b + np.where(
+                total > 0, delta**2 * count * n_b / total, 0)
+        self.count[start:stop] = total
+
+    def variance(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, self.m2 / (self.count - 1),
+                            np.nan)
+
+    def results(self):
+        results = {
+            'count': self.count.astype(np.float32),
+            'mean': np.where(self.count > 0, self.mean, np.nan),
+            'variance': self.variance()
+        }
+        for sketch in self.sketches:
+            results[f'p{sketch.p * 100:g}'] = sketch.value(self.count)
+
+        return results
+
+
+class MapAggregator:
+    """Computes the statistics of several groups of maps in one pass.
+    Each batch is split into voxel ranges which are updated in parallel,
+    as every voxel is independent"""
+
+    def __init__(self, voxels, groups, quantiles=(0.5, ), threads=4):
+        self.voxels = voxels
+        self.groups = groups
+        self.stats = {
+            name: GroupStats(voxels, quantiles)
+            for name in sorted(set(groups.values()))
+        }
+        self.threads = threads
+        bounds = np.linspace(0, voxels, threads + 1).astype(int)
+        self.ranges = list(zip(bounds[:-1], bounds[1:]))
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def update(self, ids, values):
+        rows = {}
+        for row, id in enumerate(ids):
+            if id in self.groups:
+                rows.setdefault(self.groups[id], []).append(row)
+
+        futures = [
+            self._executor.submit(self.stats[name].update, values[indices],
+                                  start, stop)
+            for name, indices in rows.items() for start, stop in self.ranges
+        ]
+        for future in futures:
+            future.result()
+
+        return sum([len(indices) for indices in rows.values()])
+
+    def run(self, batches):
+        count = 0
+        start = time.time()
+        for ids, values in batches:
+            count += self.update(ids, values)
+            elapsed = time.time() - start
+            logger.info(f'{count} maps, {count / elapsed:.2f} maps/s')
+        self._executor.shutdown(wait=True)
+
+        return self.stats
+
+
+# assign each subject to a group, by the value of a column or by bins of
+# it, or to a single group called all
+def load_groups(ids, groups_file=None, column=None, bins=None):
+    if groups_file is None:
+        return {id: 'all' for id in ids}
+
+    df = pd.read_csv(groups_file, index_col=0)
+    df.index = df.index.astype(str)
+    values = df[column].dropna()
+    if bins is not None:
+        values = pd.cut(values, bins=bins, right=False).dropna()
+        values = values.apply(
+            lambda bin: f'{column}_{bin.left:g}-{bin.right:g}')
+    else:
+        values = values.apply(lambda value: f'{column}_{value}')
+
+    ids = set(ids)
+    return {id: group for id, group in values.items() if id in ids}
+
+
+# (ids, values) batches of the maps in a store
+def iterate_store(store, model, ids=None):
+    yield from store.iterate(model, ids=ids)
+
+
+# (ids, values) batches of the maps in a folder of nifti files, restricted
+# to a mask
+def iterate_nifti(map_path, ids, mask, batch_size=16, filenames=None):
+    for batch_ids, maps, _ in iterate_batches(ids,
+                                              map_path,
+                                              batch_size,
+                                              normalize=False,
+                                              filenames=filenames):
+        yield batch_ids, maps[:, mask]
+
+
+# write the statistics of each group as nifti files
+def save_stats(stats, mask, affine, out_path):
+    for name, group in stats.items():
+        path = os.path.join(out_path, name)
+        os.makedirs(path, exist_ok=True)
+        for statistic, values in group.results().items():
+            volume = np.full(mask.shape, np.nan, dtype=np.float32)
+            volume[mask] = values
+            nib.save(nib.Nifti1Image(volume, affine),
+                     os.path.join(path, statistic + '.nii.gz'))
+
+
+# aggregate maps from a store or a folder of nifti files
+def aggregate_maps(args):
+    if args.store_path is not None:
+        store = SaliencyStore(args.store_path)
+        ids = store.ids(args.model)
+        mask, affine = store.mask, store.affine
+    else:
+        # maps may be stored as .nii or .nii.gz
+        filenames = {
+            f.split('.')[0]: f
+            for f in os.listdir(args.map_path) if not f.startswith('.')
+        }
+        ids = sorted(filenames)
+        reference = nib.load(os.path.join(args.map_path, filenames[ids[0]]))
+        affine = reference.affine
+        if args.brain_mask_file is not None:
+            mask = nib.load(args.brain_mask_file).get_fdata() > 0
+        else:
+            mask = np.ones(reference.shape, dtype=bool)
+
+    groups = load_groups(ids, args.groups_file, args.column, args.bins)
+    logger.info(f'Aggregating {len(groups)} maps in '
+                f'{len(set(groups.values()))} groups')
+
+    if args.store_path is not None:
+        batches = iterate_store(store, args.model, ids=list(groups))
+    else:
+        batches = iterate_nifti(args.map_path, list(groups), mask,
+                                args.batch_size, filenames)
+
+    aggregator = MapAggregator(int(np.sum(mask)),
+                               groups,
+                               quantiles=args.quantiles,
+                               threads=args.threads)
+    stats = aggregator.run(batches)
+    save_stats(stats, mask, affine, args.out_path)
+
+
+# pass in arguments
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Calculate voxelwise count, mean, '
+                                      'variance and percentiles of saliency '
+                                      'maps for groups of subjects, in one '
+                                      'pass over the maps'))
+
+    parser.add_argument('-s',
+                        '--store_path',
+                        required=False,
+                        default=None,
+                        help=('Path to saliency store'))
+    parser.add_argument('-m',
+                        '--model',
+                        required=False,
+                        default='pretrained',
+                        help=('Model of the maps in the store'))
+    parser.add_argument('-p',
+                        '--map_path',
+                        required=False,
+                        default=None,
+                        help=('Path to folder of NIfTI maps, used if no '
+                              'store is given'))
+    parser.add_argument('-b',
+                        '--brain_mask_file',
+                        required=False,
+                        default=None,
+                        help=('Path to brain mask for NIfTI maps'))
+    parser.add_argument('-o',
+                        '--out_path',
+                        required=True,
+                        help=('Path to store a folder of maps per group'))
+    parser.add_argument('-g',
+                        '--groups_file',
+                        required=False,
+                        default=None,
+                        help=('CSV with image ids as index. If not set, all '
+                              'maps form one group'))
+    parser.add_argument('-c',
+                        '--column',
+                        required=False,
+                        default=None,
+                        help=('Column of the groups file defining the '
+                              'groups, e.g. study or age'))
+    parser.add_argument('--bins',
+                        required=False,
+                        default=None,
+                        nargs='+',
+                        type=float,
+                        help=('Bin edges for a numeric column, e.g. '
+                              '0 20 40 60 80 100 for age bins'))
+    parser.add_argument('-q',
+                        '--quantiles',
+                        required=False,
+                        default=[0.5],
+                        nargs='+',
+                        type=float,
+                        help=('Quantiles to estimate, e.g. 0.5 0.9'))
+    parser.add_argument('-t',
+                        '--threads',
+                        required=False,
+                        default=4,
+                        type=int,
+                        help=('Number of voxel ranges updated in parallel'))
+    parser.add_argument('--batch_size',
+                        required=False,
+                        default=16,
+                        type=int,
+                        help=('Number of NIfTI maps loaded at once'))
+
+    args = parser.parse_args()
+    if (args.store_path is None) == (args.map_path is None):
+        parser.error('Either a store or a folder of maps is required')
+    if args.groups_file is not None and args.column is None:
+        parser.error('A groups file requires a column')
+    aggregate_maps(args)
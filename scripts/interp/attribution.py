@@ -0,0 +1,162 @@
+import time
+import logging
+import numpy as np
+import tensorflow as tf
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class InputGradients:
+    """Computes the gradients of the predictions of a model with respect to
+    its inputs, for batches of images in a compiled function.
+
+    The function is traced once per model, with the batch dimension left
+    open. Weights can be swapped with load_weights between batches without
+    retracing, so one engine serves every model of the same architecture.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.image_shape = tuple(model.input_shape[1:])
+
+        # the batch dimension is left open so the last, smaller batch
+        # does not trigger a new trace
+        signature = tf.TensorSpec((None, ) + self.image_shape, tf.float32)
+        self._gradients = tf.function(self._compute,
+                                      input_signature=[signature])
+
+    def _compute(self, images):
+        with tf.GradientTape() as tape:
+            tape.watch(images)
+            predictions = self.model(images, training=False)
+
+            # images do not interact in inference mode, so the gradient of
+            # the sum holds the gradient of each prediction for its image
+            total = tf.reduce_sum(predictions)
+
+        return tape.gradient(total, images)
+
+    def load_weights(self, weights):
+        self.model.load_weights(weights)
+
+    def __call__(self, images):
+        images = tf.convert_to_tensor(np.asarray(images, dtype=np.float32))
+        return self._gradients(images).numpy()
+
+    def generate(self, batches, writer):
+        """Computes maps for (ids, images, affines) batches and passes each
+        map to the writer as it is computed. Returns the number of maps and
+        the throughput in maps per second"""
+        count = 0
+        start = time.time()
+        for ids, images, affines in batches:
+            maps = self(images)
+            for id, map, affine in zip(ids, maps, affines):
+                writer.write(id, map, affine)
+            count += len(ids)
+            elapsed = time.time() - start
+            logger.info(f'{count} maps, {count / elapsed:.2f} maps/s')
+
+        elapsed = time.time() - start
+        throughput = count / elapsed if elapsed > 0 else 0.
+
+        return count, throughput
+
+
+class SmoothGrad(InputGradients):
+    """Averages the input gradients over noisy copies of each image.
+
+    The copies are drawn inside the compiled function and packed into
+    batches of chunk_size, so each chunk is a single forward and backward
+    pass, and memory is bounded by the chunk size rather than the number
+    of samples. The noise has a standard deviation of noise times the
+    intensity range of the image.
+    """
+
+    def __init__(self, model, samples=50, noise=0.15, chunk_size=8, seed=0):
+        super().__init__(model)
+        self.samples = samples
+        self.noise = noise
+        self.chunk_size = chunk_size
+        self._generator = tf.random.Generator.from_seed(seed)
+
+        image = tf.TensorSpec(self.image_shape, tf.float32)
+        scalar = tf.TensorSpec((), tf.float32)
+        count = tf.TensorSpec((), tf.int32)
+        self._chunk = tf.function(self._compute_chunk,
+                                  input_signature=[image, scalar, count])
+
+    def _compute_chunk(self, image, sigma, count):
+        shape = tf.concat([[count], tf.shape(image)], axis=0)
+        noise = self._generator.normal(shape) * sigma
+        gradients = self._compute(image[None] + noise)
+
+        return tf.reduce_sum(gradients, axis=0)
+
+    def attribute(self, image):
+        image = tf.convert_to_tensor(image, dtype=tf.float32)
+        sigma = self.noise * (tf.reduce_max(image) - tf.reduce_min(image))
+
+        total = tf.zeros_like(image)
+        for start in range(0, self.samples, self.chunk_size):
+            count = min(self.chunk_size, self.samples - start)
+            total += self._chunk(image, sigma, tf.constant(count))
+
+        return (total / self.samples).numpy()
+
+    def __call__(self, images):
+        return np.stack([self.attribute(image) for image in images])
+
+
+class IntegratedGradients(InputGradients):
+    """Integrates the input gradients along the straight path from a
+    baseline to each image, scaled by the difference between them.
+
+    The integral is approximated by the trapezoidal rule over steps + 1
+    points. The points are packed into batches of chunk_size, so each
+    chunk is a single forward and backward pass, and memory is bounded by
+    the chunk size rather than the number of steps.
+    """
+
+    def __init__(self, model, steps=50, baseline=0., chunk_size=8):
+        super().__init__(model)
+        self.steps = steps
+        self.baseline = baseline
+        self.chunk_size = chunk_size
+
+        image = tf.TensorSpec(self.image_shape, tf.float32)
+        vector = tf.TensorSpec((None, ), tf.float32)
+        self._chunk = tf.function(
+            self._compute_chunk,
+            input_signature=[image, image, vector, vector])
+
+    def _compute_chunk(self, image, baseline, alphas, weights):
+        alphas = tf.reshape(alphas, (-1, ) + (1, ) * len(self.image_shape))
+        path = baseline[None] + alphas * (image - baseline)[None]
+        gradients = self._compute(path)
+        weights = tf.reshape(weights, tf.shape(alphas))
+
+        return tf.reduce_sum(gradients * weights, axis=0)
+
+    def attribute(self, image):
+        image = tf.convert_to_tensor(image, dtype=tf.float32)
+        baseline = tf.broadcast_to(
+            tf.convert_to_tensor(self.baseline, dtype=tf.float32),
+            image.shape)
+
+        alphas = np.linspace(0, 1, self.steps + 1, dtype=np.float32)
+        weights = np.full(self.steps + 1, 1 / self.steps, dtype=np.float32)
+        weights[[0, -1]] /= 2
+
+        total = tf.zeros_like(image)
+        for start in range(0, len(alphas), self.chunk_size):
+            end = start + self.chunk_size
+            total += self._chunk(image, baseline, alphas[start:end],
+                                 weights[start:end])
+
+        return ((image - baseline) * total).numpy()
+
+    def __call__(self, images):
+        return np.stack([self.attribute(image) for image in images])
@@ -1,15 +1,9 @@
 import os
 import argparse
 import numpy as np
-import pandas as pd
 import nibabel as nib
 import matplotlib.pyplot as plt
-from nilearn.image import resample_to_img
-
-
-# convenience function to return path of parcellation
-def path(args, file):
-    return (os.path.join(args.parcellations_path, file))
+from region_stats import load_parcellations, RegionStatistics
 
 
 # plot feature contributions
@@ -67,91 +61,25 @@ def plot_feature_contributions(args):
     plt.savefig(out_file, bbox_inches='tight')
 
 
-# calculate feature contributions for a given parcellation
-# and return updated lists
-def calculate_feature_contributions(features, parcels, labels, is_wm, args):
-    for feature in features:
-        # select feature labels
-        feature_labels = pd.DataFrame()
-        if isinstance(feature, str):
-            feature_labels = labels[labels['label'] == feature]
-        elif isinstance(feature, list):
-            for region in feature:
-                region_labels = labels[labels['label'].str.contains(region)]
-                feature_labels = feature_labels.append(region_labels)
-
-        # calculate averaged contribution
-        feature_mask = np.isin(parcels, feature_labels['number'])
-        contribution = np.nanmean(args.map_array[feature_mask])
-
-        # update lists
-        if isinstance(feature, str):
-            args.all_features = args.all_features + [feature]
-        elif isinstance(feature, list):
-            if len(feature) > 1:
-                feature = [region[:3] for region in feature]
-            args.all_features = args.all_features + ['+'.join(feature)]
-        args.all_is_wm = args.all_is_wm + [is_wm]
-        args.all_contributions = args.all_contributions + [contribution]
-
-    return (args)
-
-
 # wrapper to calculate all feature contributions
 def calculate_all_feature_contributions(args):
     # load
     args.map_img = nib.load(args.map_file)
     args.map_array = args.map_img.get_fdata()
     args.brain_mask = nib.load(args.brain_mask_file).get_fdata() > 0
-    args.all_features = list()
-    args.all_contributions = list()
-    args.all_is_wm = list()
-
-    # keep top x percent of features
-    thr = np.percentile(args.map_array[args.brain_mask],
-                        args.percentile_threshold)
-    args.map_array[args.map_array < thr] = 0
-
-    # cortical gray matter
-    file = 'Schaefer2018_400Parcels_7Networks_order_FSLMNI152_1mm.nii.gz'
-    parcels = nib.load(path(args, file)).get_fdata()
-    file = 'Schaefer2018_400Parcels_7Networks_order.txt'
-    labels = pd.read_table(path(args, file),
-                           names=['number', 'label'],
-                           usecols=[0, 1])
-    labels['label'] = labels['label'].str.split('_').apply(lambda x: x[2])
-    features = labels['label'].unique()
-    is_wm = False
-    args = calculate_feature_contributions(features, parcels, labels, is_wm,
-                                           args)
 
-    # subcortical gray matter
-    file = 'AAL3v1_1mm.nii'
-    parcels = resample_to_img(nib.load(path(args, file)),
-                              args.map_img,
-                              interpolation='nearest').get_fdata()
-    file = 'AAL3v1_1mm.nii.txt'
-    labels = pd.read_table(path(args, file),
-                           sep=' ',
-                           names=['number', 'label'],
-                           usecols=[0, 1])
-    features = [['Hippocampus', 'Amygdala'], ['Putamen', 'Caudate'], ['Thal']]
-    is_wm = False
-    args = calculate_feature_contributions(features, parcels, labels, is_wm,
-                                           args)
-
-    # white matter
-    file = 'WM_48_ROIs_1mm.nii.gz'
-    parcels = nib.load(path(args, file)).get_fdata()
-    file = 'WM_labels.xlsx'
-    labels = pd.read_excel(path(args, file), sheet_name='ROI_48', header=1)
-    labels['number'] = labels.iloc[:, 0].str.split('_', expand=True)[0]
-    labels['number'] = labels['number'].astype(int)
-    labels['label'] = labels['Abbreviation']
-    features = labels['label'].unique()
-    is_wm = True
-    args = calculate_feature_contributions(features, parcels, labels, is_wm,
-                                           args)
+    # mean of each gray and white matter feature, keeping the top x percent
+    # of voxels within the brain
+    engine = RegionStatistics(
+        load_parcellations(args.parcellations_path, args.map_img,
+                           args.cache_path))
+    contributions = engine(args.map_array,
+                           statistic='thresholded_mean',
+                           percentile=args.percentile_threshold,
+                           brain_mask=args.brain_mask)
+    args.all_features = list(engine.names)
+    args.all_contributions = list(contributions.iloc[0])
+    args.all_is_wm = list(engine.is_wm)
 
     # plot
     plot_feature_contributions(args)
@@ -190,6 +118,12 @@ if __name__ == '__main__':
                         help=('Path to GM and WM parcellations. Assumes the '
                               'parcellations follow the same format as those '
                               'provided in the repository'))
+    parser.add_argument('-c',
+                        '--cache_path',
+                        required=False,
+                        default=None,
+                        help=('Optional path to cache the parcellations '
+                              'resampled to the grid of the maps'))
 
     args = parser.parse_args()
     calculate_all_feature_contributions(args)
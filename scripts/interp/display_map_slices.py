@@ -31,6 +31,15 @@ def display_map_slices(args):
     if not os.path.exists(args.out_path):
         os.makedirs(args.out_path)
 
+    # threshold, once for all slices
+    if args.percentile_thresholds:
+        brain_mask = nib.load(args.brain_mask_file).get_fdata() > 0
+        lower_thr, upper_thr = np.percentile(map_array[brain_mask],
+                                             args.thresholds)
+    else:
+        lower_thr = args.thresholds[0]
+        upper_thr = args.thresholds[1]
+
     # loop through slices
     for slice in args.slices:
         if slice[0] == 'x':
@@ -46,16 +55,6 @@ def display_map_slices(args):
             ('_%s%d.png') % (slice[0], slice[1])
 
         # threshold
-        if args.percentile_thresholds:
-            brain_mask = nib.load(args.brain_mask_file).get_fdata() > 0
-            lower_thr = np.percentile(map_array[brain_mask],
-                                      args.thresholds[0])
-            upper_thr = np.percentile(map_array[brain_mask],
-                                      args.thresholds[1])
-        else:
-            lower_thr = args.thresholds[0]
-            upper_thr = args.thresholds[1]
-
         map_slice[map_slice < lower_thr] = np.nan
         map_slice[map_slice > upper_thr] = upper_thr
 
@@ -95,6 +94,9 @@ def display_map_slices(args):
                         transparent=True,
                         bbox_inches='tight')
 
+        # release the figures of the slice
+        plt.close('all')
+
 
 # pass in arguments
 if __name__ == '__main__':
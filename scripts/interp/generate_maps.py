@@ -1,14 +1,75 @@
 import os
+import logging
+import keras
 import pandas as pd
-from generate_maps_by_image import generate_for_image
+from pyment.models import get as get_model
+import nibabel as nib
+from guided_backprop import get_engine, iterate_batches, NiftiMapWriter
+from region_stats import CROP_BOUNDS
+from saliency_store import load_mask, SaliencyStore
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+keras.utils.set_random_seed(0)
 
 # variables
 pred_file = 'output/prediction/finetuned/predictions.csv'
 data_path = 'data/prediction/cropped/images'
 out_path = 'output/interp/guided_backprop_maps'
+batch_size = 4
+dropout_rate = 0.3
+weight_decay = 1e-3
+
+# attribution method, one of guided_backprop, smoothgrad and
+# integrated_gradients, with its options (e.g. samples or steps, and the
+# chunk_size bounding how many are computed in one pass)
+method = 'guided_backprop'
+options = {}
+
+# optional saliency store, holding the maps inside the brain mask as
+# float16 instead of one nifti file per map
+store_path = None
+mask_file = None
+
 
-# loop through predictions
+# writer of the maps of a model, to the store or as nifti files
+def map_writer(model, shape):
+    if store_path is None:
+        return NiftiMapWriter(os.path.join(out_path, model))
+
+    mask = load_mask(mask_file, shape, bounds=CROP_BOUNDS)
+    store = SaliencyStore.create(store_path, mask, nib.load(mask_file).affine)
+    return store.writer(model)
+
+
+# subjects and the finetuned weights each was predicted with
 df_pred = pd.read_csv(pred_file, index_col=0)
-for id in df_pred.index:
-    weights = os.path.join(df_pred.loc[id, 'src_path'], 'best_model.h5')
-    generate_for_image(id, data_path, out_path, weights)
+df_pred.index = df_pred.index.astype(str)
+weights = df_pred['src_path'].apply(
+    lambda src_path: os.path.join(src_path, 'best_model.h5'))
+
+# pretrained model, for the whole cohort at once
+engine = get_engine(method, get_model('sfcn-reg', weights='brain-age'),
+                    **options)
+with map_writer('pretrained', engine.image_shape) as writer:
+    count, throughput = engine.generate(
+        iterate_batches(list(df_pred.index), data_path, batch_size), writer)
+logger.info(f'pretrained: {count} maps at {throughput:.2f} maps/s')
+
+# finetuned models, one engine whose weights are swapped per model
+engine = get_engine(
+    method,
+    get_model('sfcn-reg',
+              weights=None,
+              dropout=dropout_rate,
+              weight_decay=weight_decay,
+              prediction_range=None), **options)
+with map_writer('finetuned', engine.image_shape) as writer:
+    for model_weights, ids in weights.groupby(weights).groups.items():
+        engine.load_weights(model_weights)
+        count, throughput = engine.generate(
+            iterate_batches(list(ids), data_path, batch_size), writer)
+        logger.info(
+            f'{model_weights}: {count} maps at {throughput:.2f} maps/s')
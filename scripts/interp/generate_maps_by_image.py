@@ -2,23 +2,13 @@ import os
 import keras
 import argparse
 import nibabel as nib
-import tensorflow as tf
 import matplotlib.pyplot as plt
 from pyment.models import get as get_model
+from guided_backprop import get_engine, METHODS
 
 keras.utils.set_random_seed(0)
 
 
-# modify gradient
-@tf.custom_gradient
-def guidedRelu(x):
-
-    def grad(dy):
-        return tf.cast(dy > 0, tf.float32) * tf.cast(x > 0, tf.float32) * dy
-
-    return tf.nn.relu(x), grad
-
-
 # show and optionally save 2D slices
 def show_slices(img, filename=None, x=77, y=127, z=73):
     # setup
@@ -37,31 +27,25 @@ def show_slices(img, filename=None, x=77, y=127, z=73):
     # save
     if filename is not None:
         plt.savefig(filename)
+    plt.close(fig)
 
 
 # map for given model
-def generate_for_model(model, img, affine, filename, save_slices):
-    # change to guided relu
-    layer_dict = [
-        layer for layer in model.layers[1:] if hasattr(layer, 'activation')
-    ]
-    for layer in layer_dict:
-        if layer.activation == keras.activations.relu:
-            layer.activation = guidedRelu
-
-    # calculate gradients
-    input = tf.expand_dims(img, axis=0)
-    with tf.GradientTape() as tape:
-        tape.watch(input)
-        result = model(input)
-    grads = tape.gradient(result, input)
-    grads = grads.numpy().squeeze()
+def generate_for_model(model,
+                       img,
+                       affine,
+                       filename,
+                       save_slices,
+                       method='guided_backprop',
+                       **options):
+    # calculate map with the given attribution method
+    grads = get_engine(method, model, **options)(img[None])[0]
 
     # save
     if save_slices:
         show_slices(grads, filename=filename)
     map = nib.Nifti1Image(grads, affine)
-    nib.save(map, filename)
+    nib.save(map, filename + '.nii.gz')
 
 
 # maps for given image
@@ -72,7 +56,9 @@ def generate_for_image(id,
                        save_slices=False,
                        normalize=True,
                        dropout_rate=0.3,
-                       weight_decay=1e-3):
+                       weight_decay=1e-3,
+                       method='guided_backprop',
+                       **options):
     # load
     nii_orig = nib.load(os.path.join(data_path, id + '.nii.gz'))
     img = nii_orig.get_fdata()
@@ -92,7 +78,8 @@ def generate_for_image(id,
     path = os.path.join(out_path, 'pretrained')
     os.makedirs(path, exist_ok=True)
     filename = os.path.join(path, id)
-    generate_for_model(model, img, affine, filename, save_slices)
+    generate_for_model(model, img, affine, filename, save_slices, method,
+                       **options)
 
     # for finetuned model
     if weights is not None:
@@ -105,13 +92,15 @@ def generate_for_image(id,
         path = os.path.join(out_path, 'finetuned')
         os.makedirs(path, exist_ok=True)
         filename = os.path.join(path, id)
-        generate_for_model(model, img, affine, filename, save_slices)
+        generate_for_model(model, img, affine, filename, save_slices, method,
+                           **options)
 
 
 # pass in arguments
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(('Generate guided backpropagation map(s) '
-                                      'for one image'))
+    parser = argparse.ArgumentParser(('Generate guided backpropagation, '
+                                      'SmoothGrad or Integrated Gradients '
+                                      'map(s) for one image'))
 
     parser.add_argument('-i', '--id', required=True, help=('Image id'))
     parser.add_argument('-d',
@@ -151,7 +140,48 @@ if __name__ == '__main__':
                         type=float,
                         help=('Weight decay hyperparameter'))
 
+    parser.add_argument('-a',
+                        '--method',
+                        required=False,
+                        default='guided_backprop',
+                        choices=list(METHODS),
+                        help=('Attribution method'))
+    parser.add_argument('--samples',
+                        required=False,
+                        default=50,
+                        type=int,
+                        help=('Number of noisy copies averaged by SmoothGrad'))
+    parser.add_argument('--noise',
+                        required=False,
+                        default=0.15,
+                        type=float,
+                        help=('Standard deviation of the SmoothGrad noise, '
+                              'relative to the intensity range of the image'))
+    parser.add_argument('--steps',
+                        required=False,
+                        default=50,
+                        type=int,
+                        help=('Number of steps from the baseline to the '
+                              'image in Integrated Gradients'))
+    parser.add_argument('-c',
+                        '--chunk_size',
+                        required=False,
+                        default=8,
+                        type=int,
+                        help=('Number of SmoothGrad samples or Integrated '
+                              'Gradients steps computed in one pass. Bounds '
+                              'the memory used'))
+
     args = parser.parse_args()
+    options = {}
+    if args.method == 'smoothgrad':
+        options = {
+            'samples': args.samples,
+            'noise': args.noise,
+            'chunk_size': args.chunk_size
+        }
+    elif args.method == 'integrated_gradients':
+        options = {'steps': args.steps, 'chunk_size': args.chunk_size}
     generate_for_image(args.id, args.data_path, args.out_path, args.weights,
                        args.save_slices, args.normalize, args.dropout_rate,
-                       args.weight_decay)
+                       args.weight_decay, args.method, **options)
@@ -0,0 +1,139 @@
+import os
+import logging
+import numpy as np
+import nibabel as nib
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+from attribution import InputGradients, IntegratedGradients, SmoothGrad
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# relu whose gradient only passes positive gradients through positive inputs
+@tf.custom_gradient
+def guidedRelu(x):
+
+    def grad(dy):
+        return tf.cast(dy > 0, dy.dtype) * tf.cast(x > 0, dy.dtype) * dy
+
+    return tf.nn.relu(x), grad
+
+
+# swap the relu activations of a model for guided relus, in place
+def apply_guided_relu(model):
+    patched = 0
+    for layer in model.layers[1:]:
+        activation = getattr(layer, 'activation', None)
+        if getattr(activation, '__name__', None) == 'relu':
+            layer.activation = guidedRelu
+            patched += 1
+
+    return patched
+
+
+class GuidedBackprop(InputGradients):
+    """Computes guided backpropagation maps for batches of images.
+
+    The relu activations of the model are replaced once, before the input
+    gradients are traced, so the guided graph is built once per model.
+    """
+
+    def __init__(self, model):
+        self.patched = apply_guided_relu(model)
+        if self.patched == 0:
+            logger.warning('No relu activations found in the model')
+
+        super().__init__(model)
+
+
+METHODS = {
+    'guided_backprop': GuidedBackprop,
+    'smoothgrad': SmoothGrad,
+    'integrated_gradients': IntegratedGradients
+}
+
+
+# build the attribution engine of a method for a model
+def get_engine(method, model, **options):
+    if method not in METHODS:
+        raise ValueError(f'Unknown attribution method {method}')
+
+    return METHODS[method](model, **options)
+
+
+# load an image and its affine
+def load_image(path, normalize=True):
+    nii = nib.load(path)
+    img = nii.get_fdata(dtype=np.float32)
+    if normalize:
+        img = img / 255
+
+    return img, nii.affine
+
+
+# yield (ids, images, affines) batches, loading the next batch in the
+# background while the current one is processed. Images are read from
+# <id>.nii.gz, unless the file name of each id is given
+def iterate_batches(ids,
+                    data_path,
+                    batch_size,
+                    normalize=True,
+                    threads=4,
+                    filenames=None):
+    if filenames is None:
+        filenames = {id: id + '.nii.gz' for id in ids}
+    paths = [os.path.join(data_path, filenames[id]) for id in ids]
+    chunks = [(ids[i:i + batch_size], paths[i:i + batch_size])
+              for i in range(0, len(ids), batch_size)]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+
+        def submit(chunk):
+            return [executor.submit(load_image, path, normalize)
+                    for path in chunk[1]]
+
+        pending = submit(chunks[0]) if len(chunks) > 0 else None
+        for i, chunk in enumerate(chunks):
+            loaded = [future.result() for future in pending]
+            if i + 1 < len(chunks):
+                pending = submit(chunks[i + 1])
+
+            images = np.stack([img for img, _ in loaded])
+            affines = [affine for _, affine in loaded]
+            yield chunk[0], images, affines
+
+
+class NiftiMapWriter:
+    """Writes each map as a NIfTI file in a folder. Files are written by a
+    background thread, with at most max_pending maps held in memory"""
+
+    def __init__(self, out_path, max_pending=8):
+        self.out_path = out_path
+        os.makedirs(out_path, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+        self.max_pending = max_pending
+
+    def _save(self, id, map, affine):
+        nib.save(nib.Nifti1Image(map, affine),
+                 os.path.join(self.out_path, id + '.nii.gz'))
+
+    def write(self, id, map, affine):
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+        self._pending.append(
+            self._executor.submit(self._save, id, map, affine))
+
+    def close(self):
+        for future in self._pending:
+            future.result()
+        self._pending = []
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,294 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import tensorflow as tf
+from pyment.models import get as get_model
+from pyment.models.utils import TiledExecutor
+from guided_backprop import iterate_batches
+from region_stats import (CROP_BOUNDS, TEMPLATE, feature_masks,
+                          load_parcellations)
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# load the features of the shipped parcellations in the space of the
+# cropped images, as one volume of feature indices per parcellation
+def load_parcels(parcellations_path, bounds=CROP_BOUNDS):
+    reference = nib.load(os.path.join(parcellations_path, TEMPLATE))
+    crop = tuple(slice(*bound) for bound in bounds)
+
+    atlases = []
+    for features, parcels, labels, is_wm in load_parcellations(
+            parcellations_path, reference):
+        volume = np.zeros(parcels[crop].shape, dtype=np.int32)
+        names = []
+        for name, mask in feature_masks(features, parcels, labels):
+            mask = mask[crop]
+            if not np.any(mask):
+                logger.warning(f'Feature {name} is outside the cropped '
+                               'volume')
+                continue
+            if np.any(volume[mask] > 0):
+                raise ValueError(f'Feature {name} overlaps another feature '
+                                 'of the same parcellation')
+            names.append(name)
+            volume[mask] = len(names)
+        atlases.append({'names': names, 'volume': volume, 'is_wm': is_wm})
+
+    return atlases
+
+
+class ParcelOcclusion:
+    """Computes how much the prediction for each subject changes when each
+    parcel is occluded (set to the fill value). Deltas are the occluded
+    prediction minus the prediction for the intact image.
+
+    Without reuse, the occluded copies of an image are built on the device
+    from the feature index volumes, chunk_size parcels at a time, and run
+    as one batch. With reuse_features, the features of the intact images
+    after the first blocks of the model are computed once per batch of
+    subjects. For each parcel only the region of those features that the
+    parcel can reach is recomputed, and spliced into the intact features.
+    The spliced features of chunk_size parcels are run through the rest of
+    the model as one batch. This saves most of the compute
+    for small parcels, while parcels spanning the brain cost as much as a
+    full pass.
+    """
+
+    def __init__(self,
+                 model,
+                 atlases,
+                 fill=0.,
+                 chunk_size=8,
+                 reuse_features=False,
+                 blocks=2):
+        self.model = model
+        self.atlases = atlases
+        self.fill = fill
+        self.chunk_size = chunk_size
+        self.reuse_features = reuse_features
+        self.names = [name for atlas in atlases for name in atlas['names']]
+
+        shape = tuple(model.input_shape[1:])
+        for atlas in atlases:
+            if atlas['volume'].shape != shape:
+                raise ValueError(f'Parcellation of shape '
+                                 f'{atlas["volume"].shape} does not match '
+                                 f'model input {shape}')
+
+        image = tf.TensorSpec(shape, tf.float32)
+        volume = tf.TensorSpec(shape, tf.int32)
+        indices = tf.TensorSpec((None, ), tf.int32)
+        self._occluded = tf.function(self._predict_occluded,
+                                     input_signature=[image, volume, indices])
+
+        if reuse_features:
+            self.executor = TiledExecutor(model, blocks=blocks,
+                                          tiles=(1, 1, 1))
+            self._regions = [[
+                self.executor.region(atlas['volume'] == index + 1)
+                for index in range(len(atlas['names']))
+            ] for atlas in atlases]
+
+    def _predict_occluded(self, image, volume, indices):
+        masks = tf.equal(volume[None], indices[:, None, None, None])
+        images = tf.where(masks, tf.cast(self.fill, tf.float32), image[None])
+
+        return tf.reshape(self.model(images, training=False), [-1])
+
+    def _predict(self, images):
+        return self.model.predict(images, batch_size=len(images),
+                                  verbose=0).reshape(-1)
+
+    def _occlude_chunked(self, image):
+        deltas = []
+        for atlas in self.atlases:
+            indices = np.arange(1, len(atlas['names']) + 1, dtype=np.int32)
+            for start in range(0, len(indices), self.chunk_size):
+                deltas.append(
+                    self._occluded(
+                        tf.convert_to_tensor(image, dtype=tf.float32),
+                        atlas['volume'],
+                        indices[start:start + self.chunk_size]).numpy())
+
+        return np.concatenate(deltas)
+
+    def _occlude_reused(self, images, baseline):
+        features = self.executor.features(images)
+        parcels = [(atlas, index, region)
+                   for atlas, regions in zip(self.atlases, self._regions)
+                   for index, region in enumerate(regions)]
+
+        deltas = []
+        for start in range(0, len(parcels), self.chunk_size):
+            # the spliced features of a chunk of parcels go through the
+            # rest of the model as one batch
+            spliced = []
+            for atlas, index, region in parcels[start:start +
+                                                self.chunk_size]:
+                mask = atlas['volume'] == index + 1
+                occluded = np.where(mask[None], self.fill,
+                                    images).astype(np.float32)
+                copy = features.copy()
+                (y0, y1), (x0, x1), (z0, z1) = region
+                copy[:, y0:y1, x0:x1, z0:z1] = self.executor.features_in(
+                    occluded, region)
+                spliced.append(copy)
+
+            spliced = np.concatenate(spliced)
+            predictions = self.executor.tail.predict(
+                spliced, batch_size=len(spliced), verbose=0)
+            deltas.append(
+                predictions.reshape(-1, len(images)) - baseline[None])
+
+        return np.concatenate(deltas).T
+
+    def __call__(self, images):
+        """Returns the deltas of a batch of images, as an array of shape
+        (images, parcels)"""
+        images = np.asarray(images, dtype=np.float32)
+        baseline = self._predict(images)
+
+        if self.reuse_features:
+            return self._occlude_reused(images, baseline)
+
+        return np.stack([
+            self._occlude_chunked(image) - prediction
+            for image, prediction in zip(images, baseline)
+        ])
+
+    def generate(self, batches):
+        """Computes the deltas for (ids, images, affines) batches. Returns
+        a subjects by parcels dataframe"""
+        tables = []
+        count = 0
+        start = time.time()
+        for ids, images, _ in batches:
+            tables.append(
+                pd.DataFrame(self(images), index=ids, columns=self.names))
+            count += len(ids)
+            elapsed = time.time() - start
+            logger.info(f'{count} subjects, {count / elapsed:.2f} '
+                        'subjects/s')
+
+        table = pd.concat(tables)
+        table.index.name = 'id'
+
+        return table
+
+
+# occlusion table for a cohort
+def occlude_cohort(args):
+    if args.ids is not None:
+        ids = list(pd.read_csv(args.ids, index_col=0).index.astype(str))
+    else:
+        ids = sorted(
+            [f.split('.')[0] for f in os.listdir(args.data_path)])
+
+    if args.weights is not None:
+        model = get_model('sfcn-reg',
+                          weights=None,
+                          dropout=args.dropout_rate,
+                          weight_decay=args.weight_decay,
+                          prediction_range=None)
+        model.load_weights(args.weights)
+    else:
+        model = get_model('sfcn-reg', weights='brain-age')
+
+    engine = ParcelOcclusion(model,
+                             load_parcels(args.parcellations_path),
+                             fill=args.fill,
+                             chunk_size=args.chunk_size,
+                             reuse_features=args.reuse_features)
+    table = engine.generate(
+        iterate_batches(ids, args.data_path, args.batch_size,
+                        args.normalize))
+
+    os.makedirs(os.path.dirname(args.out_file) or '.', exist_ok=True)
+    table.to_csv(args.out_file)
+
+
+# pass in arguments
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Calculate the change in predicted '
+                                      'brain age when each GM and WM parcel '
+                                      'is occluded, for a cohort'))
+
+    parser.add_argument('-d',
+                        '--data_path',
+                        required=True,
+                        help=('Path to cropped input images'))
+    parser.add_argument('-o',
+                        '--out_file',
+                        required=True,
+                        help=('Path to CSV of subjects by parcels'))
+    parser.add_argument('-a',
+                        '--parcellations_path',
+                        required=True,
+                        help=('Path to GM and WM parcellations. Assumes the '
+                              'parcellations follow the same format as those '
+                              'provided in the repository'))
+    parser.add_argument('-i',
+                        '--ids',
+                        required=False,
+                        default=None,
+                        help=('Optional CSV with image ids as index. If not '
+                              'set, all images in data_path are used'))
+    parser.add_argument('-w',
+                        '--weights',
+                        required=False,
+                        default=None,
+                        help=('Path to weights of finetuned model. If not '
+                              'set, the pretrained model is used'))
+    parser.add_argument('-n',
+                        '--normalize',
+                        action='store_true',
+                        help=('If set, images will be normalized to range '
+                              '(0, 1) before occlusion'))
+    parser.add_argument('-f',
+                        '--fill',
+                        required=False,
+                        default=0.,
+                        type=float,
+                        help=('Value occluded parcels are set to'))
+    parser.add_argument('-b',
+                        '--batch_size',
+                        required=False,
+                        default=4,
+                        type=int,
+                        help=('Number of subjects processed at once'))
+    parser.add_argument('-c',
+                        '--chunk_size',
+                        required=False,
+                        default=8,
+                        type=int,
+                        help=('Number of parcels whose occluded copies are '
+                              'run in one batch'))
+    parser.add_argument('-u',
+                        '--reuse_features',
+                        action='store_true',
+                        help=('If set, the features of the intact images '
+                              'after the first blocks are reused, and only '
+                              'the region each parcel can reach is '
+                              'recomputed'))
+    parser.add_argument('-r',
+                        '--dropout_rate',
+                        required=False,
+                        default=0.3,
+                        type=float,
+                        help=('Probability of dropout for dropout layers'))
+    parser.add_argument('-g',
+                        '--weight_decay',
+                        required=False,
+                        default=1e-3,
+                        type=float,
+                        help=('Weight decay hyperparameter'))
+
+    args = parser.parse_args()
+    occlude_cohort(args)
@@ -0,0 +1,445 @@
+import os
+import hashlib
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import sparse
+from nilearn.image import resample_to_img
+from saliency_store import SaliencyStore
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# bounds used to crop the MNI152 registered images before prediction
+CROP_BOUNDS = ((6, 173), (2, 214), (0, 160))
+TEMPLATE = 'Schaefer2018_400Parcels_7Networks_order_FSLMNI152_1mm.nii.gz'
+STATISTICS = ['mean', 'sum', 'thresholded_mean']
+
+# changed when the layout of cached parcellations changes
+ATLAS_CACHE_VERSION = '1'
+
+
+# yield the name and label numbers of each feature of a parcellation
+def feature_labels(features, labels):
+    for feature in features:
+        # select feature labels
+        feature_labels = pd.DataFrame()
+        if isinstance(feature, str):
+            feature_labels = labels[labels['label'] == feature]
+        elif isinstance(feature, list):
+            feature_labels = pd.concat([
+                labels[labels['label'].str.contains(region)]
+                for region in feature
+            ])
+
+        # name
+        if isinstance(feature, list):
+            if len(feature) > 1:
+                feature = [region[:3] for region in feature]
+            feature = '+'.join(feature)
+
+        yield feature, feature_labels['number'].values
+
+
+# yield the name and mask of each feature of a parcellation
+def feature_masks(features, parcels, labels):
+    for feature, numbers in feature_labels(features, labels):
+        yield feature, np.isin(parcels, numbers)
+
+
+# sparse (features, voxels) indicator of the voxels of each feature of a
+# parcellation, as the product of a (features, labels) selection and a
+# one-hot encoding of the label of every voxel in any feature
+def feature_indicator(features, parcels, labels):
+    parcels = np.rint(np.ravel(parcels)).astype(np.int64)
+
+    names = []
+    rows = []
+    numbers = []
+    for name, feature_numbers in feature_labels(features, labels):
+        rows.append(np.full(len(feature_numbers), len(names)))
+        numbers.append(np.asarray(feature_numbers, dtype=np.int64))
+        names.append(name)
+    rows = np.concatenate(rows + [np.zeros(0, dtype=np.int64)])
+    numbers = np.concatenate(numbers + [np.zeros(0, dtype=np.int64)])
+    size = int(max(np.max(parcels, initial=0), np.max(numbers,
+                                                      initial=0))) + 1
+    selection = sparse.csr_matrix((np.ones(len(rows)), (rows, numbers)),
+                                  shape=(len(names), size))
+    selection.data[:] = 1
+
+    selected = np.zeros(size, dtype=bool)
+    selected[numbers] = True
+    voxels = np.flatnonzero(selected[parcels])
+    one_hot = sparse.csr_matrix(
+        (np.ones(len(voxels)), (parcels[voxels], voxels)),
+        shape=(size, len(parcels)))
+
+    return names, (selection @ one_hot).tocsr()
+
+
+# label tables of the shipped parcellations, with number and label columns
+def read_schaefer_labels(file):
+    labels = pd.read_table(file, names=['number', 'label'], usecols=[0, 1])
+    labels['label'] = labels['label'].str.split('_').apply(lambda x: x[2])
+
+    return labels
+
+
+def read_aal_labels(file):
+    return pd.read_table(file,
+                         sep=' ',
+                         names=['number', 'label'],
+                         usecols=[0, 1])
+
+
+def read_wm_labels(file):
+    labels = pd.read_excel(file, sheet_name='ROI_48', header=1)
+    labels['number'] = labels.iloc[:, 0].str.split('_', expand=True)[0]
+    labels['number'] = labels['number'].astype(int)
+    labels['label'] = labels['Abbreviation']
+
+    return labels[['number', 'label']]
+
+
+# key of a parcellation resampled to a grid, from the contents of its files
+# and the affine and shape of the grid
+def atlas_key(files, reference):
+    key = hashlib.sha256(ATLAS_CACHE_VERSION.encode())
+    for file in files:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+    key.update(np.round(np.asarray(reference.affine, dtype=np.float64),
+                        6).tobytes())
+    key.update(np.asarray(reference.shape[:3], dtype=np.int64).tobytes())
+
+    return key.hexdigest()
+
+
+# load a parcellation resampled to the reference image and its label table.
+# With a cache path, both are stored as one .npz file per parcellation and
+# grid, so each parcellation is resampled once per grid
+def load_atlas(atlas_file, label_file, read_labels, reference,
+               cache_path=None):
+    if cache_path is not None:
+        key = atlas_key([atlas_file, label_file], reference)
+        cache_file = os.path.join(cache_path, f'{key}.npz')
+        if os.path.isfile(cache_file):
+            with np.load(cache_file, allow_pickle=False) as cached:
+                labels = pd.DataFrame({
+                    'number': cached['number'],
+                    'label': cached['label']
+                })
+                return cached['parcels'], labels
+
+    parcels = resample_to_img(nib.load(atlas_file),
+                              reference,
+                              interpolation='nearest').get_fdata()
+    parcels = np.rint(parcels).astype(np.int32)
+    labels = read_labels(label_file)
+
+    if cache_path is not None:
+        # the file is in place only once complete, so concurrent readers
+        # never see a partial cache entry
+        os.makedirs(cache_path, exist_ok=True)
+        partial = os.path.join(cache_path,
+                               f'.partial-{key}-{os.getpid()}.npz')
+        np.savez(partial,
+                 parcels=parcels,
+                 number=labels['number'].to_numpy(dtype=np.int64),
+                 label=labels['label'].to_numpy(dtype=str))
+        os.replace(partial, cache_file)
+
+    return parcels, labels
+
+
+# load the gm and wm parcellations, resampled to the reference image, as
+# (features, parcels, labels, is_wm) tuples
+def load_parcellations(parcellations_path, reference, cache_path=None):
+    parcellations = []
+
+    # cortical gray matter
+    parcels, labels = load_atlas(
+        os.path.join(parcellations_path, TEMPLATE),
+        os.path.join(parcellations_path,
+                     'Schaefer2018_400Parcels_7Networks_order.txt'),
+        read_schaefer_labels, reference, cache_path)
+    features = labels['label'].unique()
+    parcellations.append((features, parcels, labels, False))
+
+    # subcortical gray matter
+    parcels, labels = load_atlas(
+        os.path.join(parcellations_path, 'AAL3v1_1mm.nii'),
+        os.path.join(parcellations_path, 'AAL3v1_1mm.nii.txt'),
+        read_aal_labels, reference, cache_path)
+    features = [['Hippocampus', 'Amygdala'], ['Putamen', 'Caudate'], ['Thal']]
+    parcellations.append((features, parcels, labels, False))
+
+    # white matter
+    parcels, labels = load_atlas(
+        os.path.join(parcellations_path, 'WM_48_ROIs_1mm.nii.gz'),
+        os.path.join(parcellations_path, 'WM_labels.xlsx'), read_wm_labels,
+        reference, cache_path)
+    features = labels['label'].unique()
+    parcellations.append((features, parcels, labels, True))
+
+    return (parcellations)
+
+
+class RegionStatistics:
+    """Computes statistics of maps within the features (regions) of one or
+    more parcellations.
+
+    Each parcellation is turned once into a sparse (regions, voxels)
+    indicator matrix, so the region sums of one map or of a whole stack of
+    maps are a single sparse matrix product, instead of a pass over the
+    volume per region. Maps are given as volumes, or as the values inside
+    a mask, e.g. as read from a saliency store. Voxels outside the mask
+    count as zeros, so results are those of the full volumes. Missing
+    (NaN) values are left out of sums and means.
+
+    Statistics:
+        mean: mean of each region
+        sum: sum of each region
+        thresholded_mean: mean of each region after setting values below
+            a percentile of the map within the brain mask to zero
+    """
+
+    def __init__(self, parcellations, mask=None, bounds=None):
+        crop = tuple(slice(*bound) for bound in bounds or [])
+
+        self.names = []
+        self.is_wm = []
+        indicators = []
+        self.shape = None
+        for features, parcels, labels, is_wm in parcellations:
+            parcels = np.asarray(parcels)[crop]
+            if self.shape is not None and parcels.shape != self.shape:
+                raise ValueError('Parcellations are of different shapes')
+            self.shape = parcels.shape
+
+            names, indicator = feature_indicator(features, parcels, labels)
+            self.names += list(names)
+            self.is_wm += [is_wm] * len(names)
+            indicators.append(indicator)
+        indicator = sparse.vstack(indicators).tocsr()
+
+        # region sizes of the full volume, before voxels outside the mask
+        # are left out
+        self.sizes = np.asarray(indicator.sum(axis=1)).reshape(-1)
+        self.mask = mask
+        if mask is not None:
+            if tuple(mask.shape) != self.shape:
+                raise ValueError(f'Mask of shape {mask.shape} does not match '
+                                 f'parcellations of shape {self.shape}')
+            indicator = indicator[:, np.flatnonzero(np.ravel(mask))]
+        self.indicator = indicator
+
+        for name, size in zip(self.names, self.sizes):
+            if size == 0:
+                logger.warning(f'Feature {name} is empty')
+
+    @property
+    def regions(self):
+        return pd.DataFrame({
+            'region': self.names,
+            'is_wm': self.is_wm,
+            'voxels': self.sizes.astype(int)
+        })
+
+    def values(self, maps):
+        """Returns maps as a (maps, voxels) array of the voxels the regions
+        are defined for. Maps are a volume, a stack of volumes, or values
+        inside the mask"""
+        maps = np.asarray(maps)
+        if not np.issubdtype(maps.dtype, np.floating):
+            maps = maps.astype(np.float32)
+        if maps.shape == self.shape or maps.ndim == 1:
+            maps = maps[None]
+
+        if maps.shape[1:] == self.shape:
+            if self.mask is not None:
+                maps = maps[:, self.mask]
+            else:
+                maps = maps.reshape(len(maps), -1)
+        if maps.shape[1] != self.indicator.shape[1]:
+            raise ValueError(f'Maps of shape {maps.shape[1:]} do not match '
+                             f'regions of shape {self.shape}')
+
+        return maps
+
+    def __call__(self,
+                 maps,
+                 statistic='mean',
+                 percentile=90,
+                 brain_mask=None,
+                 ids=None):
+        """Returns a maps by regions dataframe of a statistic. The
+        percentile of thresholded_mean is taken within the brain mask, or
+        within all voxels if not given"""
+        if statistic not in STATISTICS:
+            raise ValueError(f'Unknown statistic {statistic}, must be one of '
+                             f'{STATISTICS}')
+        values = self.values(maps)
+
+        if statistic == 'thresholded_mean':
+            brain = slice(None)
+            if brain_mask is not None:
+                brain = self.values(brain_mask)[0] > 0
+            threshold = np.percentile(values[:, brain], percentile, axis=1)
+            values = np.where(values < threshold[:, None], 0, values)
+
+        missing = np.isnan(values)
+        sums = self.indicator @ np.where(missing, 0, values).T
+
+        if statistic == 'sum':
+            results = sums
+        else:
+            counts = self.sizes[:, None]
+            if np.any(missing):
+                counts = counts - self.indicator @ missing.T.astype(float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                results = sums / counts
+
+        table = pd.DataFrame(np.asarray(results).T,
+                             index=ids,
+                             columns=self.names)
+        table.index.name = 'id'
+
+        return table
+
+    def generate(self, batches, **kwargs):
+        """Computes a statistic for (ids, maps) batches. Returns a subjects
+        by regions dataframe"""
+        tables = []
+        count = 0
+        start = time.time()
+        for ids, maps in batches:
+            tables.append(self(maps, ids=ids, **kwargs))
+            count += len(ids)
+            elapsed = time.time() - start
+            logger.info(f'{count} maps, {count / elapsed:.2f} maps/s')
+
+        return pd.concat(tables)
+
+
+# yield (ids, maps) batches of the nifti maps in a folder
+def iterate_maps(map_path, batch_size):
+    files = sorted(
+        [f for f in os.listdir(map_path) if f.endswith(('.nii', '.nii.gz'))])
+    for start in range(0, len(files), batch_size):
+        batch = files[start:start + batch_size]
+        yield ([f.split('.')[0] for f in batch],
+               np.stack([
+                   nib.load(os.path.join(map_path, f)).get_fdata(
+                       dtype=np.float32) for f in batch
+               ]))
+
+
+# region statistics for the maps of a store or a folder
+def region_stats(args):
+    if args.store_path is not None:
+        store = SaliencyStore(args.store_path)
+        reference = nib.load(os.path.join(args.parcellations_path, TEMPLATE))
+        bounds = None if reference.shape == store.shape else CROP_BOUNDS
+        engine = RegionStatistics(load_parcellations(args.parcellations_path,
+                                                     reference,
+                                                     args.cache_path),
+                                  mask=store.mask,
+                                  bounds=bounds)
+        batches = store.iterate(args.model)
+        brain_mask = None
+    else:
+        files = sorted([
+            f for f in os.listdir(args.map_path)
+            if f.endswith(('.nii', '.nii.gz'))
+        ])
+        reference = nib.load(os.path.join(args.map_path, files[0]))
+        engine = RegionStatistics(
+            load_parcellations(args.parcellations_path, reference,
+                               args.cache_path))
+        batches = iterate_maps(args.map_path, args.batch_size)
+        brain_mask = None
+        if args.brain_mask_file is not None:
+            brain_mask = nib.load(args.brain_mask_file).get_fdata() > 0
+
+    table = engine.generate(batches,
+                            statistic=args.statistic,
+                            percentile=args.percentile_threshold,
+                            brain_mask=brain_mask)
+
+    os.makedirs(os.path.dirname(args.out_file) or '.', exist_ok=True)
+    table.to_csv(args.out_file)
+
+
+# pass in arguments
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Calculate statistics of saliency maps '
+                                      'within the GM and WM parcellations, as '
+                                      'a subjects by regions table'))
+
+    parser.add_argument('-s',
+                        '--store_path',
+                        required=False,
+                        default=None,
+                        help=('Path to saliency store. Either this or '
+                              'map_path must be set'))
+    parser.add_argument('-m',
+                        '--model',
+                        required=False,
+                        default='pretrained',
+                        help=('Model of the maps in the store'))
+    parser.add_argument('-d',
+                        '--map_path',
+                        required=False,
+                        default=None,
+                        help=('Path to folder of nifti maps'))
+    parser.add_argument('-a',
+                        '--parcellations_path',
+                        required=True,
+                        help=('Path to GM and WM parcellations. Assumes the '
+                              'parcellations follow the same format as those '
+                              'provided in the repository'))
+    parser.add_argument('-t',
+                        '--statistic',
+                        required=False,
+                        default='mean',
+                        choices=STATISTICS,
+                        help=('Statistic of each region'))
+    parser.add_argument('-p',
+                        '--percentile_threshold',
+                        required=False,
+                        default=90,
+                        type=float,
+                        help=('Percentile threshold of thresholded_mean'))
+    parser.add_argument('-b',
+                        '--brain_mask_file',
+                        required=False,
+                        default=None,
+                        help=('Path to brain mask file for calculating the '
+                              'percentile threshold of nifti maps. Maps of a '
+                              'store use the mask of the store'))
+    parser.add_argument('--batch_size',
+                        required=False,
+                        default=16,
+                        type=int,
+                        help=('Number of nifti maps loaded at once'))
+    parser.add_argument('--cache_path',
+                        required=False,
+                        default=None,
+                        help=('Optional path to cache the parcellations '
+                              'resampled to the grid of the maps'))
+    parser.add_argument('-o',
+                        '--out_file',
+                        required=True,
+                        help=('Path to CSV of subjects by regions'))
+
+    args = parser.parse_args()
+    if (args.store_path is None) == (args.map_path is None):
+        parser.error('Exactly one of store_path and map_path must be set')
+    region_stats(args)
@@ -0,0 +1,312 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import nibabel as nib
+import matplotlib
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
+from matplotlib.ticker import MaxNLocator
+from display_map_slices import reshape_slice
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AXES = {'x': 0, 'y': 1, 'z': 2}
+SLICES = [('x', 97), ('z', 68), ('z', 89), ('z', 135)]
+
+
+# parse slices given as e.g. x97 or z68
+def parse_slice(text):
+    if text[0] not in AXES:
+        raise ValueError(f'Slice dimension {text[0]} not supported')
+
+    return (text[0], int(text[1:]))
+
+
+# read one slice of a volume, or of the array proxy of an image, so that
+# only that slice is loaded
+def read_slice(data, view):
+    index = [slice(None)] * 3
+    index[AXES[view[0]]] = view[1]
+
+    return np.asarray(data[tuple(index)], dtype=np.float64)
+
+
+# rgba colors of values with a colormap lookup table, normalized to
+# (lower, upper) as imshow does
+def to_colors(values, lower, upper, lut):
+    normalized = np.zeros_like(values)
+    if upper > lower:
+        normalized = (values - lower) / (upper - lower)
+    indices = np.clip((normalized * len(lut)).astype(int), 0, len(lut) - 1)
+
+    return lut[indices]
+
+
+class SliceRenderer:
+    """Renders thresholded map slices overlaid on a template, as
+    display_map_slices.py does, for many maps.
+
+    The template slices and the brain mask are loaded once. Each map is
+    read once and its thresholds computed once, and uncompressed maps with
+    fixed thresholds are only read for the displayed slices, through the
+    array proxy. Slices are composited directly as RGBA arrays and saved
+    as PNGs, upsampled by an integer scale, instead of drawing a figure
+    per slice. Colorbars are drawn on one figure reused for all maps,
+    without pyplot, so rendering is headless.
+    """
+
+    def __init__(self,
+                 template_file,
+                 slices=SLICES,
+                 colormap='inferno',
+                 thresholds=(90, 99),
+                 percentile_thresholds=False,
+                 brain_mask_file=None,
+                 colorbar=False,
+                 scale=4):
+        self.slices = [tuple(view) for view in slices]
+        self.colormap = colormap
+        self.thresholds = tuple(thresholds)
+        self.percentile_thresholds = percentile_thresholds
+        self.colorbar = colorbar
+        self.scale = scale
+        self._figure = None
+
+        cmap = matplotlib.colormaps[colormap]
+        self.lut = cmap(np.arange(cmap.N), bytes=True)
+        gray = matplotlib.colormaps['gray']
+        gray = gray(np.arange(gray.N), bytes=True)
+
+        template = nib.load(template_file)
+        self.shape = template.shape[:3]
+        self.backgrounds = []
+        for view in self.slices:
+            background = self._reshape(view,
+                                       read_slice(template.dataobj, view))
+            self.backgrounds.append(
+                to_colors(background, np.min(background),
+                          np.max(background), gray))
+
+        self.brain_mask = None
+        if percentile_thresholds:
+            if brain_mask_file is None:
+                raise ValueError('Percentile thresholds require a brain mask')
+            self.brain_mask = np.asanyarray(
+                nib.load(brain_mask_file).dataobj) > 0
+
+    # resize x slices to match the shape of z slices
+    def _reshape(self, view, values):
+        if view[0] == 'x':
+            values = reshape_slice(values, values.shape[1], values.shape[0])
+
+        return values
+
+    # flip as imshow with origin lower and an inverted x axis, and upsample
+    def _orient(self, rgba):
+        rgba = rgba.transpose(1, 0, 2)[::-1, ::-1]
+
+        return np.repeat(np.repeat(rgba, self.scale, axis=0),
+                         self.scale,
+                         axis=1)
+
+    def load(self, map_file):
+        """Returns the data of a map to read its slices from, and its lower
+        and upper thresholds. Only uncompressed maps with fixed thresholds
+        are read slice by slice, as reading a slice of a compressed file
+        decompresses it up to that slice"""
+        image = nib.load(map_file)
+        if image.shape[:3] != self.shape:
+            raise ValueError(f'Map of shape {image.shape} does not match '
+                             f'template of shape {self.shape}')
+
+        data = image.dataobj
+        if self.percentile_thresholds or map_file.endswith('.gz'):
+            data = np.asanyarray(data)
+        if not self.percentile_thresholds:
+            return data, self.thresholds
+
+        if data.shape[:3] != self.brain_mask.shape:
+            raise ValueError(f'Map of shape {data.shape} does not match '
+                             f'brain mask of shape {self.brain_mask.shape}')
+        thresholds = np.percentile(data[self.brain_mask].astype(np.float64),
+                                   self.thresholds)
+
+        return data, tuple(thresholds)
+
+    def render_colorbar(self, lower, upper, out_file):
+        if self._figure is None:
+            self._figure = Figure()
+        self._figure.clf()
+
+        axes = self._figure.add_subplot()
+        cbar = self._figure.colorbar(ScalarMappable(Normalize(lower, upper),
+                                                    self.colormap),
+                                     location='left',
+                                     ticks=MaxNLocator(nbins=1),
+                                     ax=axes)
+        cbar.ax.tick_params(labelsize=20)
+        axes.axis('off')
+        self._figure.savefig(out_file, transparent=True, bbox_inches='tight')
+
+    def render(self, map_file, out_path):
+        """Saves the slices of a map, and optionally its colorbar. Returns
+        the saved files"""
+        data, (lower, upper) = self.load(map_file)
+        name = os.path.basename(map_file).split('.')[0]
+
+        files = []
+        for view, background in zip(self.slices, self.backgrounds):
+            values = read_slice(data, view)
+            values = np.where(values < lower, np.nan,
+                              np.minimum(values, upper))
+            values = self._reshape(view, values)
+
+            rgba = background.copy()
+            visible = ~np.isnan(values)
+            rgba[visible] = to_colors(values[visible], lower, upper,
+                                      self.lut)
+
+            out_file = os.path.join(out_path,
+                                    f'{name}_{view[0]}{view[1]}.png')
+            imsave(out_file, self._orient(rgba))
+            files.append(out_file)
+
+        if self.colorbar:
+            out_file = os.path.join(out_path, f'{name}_colorbar.png')
+            self.render_colorbar(lower, upper, out_file)
+            files.append(out_file)
+
+        return files
+
+
+# renderer of a worker process, set once when the process starts
+_renderer = None
+
+
+def _init_worker(renderer):
+    global _renderer
+    _renderer = renderer
+
+
+def _render(map_file, out_path):
+    return _renderer.render(map_file, out_path)
+
+
+# render the slices of many maps, in parallel worker processes which each
+# hold one renderer
+def render_maps(renderer, map_files, out_path, workers=1):
+    names = [os.path.basename(f).split('.')[0] for f in map_files]
+    if len(set(names)) < len(names):
+        raise ValueError('Map files must have distinct names')
+    os.makedirs(out_path, exist_ok=True)
+
+    files = []
+    start = time.time()
+    if workers <= 1:
+        rendered = (renderer.render(f, out_path) for f in map_files)
+    else:
+        pool = ProcessPoolExecutor(workers,
+                                   initializer=_init_worker,
+                                   initargs=(renderer, ))
+        rendered = pool.map(_render, map_files, [out_path] * len(map_files))
+
+    try:
+        for count, map_files_out in enumerate(rendered, 1):
+            files += map_files_out
+            if count % 100 == 0 or count == len(map_files):
+                elapsed = time.time() - start
+                logger.info(f'{count}/{len(map_files)} maps, '
+                            f'{count / elapsed:.2f} maps/s')
+    finally:
+        if workers > 1:
+            pool.shutdown()
+
+    return files
+
+
+# render the slices of all given maps
+def render_slices(args):
+    renderer = SliceRenderer(args.template_file,
+                             slices=[parse_slice(s) for s in args.slices],
+                             colormap=args.colormap,
+                             thresholds=args.thresholds,
+                             percentile_thresholds=args.percentile_thresholds,
+                             brain_mask_file=args.brain_mask_file,
+                             colorbar=args.colorbar,
+                             scale=args.scale)
+    render_maps(renderer, args.map_files, args.out_path, args.workers)
+
+
+# pass in arguments
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        ('Render thresholded map slices overlaid on a template (MNI152) '
+         'brain for many maps'))
+
+    parser.add_argument('-m',
+                        '--map_files',
+                        required=True,
+                        nargs='+',
+                        help=('Paths to map files'))
+    parser.add_argument('-t',
+                        '--template_file',
+                        required=True,
+                        help=('Path to template file'))
+    parser.add_argument('-o',
+                        '--out_path',
+                        required=True,
+                        help=('Path to store output images'))
+    parser.add_argument('-c',
+                        '--colorbar',
+                        action='store_true',
+                        help=('If set, save separate png of colorbar'))
+    parser.add_argument('-l',
+                        '--colormap',
+                        required=False,
+                        default='inferno',
+                        help=('Colormap of overlaid map'))
+    parser.add_argument('-r',
+                        '--thresholds',
+                        required=False,
+                        default=[90, 99],
+                        nargs=2,
+                        type=float,
+                        help=('Lower and upper thresholds '
+                              'for map coloring'))
+    parser.add_argument('-p',
+                        '--percentile_thresholds',
+                        action='store_true',
+                        help=('If set, thresholds will be used as percentiles '
+                              'of map values within the brain'))
+    parser.add_argument('-b',
+                        '--brain_mask_file',
+                        required=False,
+                        help=('Path to brain mask file for calculating '
+                              'percentile thresholds'))
+    parser.add_argument('-s',
+                        '--slices',
+                        required=False,
+                        default=['x97', 'z68', 'z89', 'z135'],
+                        nargs='+',
+                        help=('Slice coordinates to display, e.g. x97 z68'))
+    parser.add_argument('--scale',
+                        required=False,
+                        default=4,
+                        type=int,
+                        help=('Number of pixels per voxel in each direction'))
+    parser.add_argument('-j',
+                        '--workers',
+                        required=False,
+                        default=1,
+                        type=int,
+                        help=('Number of worker processes'))
+
+    args = parser.parse_args()
+    render_slices(args)
@@ -0,0 +1,297 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+
+class SaliencyStore:
+    """Stores the saliency maps of a cohort compactly, for one or more
+    models.
+
+    Only the voxels inside a brain mask are kept, as float16 values scaled
+    by the largest absolute value of each map, so that small gradients do
+    not underflow. Maps are written in chunks of chunk_size subjects, each
+    chunk a (subjects, voxels) array in a .npy file which is memory mapped
+    when read. An append-only index per model maps each subject id to its
+    chunk, row and scale. A map written again for the same id replaces the
+    earlier one in the index.
+
+    Layout:
+        meta.json, mask.npy, affine.npy
+        <model>/index.csv
+        <model>/chunk-00000.npy, <model>/chunk-00001.npy, ...
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.shape = tuple(meta['shape'])
+        self.chunk_size = meta['chunk_size']
+        self.mask = np.load(os.path.join(path, 'mask.npy'))
+        self.affine = np.load(os.path.join(path, 'affine.npy'))
+        self.voxels = int(np.sum(self.mask))
+        self._indices = {}
+
+    @classmethod
+    def create(cls, path, mask, affine, chunk_size=64):
+        """Creates an empty store for maps with the shape of the mask, or
+        opens the store if it exists with the same mask"""
+        mask = np.asarray(mask, dtype=bool)
+        if os.path.isfile(os.path.join(path, 'meta.json')):
+            store = cls(path)
+            if not np.array_equal(store.mask, mask):
+                raise ValueError(f'Store {path} exists with another mask')
+            return store
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'mask.npy'), mask)
+        np.save(os.path.join(path, 'affine.npy'), np.asarray(affine))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'shape': list(mask.shape),
+                'chunk_size': chunk_size,
+                'dtype': 'float16'
+            }, f)
+
+        return cls(path)
+
+    def models(self):
+        return sorted([
+            name for name in os.listdir(self.path)
+            if os.path.isfile(os.path.join(self.path, name, 'index.csv'))
+        ])
+
+    def index(self, model):
+        """Returns the chunk, row and scale of every id stored for a
+        model"""
+        path = os.path.join(self.path, model, 'index.csv')
+        if not os.path.isfile(path):
+            raise KeyError(f'No maps stored for model {model}')
+
+        # the index is read again when maps have been added to it
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if model not in self._indices or self._indices[model][0] != version:
+            index = pd.read_csv(path, dtype={'id': str})
+            index = index.drop_duplicates('id', keep='last').set_index('id')
+            self._indices[model] = (version, index)
+
+        return self._indices[model][1]
+
+    def ids(self, model):
+        return list(self.index(model).index)
+
+    def _chunk(self, model, chunk):
+        return np.load(os.path.join(self.path, model,
+                                    f'chunk-{chunk:05d}.npy'),
+                       mmap_mode='r')
+
+    def values(self, id, model):
+        """Returns the values of a map inside the mask"""
+        entry = self.index(model).loc[id]
+        values = self._chunk(model, int(entry['chunk']))[int(entry['row'])]
+
+        return values.astype(np.float32) * entry['scale']
+
+    def unmask(self, values):
+        volume = np.zeros(self.shape, dtype=np.float32)
+        volume[self.mask] = values
+
+        return volume
+
+    def get(self, id, model):
+        """Returns the map of a subject as a volume"""
+        return self.unmask(self.values(id, model))
+
+    def to_nifti(self, id, model):
+        return self.to_nifti_values(self.values(id, model))
+
+    def to_nifti_values(self, values):
+        """Returns values inside the mask, e.g. a statistic computed from
+        the maps, as a nifti image"""
+        return nib.Nifti1Image(self.unmask(values), self.affine)
+
+    def iterate(self, model, ids=None):
+        """Yields (ids, values) for the maps of a model, one chunk at a
+        time, where values is a (maps, voxels) float32 array of the values
+        inside the mask. Maps are read in the order they are stored,
+        optionally restricted to the given ids"""
+        index = self.index(model)
+        if ids is not None:
+            index = index.loc[[id for id in ids if id in index.index]]
+
+        for chunk, entries in index.groupby('chunk', sort=True):
+            data = self._chunk(model, int(chunk))
+            values = data[entries['row'].values].astype(np.float32)
+            values *= entries['scale'].values[:, None].astype(np.float32)
+            yield list(entries.index), values
+
+    def block(self, model, ids, start, stop):
+        """Returns the values of the voxels in [start, stop) of the mask
+        for the given ids, as an (ids, voxels) float32 array. Only that
+        range of each map is read from the memory mapped chunks"""
+        index = self.index(model).loc[list(ids)]
+        index = index.assign(position=np.arange(len(index)))
+
+        values = np.empty((len(index), stop - start), dtype=np.float32)
+        for chunk, entries in index.groupby('chunk', sort=True):
+            data = self._chunk(model, int(chunk))
+            values[entries['position'].values] = \
+                data[entries['row'].values, start:stop] * \
+                entries['scale'].values[:, None].astype(np.float32)
+
+        return values
+
+    def writer(self, model):
+        return SaliencyWriter(self, model)
+
+
+class SaliencyWriter:
+    """Writes maps of one model to a store, with the same write interface
+    as NiftiMapWriter. Maps are buffered until a chunk is full. Several
+    writers, e.g. one per process, can add maps of the same model at
+    once"""
+
+    def __init__(self, store, model):
+        self.store = store
+        self.model = model
+        self.folder = os.path.join(store.path, model)
+        os.makedirs(self.folder, exist_ok=True)
+
+        chunks = [
+            int(f[len('chunk-'):-len('.npy')]) for f in os.listdir(self.folder)
+            if f.startswith('chunk-') and f.endswith('.npy')
+        ]
+        self._next = max(chunks) + 1 if len(chunks) > 0 else 0
+        self._ids = []
+        self._scales = []
+        self._buffer = np.zeros((store.chunk_size, store.voxels),
+                                dtype=np.float16)
+
+    def write(self, id, map, affine=None):
+        if tuple(map.shape) != self.store.shape:
+            raise ValueError(f'Map of shape {map.shape} does not match store '
+                             f'of shape {self.store.shape}')
+
+        values = np.asarray(map, dtype=np.float32)[self.store.mask]
+        scale = float(np.max(np.abs(values))) if len(values) > 0 else 0.
+        scale = scale if scale > 0 else 1.
+
+        self._buffer[len(self._ids)] = values / scale
+        self._ids.append(str(id))
+        self._scales.append(scale)
+
+        if len(self._ids) == self.store.chunk_size:
+            self.flush()
+
+    # take the next free chunk number. Other writers may be flushing at
+    # the same time, so a number is only taken by creating its file
+    def _reserve(self):
+        while True:
+            path = os.path.join(self.folder, f'chunk-{self._next:05d}.npy')
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self._next
+            except FileExistsError:
+                self._next += 1
+
+    def flush(self):
+        if len(self._ids) == 0:
+            return
+
+        # the chunk is in place before the index refers to it
+        chunk = self._reserve()
+        path = os.path.join(self.folder, f'chunk-{chunk:05d}.npy')
+        partial = os.path.join(self.folder, f'.partial-chunk-{chunk:05d}.npy')
+        np.save(partial, self._buffer[:len(self._ids)])
+        os.replace(partial, path)
+
+        index = pd.DataFrame({
+            'id': self._ids,
+            'chunk': chunk,
+            'row': np.arange(len(self._ids)),
+            'scale': self._scales
+        })
+        index_path = os.path.join(self.folder, 'index.csv')
+        if not os.path.isfile(index_path):
+            # the index appears with its header, as linking fails if
+            # another writer created it first
+            header = os.path.join(self.folder,
+                                  f'.partial-index-{os.getpid()}.csv')
+            with open(header, 'w') as f:
+                f.write(','.join(index.columns) + '\n')
+            try:
+                os.link(header, index_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(header)
+
+        # the rows of a chunk are appended in a single write, so that they
+        # are not interleaved with those of other writers
+        fd = os.open(index_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, index.to_csv(header=False, index=False).encode())
+        finally:
+            os.close(fd)
+
+        self._next += 1
+        self._ids = []
+        self._scales = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# load a brain mask, cropped by the given bounds if it does not have the
+# shape of the maps
+def load_mask(path, shape, bounds=None):
+    mask = nib.load(path).get_fdata() > 0
+    if mask.shape != tuple(shape):
+        if bounds is None:
+            raise ValueError(f'Mask of shape {mask.shape} does not match '
+                             f'maps of shape {shape}')
+        mask = mask[tuple(slice(*bound) for bound in bounds)]
+
+    return mask
+
+
+# export a stored map to a nifti file
+def export(args):
+    store = SaliencyStore(args.store_path)
+    os.makedirs(os.path.dirname(args.out_file) or '.', exist_ok=True)
+    nib.save(store.to_nifti(args.id, args.model), args.out_file)
+
+
+# pass in arguments
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Export a saliency map from a store '
+                                      'to a NIfTI file'))
+
+    parser.add_argument('-s',
+                        '--store_path',
+                        required=True,
+                        help=('Path to saliency store'))
+    parser.add_argument('-m',
+                        '--model',
+                        required=True,
+                        help=('Model the map was generated for, e.g. '
+                              'pretrained or finetuned'))
+    parser.add_argument('-i', '--id', required=True, help=('Image id'))
+    parser.add_argument('-o',
+                        '--out_file',
+                        required=True,
+                        help=('Path to output NIfTI file'))
+
+    args = parser.parse_args()
+    export(args)
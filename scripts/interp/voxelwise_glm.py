@@ -0,0 +1,309 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import stats
+from saliency_store import SaliencyStore
+
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class VoxelwiseGLM:
+    """Fits the same linear model at every voxel, Y = X B + E, for blocks
+    of voxels at a time.
+
+    The design is solved once: its pseudo-inverse and the diagonal of
+    (X'X)^-1 are shared by all voxels, so each block costs a few matrix
+    products. Permutation tests of one regressor use Freedman-Lane: the
+    residuals of the model without the regressor are permuted. Since the
+    fitted part of that model lies in the span of the full design, the
+    coefficient of the regressor for a permutation P is (P'w) R, with w
+    the row of the pseudo-inverse and R the reduced residuals, and the
+    residual sum of squares is |R|^2 - |(P'Q)' R|^2 with Q an orthonormal
+    basis of the design. A batch of permutations is thus two matrix
+    products per block, without building the permuted maps.
+
+    Subjects with more than one map, e.g. from several sessions, are not
+    exchangeable. Given exchangeability blocks, subjects are only permuted
+    within their block, or with whole_blocks, blocks of equal size are
+    permuted as wholes.
+    """
+
+    def __init__(self, design, names, test=None, permutations=0,
+                 batch_size=100, seed=0, blocks=None, whole_blocks=False):
+        self.X = np.asarray(design, dtype=np.float64)
+        self.names = list(names)
+        n, p = self.X.shape
+        if np.linalg.matrix_rank(self.X) < p:
+            raise ValueError('Design matrix is rank deficient')
+
+        self.df = n - p
+        self.pinv = np.linalg.pinv(self.X)
+        self.diagonal = np.diag(np.linalg.inv(self.X.T @ self.X))
+
+        self.test = test
+        self.batch_size = batch_size
+        if test is not None:
+            j = self.names.index(test)
+            self.j = j
+            self.Z = np.delete(self.X, j, axis=1)
+            self.Z_pinv = np.linalg.pinv(self.Z)
+            self.Q = np.linalg.qr(self.X)[0]
+
+            # the first permutation is the identity, so the observed
+            # statistic is part of the null distribution
+            rng = np.random.default_rng(seed)
+            members = [np.arange(n)] if blocks is None else [
+                np.flatnonzero(np.asarray(blocks) == block)
+                for block in pd.unique(np.asarray(blocks))
+            ]
+            if whole_blocks and len(set(map(len, members))) > 1:
+                raise ValueError('Whole blocks are only exchangeable when '
+                                 'they have the same size')
+            self.permutations = np.stack(
+                [np.arange(n)] + [
+                    permute_blocks(rng, members, whole_blocks)
+                    for _ in range(permutations)
+                ])
+            self.max_null = np.zeros(len(self.permutations))
+
+    def fit(self, Y):
+        """Returns betas, t-statistics and p-values, each of shape
+        (regressors, voxels), for a (subjects, voxels) block"""
+        Y = np.asarray(Y, dtype=np.float64)
+        betas = self.pinv @ Y
+        residuals = Y - self.X @ betas
+        sigma2 = np.sum(residuals**2, axis=0) / self.df
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            se = np.sqrt(self.diagonal[:, None] * sigma2[None])
+            t = betas / se
+        p = 2 * stats.t.sf(np.abs(t), self.df)
+
+        if self.test is not None:
+            self._permute(Y)
+
+        return betas, t, p
+
+    def _permute(self, Y):
+        R = Y - self.Z @ (self.Z_pinv @ Y)
+        total = np.sum(R**2, axis=0)
+        w = self.pinv[self.j]
+        p = self.X.shape[1]
+
+        for start in range(0, len(self.permutations), self.batch_size):
+            batch = self.permutations[start:start + self.batch_size]
+
+            # (P'w)_i = w_{P^-1(i)}, so rows of R are matched through the
+            # inverse permutation
+            inverse = np.argsort(batch, axis=1)
+            betas = w[inverse] @ R
+            projected = (self.Q[inverse].transpose(0, 2, 1).reshape(
+                len(batch) * p, -1)) @ R
+            rss = total[None] - np.sum(
+                projected.reshape(len(batch), p, -1)**2, axis=1)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = betas / np.sqrt(self.diagonal[self.j] * rss / self.df)
+            t = np.nan_to_num(np.abs(t))
+            self.max_null[start:start + len(batch)] = np.maximum(
+                self.max_null[start:start + len(batch)], np.max(t, axis=1))
+
+    def fwe(self, t):
+        """Returns family-wise error corrected p-values of t-statistics of
+        the tested regressor, from the maximum statistic over voxels of
+        each permutation"""
+        null = np.sort(self.max_null)
+        exceeding = len(null) - np.searchsorted(null, np.abs(t), side='left')
+
+        return exceeding / len(null)
+
+
+# a permutation of subjects that only moves them within their block, or
+# with whole_blocks moves blocks as wholes, keeping the order within them
+def permute_blocks(rng, members, whole_blocks=False):
+    permutation = np.empty(sum(map(len, members)), dtype=np.int64)
+    if whole_blocks:
+        for target, source in zip(members, rng.permutation(len(members))):
+            permutation[target] = members[source]
+    else:
+        for indices in members:
+            permutation[indices] = rng.permutation(indices)
+
+    return permutation
+
+
+# ids of the rows of a data file. Rows are formatted as records, as apply
+# turns integer columns into floats when the row holds any float
+def format_ids(df, id_format):
+    return [id_format.format(**row) for row in df.to_dict('records')]
+
+
+# load covariates and the optional group column, leaving out excluded
+# subjects and subjects with missing values
+def load_covariates(data_file,
+                    covariates,
+                    id_format,
+                    exclude_file=None,
+                    groups=None):
+    df = pd.read_csv(data_file)
+    df.index = format_ids(df, id_format)
+    if exclude_file is not None:
+        excluded = set(format_ids(pd.read_csv(exclude_file), id_format))
+        df = df[~df.index.isin(excluded)]
+
+    duplicated = df.index[df.index.duplicated()]
+    if len(duplicated) > 0:
+        raise ValueError(f'Ids {sorted(set(duplicated))} occur more than '
+                         f'once in {data_file}. Use an id format that tells '
+                         'the rows apart')
+
+    columns = list(covariates)
+    if groups is not None and groups not in columns:
+        columns.append(groups)
+
+    return df[columns].dropna()
+
+
+# fit the glm for all voxels of the maps in a store
+def voxelwise_glm(args):
+    store = SaliencyStore(args.store_path)
+    df = load_covariates(args.data_file, args.covariates, args.id_format,
+                         args.exclude_file, args.groups)
+    stored = set(store.ids(args.model))
+    df = df[df.index.isin(stored)]
+    if len(df) <= len(args.covariates) + 1:
+        raise ValueError(f'Only {len(df)} subjects with maps and covariates')
+    logger.info(f'Fitting {len(df)} subjects and {store.voxels} voxels')
+
+    design = np.column_stack(
+        [np.ones(len(df)), df[args.covariates].values.astype(float)])
+    names = ['intercept'] + list(args.covariates)
+    glm = VoxelwiseGLM(design,
+                       names,
+                       test=args.test,
+                       permutations=args.permutations,
+                       batch_size=args.permutation_batch_size,
+                       seed=args.seed,
+                       blocks=df[args.groups].values
+                       if args.groups is not None else None,
+                       whole_blocks=args.whole_blocks)
+
+    results = {
+        name: np.zeros((len(names), store.voxels), dtype=np.float32)
+        for name in ['beta', 't', 'p']
+    }
+    start = time.time()
+    for v0 in range(0, store.voxels, args.block_size):
+        v1 = min(v0 + args.block_size, store.voxels)
+        Y = store.block(args.model, df.index, v0, v1)
+        for name, values in zip(['beta', 't', 'p'], glm.fit(Y)):
+            results[name][:, v0:v1] = values
+        elapsed = time.time() - start
+        logger.info(f'{v1}/{store.voxels} voxels, '
+                    f'{v1 / elapsed:.0f} voxels/s')
+
+    os.makedirs(args.out_path, exist_ok=True)
+    for name, values in results.items():
+        for regressor, row in zip(names, values):
+            nib.save(store.to_nifti_values(row),
+                     os.path.join(args.out_path, f'{name}_{regressor}.nii.gz'))
+
+    if args.test is not None:
+        j = names.index(args.test)
+        nib.save(store.to_nifti_values(glm.fwe(results['t'][j])),
+                 os.path.join(args.out_path, f'p_fwe_{args.test}.nii.gz'))
+        pd.DataFrame({'max_t': glm.max_null}).to_csv(
+            os.path.join(args.out_path, f'max_null_{args.test}.csv'),
+            index=False)
+
+
+# pass in arguments
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(('Fit a linear model relating saliency '
+                                      'maps to covariates at every voxel, '
+                                      'with optional permutation based FWE '
+                                      'correction'))
+
+    parser.add_argument('-s',
+                        '--store_path',
+                        required=True,
+                        help=('Path to saliency store'))
+    parser.add_argument('-m',
+                        '--model',
+                        required=False,
+                        default='pretrained',
+                        help=('Model of the maps in the store'))
+    parser.add_argument('-d',
+                        '--data_file',
+                        required=True,
+                        help=('CSV with covariates, e.g. '
+                              'data/analysis/EDIS.csv'))
+    parser.add_argument('-x',
+                        '--exclude_file',
+                        required=False,
+                        default=None,
+                        help=('Optional CSV of excluded subjects'))
+    parser.add_argument('-i',
+                        '--id_format',
+                        required=False,
+                        default='{SubID}',
+                        help=('Format of the map ids from the columns of '
+                              'the data file, e.g. {SubID}_{age_category}'))
+    parser.add_argument('-c',
+                        '--covariates',
+                        required=True,
+                        nargs='+',
+                        help=('Covariates of the model, e.g. chron_age sex '
+                              'yr_edu'))
+    parser.add_argument('-t',
+                        '--test',
+                        required=False,
+                        default=None,
+                        help=('Covariate tested with permutations'))
+    parser.add_argument('-g',
+                        '--groups',
+                        required=False,
+                        default=None,
+                        help=('Column of the data file with the '
+                              'exchangeability block of each map, e.g. '
+                              'SubID when subjects have several maps. Maps '
+                              'are only permuted within their block'))
+    parser.add_argument('--whole_blocks',
+                        action='store_true',
+                        help=('If set, blocks of the same size are permuted '
+                              'as wholes instead of within'))
+    parser.add_argument('-n',
+                        '--permutations',
+                        required=False,
+                        default=1000,
+                        type=int,
+                        help=('Number of permutations'))
+    parser.add_argument('--permutation_batch_size',
+                        required=False,
+                        default=100,
+                        type=int,
+                        help=('Number of permutations computed at once'))
+    parser.add_argument('-b',
+                        '--block_size',
+                        required=False,
+                        default=20000,
+                        type=int,
+                        help=('Number of voxels fitted at once'))
+    parser.add_argument('--seed',
+                        required=False,
+                        default=0,
+                        type=int,
+                        help=('Seed of the permutations'))
+    parser.add_argument('-o',
+                        '--out_path',
+                        required=True,
+                        help=('Path to store output maps'))
+
+    args = parser.parse_args()
+    voxelwise_glm(args)
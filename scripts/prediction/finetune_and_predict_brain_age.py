@@ -1,9 +1,16 @@
 import os
 import argparse
+import logging
+import numpy as np
 import pandas as pd
+import tensorflow as tf
 
 from pyment.models import get as get_model, ModelType
-from pyment.data import AsyncNiftiGenerator, NiftiDataset
+from pyment.data import AsyncNiftiGenerator, BatchAugmenter, NiftiDataset
+from pyment.utils import auto_batch_size, configure_tensorflow_threads, \
+                         estimate_sample_memory, find_batch_size, \
+                         parse_batch_size, peak_memory, pin_current_thread, \
+                         resolve_cpus
 
 import keras
 from keras.callbacks import CSVLogger
@@ -11,6 +18,53 @@ from keras.callbacks import ModelCheckpoint
 from tensorflow.keras.optimizers.schedules import CosineDecay
 
 
+logformat = '%(asctime)s - %(levelname)s - %(name)s: %(message)s'
+logging.basicConfig(format=logformat, level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# pin compute and configure tensorflow threads before any model is built
+def configure_threads(args):
+    pin_current_thread(resolve_cpus(args.compute_cpus))
+    configure_tensorflow_threads(intra_op=args.intra_op_threads,
+                                 inter_op=args.inter_op_threads)
+    args.loader_cpus = resolve_cpus(args.loader_cpus)
+    return args
+
+
+# choose the largest batch size that fits in memory while training
+def set_batch_size(args):
+    if args.batch_size != 'auto':
+        return args
+
+    model = get_model(args.model_name,
+                      weights=None,
+                      dropout=args.dropout_rate,
+                      weight_decay=args.weight_decay,
+                      prediction_range=None)
+
+    # images are decoded as float64, and the training and validation
+    # generators both hold a preloaded batch
+    sample_memory = estimate_sample_memory(model, dtype='float64',
+                                           training=True) + \
+                    2 * np.prod(model.input_shape[1:]) * 8
+    batch_size = auto_batch_size(sample_memory)
+
+    # run a forward and backward pass without applying the gradients
+    def trial(batch_size):
+        X = tf.zeros((batch_size, ) + model.input_shape[1:])
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(model(X, training=True))
+        tape.gradient(loss, model.trainable_variables)
+
+    args.batch_size = find_batch_size(
+        trial,
+        batch_size,
+        exceptions=(MemoryError, tf.errors.ResourceExhaustedError))
+
+    return args
+
+
 # load train, validation, and test datasets
 def load_datasets(args):
     args.labels_path = os.path.join('labels', args.split)
@@ -45,18 +99,21 @@ def load_generators(args):
                                          preprocessor=preprocessor,
                                          batch_size=args.batch_size,
                                          threads=args.threads,
+                                         cpus=args.loader_cpus,
                                          infinite=True,
                                          shuffle=True)
     args.val_gen = AsyncNiftiGenerator(args.val_dataset,
                                        preprocessor=preprocessor,
                                        batch_size=args.batch_size,
                                        threads=args.threads,
+                                       cpus=args.loader_cpus,
                                        infinite=True,
                                        shuffle=True)
     args.test_gen = AsyncNiftiGenerator(args.test_dataset,
                                         preprocessor=preprocessor,
                                         batch_size=args.batch_size,
-                                        threads=args.threads)
+                                        threads=args.threads,
+                                        cpus=args.loader_cpus)
     return args
 
 
@@ -163,7 +220,10 @@ def predict_brain_age(args):
     if args.log_path is not None:
         args.model.load_weights(args.bw_filepath)
 
-    args.predictions = args.model.predict(args.test_gen, steps=args.steps_te)
+    augmenter = BatchAugmenter(args.tta) if args.tta is not None else None
+    args.predictions = args.model.predict(args.test_gen,
+                                          augmenter=augmenter,
+                                          steps=args.steps_te)
     if args.model.type == ModelType.REGRESSION:
         args.predictions = args.predictions.squeeze()
 
@@ -177,14 +237,18 @@ def predict_brain_age(args):
     if not os.path.exists(destination_dir):
         os.makedirs(destination_dir)
     args.df.to_csv(args.destination)
+    logger.info(f'Finished with batch size {args.batch_size}. Peak memory: '
+                f'{peak_memory() / 2**20:.1f}MB')
 
     return args
 
 
 # wrapper function
 def finetune_and_predict_brain_age(args):
+    args = configure_threads(args)
     keras.utils.set_random_seed(0)
     args = load_datasets(args)
+    args = set_batch_size(args)
     args = load_generators(args)
 
     args = config_training(args)
@@ -212,8 +276,11 @@ if __name__ == '__main__':
     parser.add_argument('-b',
                         '--batch_size',
                         required=True,
-                        type=int,
-                        help='Batch size to use while training and predicting')
+                        type=parse_batch_size,
+                        help=('Batch size to use while training and '
+                              'predicting. If \'auto\', the largest batch '
+                              'size that fits in the available memory is '
+                              'used'))
     parser.add_argument('-t',
                         '--threads',
                         required=False,
@@ -298,6 +365,36 @@ if __name__ == '__main__':
                         action='store_true',
                         help=('If set, only 2 steps per epoch are used for '
                               'training to enable a quick test.'))
+    parser.add_argument('--intra_op_threads',
+                        required=False,
+                        default=None,
+                        type=int,
+                        help=('Number of threads used within each TensorFlow '
+                              'operation'))
+    parser.add_argument('--inter_op_threads',
+                        required=False,
+                        default=None,
+                        type=int,
+                        help=('Number of TensorFlow operations run in '
+                              'parallel'))
+    parser.add_argument('--loader_cpus',
+                        required=False,
+                        default=None,
+                        help=('CPUs the threads reading data are pinned to, '
+                              'either as a list (e.g. 0-7,16) or a NUMA node '
+                              '(e.g. numa:1)'))
+    parser.add_argument('--compute_cpus',
+                        required=False,
+                        default=None,
+                        help=('CPUs TensorFlow is pinned to, either as a list '
+                              '(e.g. 8-15) or a NUMA node (e.g. numa:0)'))
+    parser.add_argument('--tta',
+                        required=False,
+                        default=None,
+                        nargs='+',
+                        help=('If set, test predictions are averaged over the '
+                              'given test-time augmentations, e.g. identity '
+                              'flip shift:2,0,0 shift:-2,0,0'))
 
     args = parser.parse_args()
 